@@ -10,4 +10,5 @@
 __version__ = '1.0.0'
 
 from .implant import embed, remove
-from eww.stats import incr, put, decr, graph, memory_consumption
+from eww.stats import (incr, put, decr, graph, histogram, timer, gauge,
+                       memory_consumption)
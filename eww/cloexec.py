@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.cloexec
+    ~~~~~~~~~~~
+
+    Marks the file descriptors Eww owns close-on-exec, so they aren't leaked
+    into programs the application runs.  Python 2 creates sockets, pipes and
+    files inheritable.
+
+"""
+
+import os
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # We're on Windows, where nothing is inherited unless asked for
+    pass
+import sys
+
+def set_cloexec(fd):
+    """Sets ``FD_CLOEXEC`` on a file descriptor.
+
+    Args:
+        fd: A file descriptor, or anything with a ``fileno()`` method, like a
+            socket.
+
+    Returns:
+        None
+    """
+
+    if 'fcntl' not in sys.modules:  # pragma: no cover
+        return
+
+    if hasattr(fd, 'fileno'):
+        fd = fd.fileno()
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def set_cloexec_duplicates(fd):
+    """Sets ``FD_CLOEXEC`` on every descriptor open on the same file as
+    ``fd``.  Python 2's :py:mod:`mmap` keeps a private duplicate of the
+    descriptor it was given, which we can only find this way.  Only works
+    where ``/proc/self/fd`` exists.
+
+    Args:
+        fd (int): A descriptor for the file.
+
+    Returns:
+        None
+    """
+
+    if 'fcntl' not in sys.modules:  # pragma: no cover
+        return
+
+    target = os.fstat(fd)
+
+    try:
+        names = os.listdir('/proc/self/fd')
+    except OSError:  # pragma: no cover
+        return
+
+    for name in names:
+        try:
+            other = os.fstat(int(name))
+        except (OSError, ValueError):
+            # Closed since we listed them, e.g. listdir's own descriptor
+            continue
+        if (other.st_dev, other.st_ino) == (target.st_dev, target.st_ino):
+            set_cloexec(int(name))
@@ -22,9 +22,13 @@ import code
 import logging
 from math import ceil
 import os
+import select
 import shlex
 from StringIO import StringIO
 import sys
+import threading
+import time
+import traceback
 import __builtin__
 
 try:
@@ -33,12 +37,42 @@ except ImportError:  # pragma: no cover
     # Just in case pygal isn't installed
     pass
 
+from .memory import (MemoryTracker, ObjectCountThread, count_objects, diff,
+                     format_bytes, process_memory, top)
 from .parser import Parser, ParserError, Opt
+from .profiler import (InvalidInterval, ProfilerUnavailable, StackSampler,
+                       ThreadProfiler, parse_interval)
 from .quitterproxy import safe_quit
-from .shared import COUNTER_STORE, GRAPH_STORE
+from .shared import (MEMORY_STATUS, OBJECTS_STATUS, PROFILER_STATUS,
+                     STATS_CONFIG)
+from .stats import graph, snapshot
+from .statsfile import read_stats_files
+from .stoppable_thread import WakeableThread
+from .threadinfo import task_cpu_times, thread_info
 
 LOGGER = logging.getLogger(__name__)
 
+# Printed by commands that run until a line is entered.  The client forwards
+# typed lines only after seeing it, so it must match scripts/eww.
+STOP_HINT = 'Press enter to stop'
+
+def wait_for_input(input_file, timeout):
+    """Waits for a line to be entered.  We use poll() rather than select(),
+    since the console's socket can be at or above ``FD_SETSIZE`` in busy
+    applications.
+
+    Args:
+        input_file (file): The file to watch, e.g. ``sys.stdin``.
+        timeout (float): Seconds to wait.
+
+    Returns:
+        bool: True if there's input to read.
+    """
+
+    poller = select.poll()
+    poller.register(input_file, select.POLLIN)
+    return bool(WakeableThread.wait_readable(poller, timeout))
+
 class Command(cmd.Cmd):
     """Our cmd subclass where we implement all console functionality."""
 
@@ -197,6 +231,24 @@ class Command(cmd.Cmd):
                            action='store',
                            type='string',
                            help='Graph title'))
+        options.append(Opt('-r', '--rate',
+                           dest='rate',
+                           default=False,
+                           action='store_true',
+                           help='Show counter rates per second'))
+        options.append(Opt('-w', '--watch',
+                           dest='watch',
+                           default=False,
+                           action='store',
+                           type='float',
+                           help='Show counter changes every WATCH seconds '
+                                'until enter is pressed'))
+        options.append(Opt('-a', '--all',
+                           dest='all',
+                           default=False,
+                           action='store_true',
+                           help='Show stats from every process sharing our '
+                                'stats file'))
 
         def __init__(self):
             """Init."""
@@ -208,6 +260,12 @@ class Command(cmd.Cmd):
             # Pygal won't support more than this currently
             self.max_points = 30
 
+            # Quantiles reported for histograms
+            self.quantiles = [('p50', 0.5),
+                              ('p90', 0.9),
+                              ('p99', 0.99),
+                              ('p999', 0.999)]
+
         def display_stat_summary(self):
             """Prints a summary of collected stats.
 
@@ -215,19 +273,36 @@ class Command(cmd.Cmd):
                 None
             """
 
-            if not COUNTER_STORE and not GRAPH_STORE:
+            stats = snapshot(rates=False)
+
+            if (not stats.counters and not stats.graphs and
+                    not stats.histograms and not stats.gauges and
+                    not stats.dropped):
                 print "No stats recorded."
                 return
 
-            if COUNTER_STORE:
+            if stats.counters:
                 print "Counters:"
-                for stat in COUNTER_STORE:
-                    print " ", stat + ':' + str(COUNTER_STORE[stat])
+                for stat, value in stats.counters.iteritems():
+                    print " ", stat + ':' + self.format_counter(value)
 
-            if GRAPH_STORE:
+            if stats.graphs:
                 print "Graphs:"
-                for stat in GRAPH_STORE:
-                    print " ", stat + ':' + str(len(GRAPH_STORE[stat]))
+                for stat, summary in stats.graphs.iteritems():
+                    print " ", stat + ':' + str(summary.length)
+
+            if stats.histograms:
+                print "Histograms:"
+                for stat, summary in stats.histograms.iteritems():
+                    print " ", stat + ':' + str(summary.count)
+
+            if stats.gauges:
+                print "Gauges:"
+                for stat, value in stats.gauges.iteritems():
+                    print " ", stat + ':' + self.format_gauge(value)
+
+            if stats.dropped:
+                print "Dropped stats (stats queue full):", stats.dropped
 
         def display_single_stat(self, stat_name):
             """Prints a specific stat.
@@ -239,17 +314,228 @@ class Command(cmd.Cmd):
                 None
             """
 
-            if stat_name in COUNTER_STORE:
-                print COUNTER_STORE[stat_name]
+            stats = snapshot(graphs=False, histograms=False, rates=False,
+                             series=[stat_name], distributions=[stat_name])
+
+            if stat_name in stats.counters:
+                print self.format_counter(stats.counters[stat_name])
+                return
+
+            if stat_name in stats.series:
+                print list(stats.series[stat_name])
+                return
+
+            if stat_name in stats.distributions:
+                self.display_histogram(stats.distributions[stat_name])
                 return
 
-            if stat_name in GRAPH_STORE:
-                print list(GRAPH_STORE[stat_name])
+            if stat_name in stats.gauges:
+                print self.format_gauge(stats.gauges[stat_name])
                 return
 
             else:
                 print 'No stat recorded with that name.'
 
+        def format_counter(self, value):
+            """Formats a counter value for display.  Sampled counters are
+            scaled estimates, so they can be fractional; we round them.
+
+            Args:
+                value (int): The counter's value.
+
+            Returns:
+                str: The formatted value.
+            """
+
+            if isinstance(value, float):
+                value = int(round(value))
+            return str(value)
+
+        def display_all_processes(self, stat_name=None):
+            """Prints counters and graphs from every live process writing a
+            stats file with the same template as us, summed and per-PID.
+
+            Args:
+                stat_name (str): If provided, only this stat is printed.
+
+            Returns:
+                None
+            """
+
+            if not STATS_CONFIG['stats_file']:
+                print 'Eww was not embedded with a stats_file.'
+                return
+
+            processes = read_stats_files(STATS_CONFIG['stats_file'])
+            if not processes:
+                print 'No processes found.'
+                return
+
+            pids = sorted(processes)
+            print 'Processes:', ', '.join([str(pid) for pid in pids])
+
+            # (title, index into the per-process tuple, value formatter)
+            sections = (('Counters', 0, lambda value: value),
+                        ('Graphs', 1, len))
+            found = False
+
+            for title, index, value_of in sections:
+                names = set()
+                for pid in pids:
+                    names.update(processes[pid][index])
+                if stat_name is not None:
+                    names &= set([stat_name])
+                if not names:
+                    continue
+
+                found = True
+                print title + ':'
+                for name in sorted(names):
+                    total = 0
+                    per_pid = []
+                    for pid in pids:
+                        if name not in processes[pid][index]:
+                            continue
+                        value = value_of(processes[pid][index][name])
+                        total += value
+                        per_pid.append(str(pid) + ':' +
+                                       self.format_counter(value))
+                    print ' ', (name + ':' + self.format_counter(total) +
+                                ' (' + ' '.join(per_pid) + ')')
+
+            if stat_name is not None and not found:
+                print 'No stat recorded with that name.'
+
+        def format_gauge(self, value):
+            """Formats a gauge value for display.
+
+            Args:
+                value: The value read from the gauge.
+
+            Returns:
+                str: The formatted value.
+            """
+
+            if value is None:
+                return 'unavailable'
+            return str(value)
+
+        def display_rates(self, stat_name=None):
+            """Prints how quickly counters are changing, per second, over each
+            of our rate windows.
+
+            Args:
+                stat_name (str): A counter to display rates for.  If not
+                                 provided, all counters are displayed.
+
+            Returns:
+                None
+            """
+
+            stats = snapshot(graphs=False, histograms=False, gauges=False)
+
+            if stat_name:
+                if stat_name not in stats.rates:
+                    print 'No rates recorded for name', stat_name
+                    return
+                names = [stat_name]
+            else:
+                names = sorted(stats.rates)
+
+            if not names:
+                print 'No rates recorded.'
+                return
+
+            header = '/'.join([self.format_window(window)
+                               for window in stats.rates[names[0]].windows])
+            print 'Rates (per second, over ' + header + '):'
+
+            for name in names:
+                rates = stats.rates[name].rates(stats.time)
+                rates = ' '.join(['%.1f' % rate for window, rate in rates])
+                print " ", name + ':', rates
+
+        def format_window(self, window):
+            """Formats a rate window for display.
+
+            Args:
+                window (int): The window length in seconds.
+
+            Returns:
+                str: e.g. '10s' or '5m'.
+            """
+
+            if window > 60 and window % 60 == 0:
+                return str(window / 60) + 'm'
+            return str(window) + 's'
+
+        def watch(self, interval, stat_name=None, input_file=None):
+            """Prints the counters that changed every ``interval`` seconds,
+            until a line is entered or the connection is closed.  Only
+            changed counters are printed, so this stays cheap with lots of
+            counters.
+
+            Args:
+                interval (float): Seconds between updates.
+                stat_name (str): Only watch this counter.  If not provided,
+                                 all counters are watched.
+                input_file (file): The file to watch for input.  Defaults to
+                                   ``sys.stdin``.
+
+            Returns:
+                None
+            """
+
+            input_file = input_file or sys.stdin
+
+            print 'Watching counters every', interval, 'seconds.',
+            print STOP_HINT + '.'
+
+            previous = snapshot(False, False, False, False).counters
+
+            while True:
+                if wait_for_input(input_file, interval):
+                    # Consume the line that stopped us
+                    input_file.readline()
+                    return
+
+                current = snapshot(False, False, False, False).counters
+                changes = []
+
+                for name in sorted(current):
+                    if stat_name and name != stat_name:
+                        continue
+                    delta = current[name] - previous.get(name, 0)
+                    if not delta and name in previous:
+                        continue
+                    if isinstance(delta, float):
+                        delta = int(round(delta))
+                    value = self.format_counter(current[name])
+                    changes.append(name + ':' + value + ' (%+d)' % delta)
+
+                previous = current
+
+                if changes:
+                    print time.strftime('[%H:%M:%S]'), ' '.join(changes)
+
+        def display_histogram(self, histogram):
+            """Prints a histogram's count, min, max and quantiles.
+
+            Args:
+                histogram (Histogram): The histogram to display.
+
+            Returns:
+                None
+            """
+
+            print 'count:', histogram.count
+            print 'total:', '%g' % histogram.total
+            print 'min:', '%g' % histogram.min
+            print 'max:', '%g' % histogram.max
+
+            for label, quantile in self.quantiles:
+                print label + ':', '%g' % histogram.quantile(quantile)
+
         def reduce_data(self, data):
             """Shrinks len(data) to ``self.max_points``.
 
@@ -282,7 +568,10 @@ class Command(cmd.Cmd):
                 None
             """
 
-            if stat_name not in GRAPH_STORE:
+            graphs = snapshot(graphs=False, histograms=False, rates=False,
+                              gauges=False, series=[stat_name]).series
+
+            if stat_name not in graphs:
                 print 'No graph records exist for name', stat_name
                 return
 
@@ -291,7 +580,7 @@ class Command(cmd.Cmd):
                 print 'pygal`.'
                 return
 
-            data = list(GRAPH_STORE[stat_name])
+            data = list(graphs[stat_name])
             graph = pygal.Line()
 
             if options['title']:
@@ -339,6 +628,20 @@ class Command(cmd.Cmd):
 
             options = vars(options)
 
+            stat_name = remainder[0] if remainder else None
+
+            if options['all']:
+                self.display_all_processes(stat_name)
+                return
+
+            if options['rate']:
+                self.display_rates(stat_name)
+                return
+
+            if options['watch']:
+                self.watch(options['watch'], stat_name)
+                return
+
             if not remainder:
                 # User entered something goofy
                 help_cmd = Command.help_command()
@@ -352,6 +655,773 @@ class Command(cmd.Cmd):
                 self.display_single_stat(remainder[0])
                 return
 
+    class profile_command(BaseCmd):
+        """A command for sampling what every thread is running."""
+
+        name = 'profile'
+        description = 'Samples thread stacks and outputs collapsed stacks.'
+        usage = 'profile [args]'
+
+        # Declare options
+        options = []
+        options.append(Opt('-d', '--duration',
+                           dest='duration',
+                           default='10s',
+                           action='store',
+                           type='string',
+                           help='How long to sample for, e.g. 30s'))
+        options.append(Opt('-i', '--interval',
+                           dest='interval',
+                           default='10ms',
+                           action='store',
+                           type='string',
+                           help='Time between samples, e.g. 5ms'))
+        options.append(Opt('-f', '--file',
+                           dest='file',
+                           default=False,
+                           action='store',
+                           type='string',
+                           help='Write collapsed stacks to this file'))
+        options.append(Opt('-m', '--max-stacks',
+                           dest='max_stacks',
+                           default=10000,
+                           action='store',
+                           type='int',
+                           help='Maximum number of unique stacks kept'))
+        options.append(Opt('-e', '--include-eww',
+                           dest='include_eww',
+                           default=False,
+                           action='store_true',
+                           help='Also sample Eww\'s own threads'))
+
+        def __init__(self):
+            """Init."""
+            super(Command.profile_command, self).__init__()
+
+            self.parser = Parser()
+            self.parser.add_options(self.options)
+
+        def profile(self, sampler, duration, interval, input_file=None):
+            """Samples stacks every ``interval`` seconds until ``duration``
+            seconds have passed, a line is entered or the connection is
+            closed.
+
+            Args:
+                sampler (StackSampler): Takes and aggregates the samples.
+                duration (float): Seconds to sample for.
+                interval (float): Seconds between samples.
+                input_file (file): The file to watch for input.  Defaults to
+                                   ``sys.stdin``.
+
+            Returns:
+                float: The number of seconds we actually sampled for.
+            """
+
+            input_file = input_file or sys.stdin
+
+            print 'Sampling every', interval, 'seconds for', duration,
+            print 'seconds. ', STOP_HINT, 'early.'
+
+            start = time.time()
+            deadline = start + duration
+
+            while True:
+                sampler.sample()
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                if wait_for_input(input_file, min(interval, remaining)):
+                    # Consume the line that stopped us
+                    input_file.readline()
+                    break
+
+            return time.time() - start
+
+        def run(self, line):
+            """Samples thread stacks and outputs them as collapsed stacks.
+
+            Args:
+                line (str): A command line argument to be parsed.
+
+            Returns:
+                None
+            """
+
+            try:
+                options, _ = self.parser.parse_args(shlex.split(line))
+                duration = parse_interval(options.duration)
+                interval = parse_interval(options.interval)
+            except (ParserError, InvalidInterval) as error_msg:
+                print error_msg
+                return
+
+            sampler = StackSampler(max_stacks=max(options.max_stacks, 1),
+                                   include_eww=options.include_eww)
+            elapsed = self.profile(sampler, duration, interval)
+            lines = sampler.collapsed()
+
+            print 'Took', sampler.samples, 'samples of', len(sampler.threads),
+            print 'threads in', round(elapsed, 2), 'seconds.'
+
+            if options.file:
+                try:
+                    with open(options.file, 'w') as output_file:
+                        for collapsed in lines:
+                            output_file.write(collapsed + '\n')
+                except IOError as exception:
+                    print 'Could not write profile:', exception
+                    return
+                print 'Wrote', len(lines), 'stacks to', options.file
+                return
+
+            for collapsed in lines:
+                print collapsed
+
+    class cprofile_command(BaseCmd):
+        """A command for profiling threads with cProfile."""
+
+        name = 'cprofile'
+        description = 'Profiles threads with cProfile.'
+        usage = 'cprofile [args] start|stop|status|dump'
+
+        # Declare options
+        options = []
+        options.append(Opt('-d', '--duration',
+                           dest='duration',
+                           default='30s',
+                           action='store',
+                           type='string',
+                           help='start: Stop profiling after this long'))
+        options.append(Opt('-i', '--include',
+                           dest='include',
+                           default=None,
+                           action='append',
+                           type='string',
+                           help='start: Only profile threads with names '
+                                'matching this pattern'))
+        options.append(Opt('-x', '--exclude',
+                           dest='exclude',
+                           default=None,
+                           action='append',
+                           type='string',
+                           help='start: Don\'t profile threads with names '
+                                'matching this pattern (default: eww_*)'))
+        options.append(Opt('-r', '--running',
+                           dest='running',
+                           default=False,
+                           action='store_true',
+                           help='start: Also profile threads that are already '
+                                'running, by patching their thread states'))
+        options.append(Opt('-s', '--sort',
+                           dest='sort',
+                           default='cumulative',
+                           action='store',
+                           type='string',
+                           help='dump: pstats sort key'))
+        options.append(Opt('-n', '--limit',
+                           dest='limit',
+                           default=30,
+                           action='store',
+                           type='int',
+                           help='dump: Number of functions to show'))
+        options.append(Opt('-f', '--file',
+                           dest='file',
+                           default=False,
+                           action='store',
+                           type='string',
+                           help='dump: Write a binary .prof file instead'))
+
+        def __init__(self):
+            """Init."""
+            super(Command.cprofile_command, self).__init__()
+
+            self.parser = Parser()
+            self.parser.add_options(self.options)
+
+        def start(self, options):
+            """Starts a profile.
+
+            Args:
+                options (dict): Our parsed options.
+
+            Returns:
+                None
+            """
+
+            profiler = PROFILER_STATUS['profiler']
+            if profiler is not None and profiler.active():
+                print 'A profile is already running.  Stop it first.'
+                return
+
+            try:
+                duration = parse_interval(options['duration'])
+            except InvalidInterval as error_msg:
+                print error_msg
+                return
+
+            profiler = ThreadProfiler(include=options['include'],
+                                      exclude=options['exclude'],
+                                      duration=duration,
+                                      include_running=options['running'])
+            try:
+                profiler.start()
+            except ProfilerUnavailable as error_msg:
+                print error_msg
+                return
+            PROFILER_STATUS['profiler'] = profiler
+
+            if options['running']:
+                print 'Profiling', len(profiler.profiles), 'running threads,',
+                print 'and threads started in the next', duration, 'seconds.'
+            else:
+                print 'Profiling threads started in the next', duration,
+                print 'seconds.'
+
+        def stop(self):
+            """Stops the profile.
+
+            Returns:
+                None
+            """
+
+            profiler = PROFILER_STATUS['profiler']
+            if profiler is None:
+                print 'No profile has been started.'
+                return
+
+            profiler.stop()
+            print 'Profiling stopped.', len(profiler.profiles),
+            print 'threads were profiled.'
+
+        def status(self):
+            """Prints what's being profiled.
+
+            Returns:
+                None
+            """
+
+            profiler = PROFILER_STATUS['profiler']
+            if profiler is None:
+                print 'No profile has been started.'
+                return
+
+            if profiler.active():
+                remaining = profiler.deadline - time.time()
+                print 'Profiling for another', round(remaining, 1), 'seconds.'
+            else:
+                print 'Not profiling.'
+
+            for name, _ in profiler.profiles:
+                print ' ', name
+
+        def dump(self, options):
+            """Outputs the stats collected so far, stopping the profile first
+            if it's still running.
+
+            Args:
+                options (dict): Our parsed options.
+
+            Returns:
+                None
+            """
+
+            profiler = PROFILER_STATUS['profiler']
+            if profiler is None:
+                print 'No profile has been started.'
+                return
+
+            if profiler.running:
+                print 'Stopped profiling to dump the stats.'
+
+            stats = profiler.stats()
+            if stats is None:
+                print 'No threads have been profiled.'
+                return
+
+            if options['file']:
+                try:
+                    stats.dump_stats(options['file'])
+                except IOError as exception:
+                    print 'Could not write profile:', exception
+                    return
+                print 'Wrote stats for', len(profiler.profiles), 'threads to',
+                print options['file']
+                return
+
+            try:
+                stats.sort_stats(options['sort'])
+            except KeyError:
+                print 'Invalid sort key:', options['sort']
+                return
+            stats.print_stats(options['limit'])
+
+        def run(self, line):
+            """Starts, stops and outputs cProfile profiles.
+
+            Args:
+                line (str): A command line argument to be parsed.
+
+            Returns:
+                None
+            """
+
+            try:
+                options, remainder = self.parser.parse_args(shlex.split(line))
+            except ParserError as error_msg:
+                print error_msg
+                return
+
+            options = vars(options)
+            action = remainder[0] if remainder else None
+
+            if action == 'start':
+                self.start(options)
+            elif action == 'stop':
+                self.stop()
+            elif action == 'status':
+                self.status()
+            elif action == 'dump':
+                self.dump(options)
+            else:
+                help_cmd = Command.help_command()
+                help_cmd.display_command_detail('cprofile')
+
+    class threads_command(BaseCmd):
+        """A command for seeing what every thread is doing."""
+
+        name = 'threads'
+        description = 'Lists threads with their CPU time and stacks.'
+        usage = 'threads [args]'
+
+        # Declare options
+        options = []
+        options.append(Opt('-n', '--top',
+                           dest='top',
+                           default=None,
+                           action='store',
+                           type='int',
+                           help='Only show the TOP threads using the most CPU'))
+        options.append(Opt('-i', '--interval',
+                           dest='interval',
+                           default=None,
+                           action='store',
+                           type='string',
+                           help='Measure CPU used over this long, e.g. 1s'))
+        options.append(Opt('-b', '--brief',
+                           dest='brief',
+                           default=False,
+                           action='store_true',
+                           help='Don\'t show stacks'))
+
+        def __init__(self):
+            """Init."""
+            super(Command.threads_command, self).__init__()
+
+            self.parser = Parser()
+            self.parser.add_options(self.options)
+
+        def collect(self, interval=None):
+            """Collects thread info, and how much CPU each thread used over
+            ``interval`` seconds.
+
+            Args:
+                interval (float): Seconds to measure CPU use over.  If not
+                                  provided, we only report CPU used so far.
+
+            Returns:
+                list: (ThreadInfo, CPU seconds used during the interval)
+                      tuples.  The CPU used is None without an interval.
+            """
+
+            before = None
+            if interval:
+                before = task_cpu_times()
+                time.sleep(interval)
+
+            threads = []
+            for info in thread_info():
+                used = None
+                if before is not None and info.cpu is not None:
+                    used = info.cpu - before.get(info.native_id, 0)
+                threads.append((info, used))
+            return threads
+
+        def display_thread(self, info, used, interval, brief):
+            """Prints a thread.
+
+            Args:
+                info (ThreadInfo): The thread.
+                used (float): CPU seconds used during the interval, or None.
+                interval (float): The interval's length, or None.
+                brief (bool): Don't print the thread's stack.
+
+            Returns:
+                None
+            """
+
+            details = [info.name]
+            if info.ident is not None:
+                details.append('ident: ' + str(info.ident))
+            if info.native_id is not None:
+                details.append('tid: ' + str(info.native_id))
+            if info.daemon is not None:
+                details.append('daemon: ' + str(info.daemon))
+            if info.cpu is not None:
+                cpu = 'cpu: %.2fs' % info.cpu
+                if used is not None:
+                    cpu += ' (%.2fs, %.1f%%)' % (used, 100 * used / interval)
+                details.append(cpu)
+
+            print '  '.join(details)
+
+            # Our own stack would only show this command
+            if (brief or info.frame is None or
+                    info.ident == threading.current_thread().ident):
+                return
+
+            stack = ''.join(traceback.format_stack(info.frame))
+            print stack.rstrip('\n')
+            print ''
+
+        def run(self, line):
+            """Lists threads.
+
+            Args:
+                line (str): A command line argument to be parsed.
+
+            Returns:
+                None
+            """
+
+            try:
+                options, _ = self.parser.parse_args(shlex.split(line))
+                interval = None
+                if options.interval:
+                    interval = parse_interval(options.interval)
+            except (ParserError, InvalidInterval) as error_msg:
+                print error_msg
+                return
+
+            threads = self.collect(interval)
+
+            if options.top is not None:
+                if not [info for info, _ in threads if info.cpu is not None]:
+                    print 'CPU times aren\'t available on this platform.'
+                    return
+
+                def cpu_used(thread):
+                    """Sorts by CPU used in the interval, or in total."""
+                    info, used = thread
+                    if used is not None:
+                        return used
+                    return info.cpu if info.cpu is not None else -1
+
+                threads.sort(key=cpu_used, reverse=True)
+                threads = threads[:options.top]
+
+            for info, used in threads:
+                self.display_thread(info, used, interval, options.brief)
+
+    class memory_command(BaseCmd):
+        """A command for finding out where memory is going."""
+
+        name = 'memory'
+        description = 'Reports memory use, and takes and compares snapshots.'
+        usage = 'memory [args] [start|stop|snapshot|top|diff [old] [new]]'
+
+        # Declare options
+        options = []
+        options.append(Opt('-n', '--limit',
+                           dest='limit',
+                           default=10,
+                           action='store',
+                           type='int',
+                           help='top, diff: Number of entries to show'))
+        options.append(Opt('-F', '--frames',
+                           dest='frames',
+                           default=1,
+                           action='store',
+                           type='int',
+                           help='start: Traceback frames to record per '
+                                'allocation'))
+
+        def __init__(self):
+            """Init."""
+            super(Command.memory_command, self).__init__()
+
+            self.parser = Parser()
+            self.parser.add_options(self.options)
+
+            if MEMORY_STATUS['tracker'] is None:
+                MEMORY_STATUS['tracker'] = MemoryTracker()
+            self.tracker = MEMORY_STATUS['tracker']
+
+        def display_usage(self):
+            """Prints our memory use and how snapshots are taken.
+
+            Returns:
+                None
+            """
+
+            rss, vms = process_memory()
+            if rss is not None:
+                print 'RSS:', format_bytes(rss), ' VMS:', format_bytes(vms)
+            else:
+                print 'Memory use isn\'t available on this platform.'
+
+            if self.tracker.tracing():
+                print 'Snapshots: tracemalloc'
+            else:
+                print 'Snapshots: object census'
+
+            numbers = [str(number) for number, _, _ in self.tracker.snapshots]
+            if numbers:
+                print 'Kept snapshots:', ' '.join(numbers)
+
+        def display_top(self, limit):
+            """Prints the biggest allocation sites right now.
+
+            Args:
+                limit (int): How many to print.
+
+            Returns:
+                None
+            """
+
+            kind, snapshot = self.tracker.snapshot()
+            for site, size, count in top(kind, snapshot, limit):
+                print '%10s %10d  %s' % (format_bytes(size), count, site)
+
+        def display_diff(self, numbers, limit):
+            """Prints what changed between two kept snapshots.
+
+            Args:
+                numbers (list): The old and new snapshot numbers, as strings.
+                                Defaults to the two most recent snapshots.
+                limit (int): How many changes to print.
+
+            Returns:
+                None
+            """
+
+            if numbers:
+                try:
+                    numbers = [int(number) for number in numbers[:2]]
+                except ValueError:
+                    print 'Snapshots are numbered, e.g. diff 1 2'
+                    return
+                old, new = [self.tracker.get(number) for number in numbers]
+            elif len(self.tracker.snapshots) >= 2:
+                old, new = list(self.tracker.snapshots)[-2:]
+            else:
+                print 'Take at least two snapshots first.'
+                return
+
+            if old is None or new is None:
+                print 'No such snapshot.'
+                return
+            if old[1] != new[1]:
+                print 'Can\'t compare a census to a tracemalloc snapshot.'
+                return
+
+            print 'Changes from snapshot', old[0], 'to snapshot', new[0]
+            for site, size_diff, count_diff, _, _ in diff(old[1], old[2],
+                                                          new[2], limit):
+                print '%10s %+10d  %s' % (('+' if size_diff > 0 else '') +
+                                          format_bytes(size_diff),
+                                          count_diff, site)
+
+        def run(self, line):
+            """Reports memory use, and takes and compares snapshots.
+
+            Args:
+                line (str): A command line argument to be parsed.
+
+            Returns:
+                None
+            """
+
+            try:
+                options, remainder = self.parser.parse_args(shlex.split(line))
+            except ParserError as error_msg:
+                print error_msg
+                return
+
+            action = remainder[0] if remainder else None
+
+            if action is None:
+                self.display_usage()
+            elif action == 'start':
+                if self.tracker.start(options.frames):  # pragma: no cover
+                    print 'Tracing allocations with tracemalloc.'
+                else:
+                    print 'tracemalloc isn\'t available, snapshots will be',
+                    print 'an object census.'
+            elif action == 'stop':
+                self.tracker.stop()
+                print 'Stopped, and dropped all snapshots.'
+            elif action == 'snapshot':
+                print 'Took snapshot', str(self.tracker.keep()) + '.'
+            elif action == 'top':
+                self.display_top(options.limit)
+            elif action == 'diff':
+                self.display_diff(remainder[1:], options.limit)
+            else:
+                help_cmd = Command.help_command()
+                help_cmd.display_command_detail('memory')
+
+    class objects_command(BaseCmd):
+        """A command for counting objects by type, for leak hunting."""
+
+        name = 'objects'
+        description = 'Counts objects by type, and graphs the counts.'
+        usage = 'objects [args] [type_name ...]'
+
+        # Declare options
+        options = []
+        options.append(Opt('-n', '--limit',
+                           dest='limit',
+                           default=10,
+                           action='store',
+                           type='int',
+                           help='Number of types to show and graph'))
+        options.append(Opt('-c', '--chunk-size',
+                           dest='chunk_size',
+                           default=10000,
+                           action='store',
+                           type='int',
+                           help='Objects counted between GIL releases.  The '
+                                'list of objects is still built in one go, '
+                                'holding the GIL, before counting starts'))
+        options.append(Opt('-e', '--every',
+                           dest='every',
+                           default=None,
+                           action='store',
+                           type='string',
+                           help='Also count and graph in the background at '
+                                'this interval, e.g. 60s, or "off" to stop'))
+
+        def __init__(self):
+            """Init."""
+            super(Command.objects_command, self).__init__()
+
+            self.parser = Parser()
+            self.parser.add_options(self.options)
+
+            # Graph names are this followed by the type name
+            self.graph_prefix = 'objects.'
+
+        @staticmethod
+        def pick_names(counts, limit, extra):
+            """Picks the types to show and graph.
+
+            Args:
+                counts (dict): Counts keyed by type name.
+                limit (int): How many of the most common types to pick.
+                extra (list): Type names to pick as well.
+
+            Returns:
+                list: Type names, most common first, then ``extra``.
+            """
+
+            ranked = sorted(counts, key=lambda name: (-counts[name], name))
+            names = ranked[:limit]
+            names.extend(name for name in extra if name not in names)
+            return names
+
+        @staticmethod
+        def stop_background():
+            """Stops counting objects in the background.
+
+            Returns:
+                bool: False if we weren't.
+            """
+
+            counter = OBJECTS_STATUS['counter']
+            if counter is None:
+                return False
+            counter.stop()
+            counter.join(5)
+            OBJECTS_STATUS['counter'] = None
+            return True
+
+        def record(self, counts, names):
+            """Adds a datapoint of (the current time, count) to a graph for
+            each type, so ``stats -g`` can chart object counts over time.
+
+            Args:
+                counts (dict): Counts keyed by type name.
+                names (list): The type names to record.
+
+            Returns:
+                None
+            """
+
+            now = int(time.time())
+            for name in names:
+                graph(self.graph_prefix + name, (now, counts.get(name, 0)),
+                      sample_rate=1)
+
+        def run(self, line):
+            """Counts objects by type.
+
+            Args:
+                line (str): A command line argument to be parsed.
+
+            Returns:
+                None
+            """
+
+            try:
+                options, remainder = self.parser.parse_args(shlex.split(line))
+            except ParserError as error_msg:
+                print error_msg
+                return
+
+            chunk_size = max(options.chunk_size, 1)
+
+            interval = None
+            if options.every == 'off':
+                if self.stop_background():
+                    print 'Stopped counting objects in the background.'
+                else:
+                    print 'Objects aren\'t being counted in the background.'
+                return
+            elif options.every is not None:
+                try:
+                    interval = parse_interval(options.every)
+                except InvalidInterval as error_msg:
+                    print error_msg
+                    return
+
+            counts = count_objects(chunk_size)
+            names = self.pick_names(counts, options.limit, remainder)
+
+            print 'Counted', sum(counts.itervalues()), 'objects of',
+            print len(counts), 'types.'
+            for name in names:
+                print '%10d  %s' % (counts.get(name, 0), name)
+
+            self.record(counts, names)
+
+            if interval is None:
+                return
+
+            def record_latest(latest):
+                """Graphs a background count."""
+                self.record(latest,
+                            self.pick_names(latest, options.limit, remainder))
+
+            self.stop_background()
+            counter = ObjectCountThread(interval, record_latest, chunk_size)
+            counter.daemon = True
+            counter.name = 'eww_objects_thread'
+            counter.start()
+            OBJECTS_STATUS['counter'] = counter
+            print 'Counting objects every', interval, 'seconds.'
+
     class help_command(BaseCmd):
         """When called with no arguments, this presents a friendly help page.
         When called with an argument, it presents command specific help.
@@ -12,12 +12,14 @@
 # outside of ConsoleThread.
 # pylint: disable=no-self-use, no-member
 
+from collections import deque
 import logging
 import __main__ as main
 import os
 import socket
 import sys
 import threading
+import time
 
 from .command import Command
 
@@ -28,13 +30,31 @@ class ConsoleThread(threading.Thread):
     implements all the features needed to make a nifty debugger.
     """
 
-    def __init__(self, user_socket):
+    def __init__(self, user_socket, pool=None):
         """Sets up our socket and socket_file.
 
         Args:
             user_socket (Socket): A socket connected to a client.
+            pool (ConsolePool): If provided, the pool this thread belongs
+                                to.  When the user disconnects, we may be
+                                handed another connection from it.
         """
         super(ConsoleThread, self).__init__()
+        self.pool = pool
+        self.stop_requested = False
+        self.attach(user_socket)
+
+    def attach(self, user_socket):
+        """Sets up a new connection to serve.
+
+        Args:
+            user_socket (Socket): A socket connected to a client.
+
+        Returns:
+            None
+        """
+        if self.pool is not None and self.pool.idle_timeout:
+            user_socket.settimeout(self.pool.idle_timeout)
         self.user_socket = user_socket
         self.user_socket_file = user_socket.makefile()
 
@@ -64,6 +84,9 @@ class ConsoleThread(threading.Thread):
         Returns:
             None
         """
+        self.stop_requested = True
+        if self.pool is not None:
+            self.pool.wake()
         try:
             self.user_socket.shutdown(socket.SHUT_RDWR)
         except socket.error:
@@ -89,6 +112,26 @@ class ConsoleThread(threading.Thread):
         self.unregister_io()
 
     def run(self):
+        """Serves our connection, then any connections our pool hands us.
+
+        Returns:
+            None
+        """
+        while True:
+            self.serve()
+
+            if self.pool is None:
+                return
+
+            connection = self.pool.next_connection(self)
+            if connection is None:
+                return
+
+            user_socket, addr = connection
+            self.name = 'eww_console_' + str(addr)
+            self.attach(user_socket)
+
+    def serve(self):
         """Sets up our IO and starts a Console instance.
 
         Returns:
@@ -103,7 +146,112 @@ class ConsoleThread(threading.Thread):
             command.intro += 'Name: ' + main.__file__
             command.prompt = '(eww) '
             command.cmdloop()
+        except socket.timeout:
+            print 'Console was idle for too long.'
         except Exception as catchall:  # pylint: disable=broad-except
             LOGGER.debug('Console thread died: ' + str(catchall))
         finally:
             self.cleanup()
+
+class ConsolePool(object):
+    """Limits how many consoles can be open at once, and reuses console
+    threads.  A console thread whose user disconnects waits up to ``linger``
+    seconds for another connection before exiting, so bursts of connections
+    don't each start a new thread.
+    """
+
+    def __init__(self, max_consoles=10, idle_timeout=None, linger=0):
+        """Init.
+
+        Args:
+            max_consoles (int): The maximum number of consoles open at once.
+                                None means no limit.
+            idle_timeout (float): If provided, consoles are disconnected
+                                  after waiting this many seconds for input.
+            linger (float): How long, in seconds, a console thread waits for
+                            another connection after its user disconnects.
+        """
+        self.max_consoles = max_consoles
+        self.idle_timeout = idle_timeout
+        self.linger = linger
+        self.condition = threading.Condition()
+        self.busy = 0
+        self.idle = 0
+        self.pending = deque()
+
+    def submit(self, user_socket, addr):
+        """Starts a console for a new connection, on an idle thread if we
+        have one.
+
+        Args:
+            user_socket (Socket): A socket connected to a client.
+            addr: The client's address.
+
+        Returns:
+            bool: False if we're at ``max_consoles``, in which case the
+                  caller should turn the connection away.
+        """
+
+        with self.condition:
+            if self.max_consoles and self.busy >= self.max_consoles:
+                return False
+            self.busy += 1
+
+            if self.idle > len(self.pending):
+                self.pending.append((user_socket, addr))
+                self.condition.notify()
+                return True
+
+        console_thread = ConsoleThread(user_socket, pool=self)
+        console_thread.daemon = True
+        console_thread.name = 'eww_console_' + str(addr)
+        console_thread.start()
+        return True
+
+    def next_connection(self, console_thread):
+        """Called by a console thread when its user disconnects.  Waits up to
+        ``linger`` seconds for another connection.
+
+        Args:
+            console_thread (ConsoleThread): The calling thread.
+
+        Returns:
+            tuple: A (socket, address) tuple, or None if the thread should
+                   exit.
+        """
+
+        with self.condition:
+            self.busy -= 1
+            if not self.linger or console_thread.stop_requested:
+                return None
+
+            console_thread.name = 'eww_console_idle'
+            self.idle += 1
+            try:
+                deadline = time.time() + self.linger
+                while not self.pending and not console_thread.stop_requested:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+
+                if console_thread.stop_requested:
+                    return None
+                return self.pending.popleft()
+            finally:
+                self.idle -= 1
+                if not self.idle:
+                    # Nobody is left to serve these
+                    while self.pending:
+                        self.pending.popleft()[0].close()
+                        self.busy -= 1
+
+    def wake(self):
+        """Wakes up idle console threads, e.g. so they notice a stop request.
+
+        Returns:
+            None
+        """
+
+        with self.condition:
+            self.condition.notify_all()
@@ -7,36 +7,149 @@
     consoles for them.
 
 """
-# Pylint will warn on the select statement.  It's there for future expansion.
-# pylint: disable=unused-variable
-
+import errno
 import logging
-import select
+import os
 import socket
 
-from .console import ConsoleThread
-from .stoppable_thread import StoppableThread
+from .cloexec import set_cloexec
+from .console import ConsolePool
+from .eventconsole import EventConsoleThread
+from .stoppable_thread import WakeableThread
 
 LOGGER = logging.getLogger(__name__)
 
-class DispatchThread(StoppableThread):
-    """``DispatchThread`` runs the connection listener thread. As a
-    StoppableThread subclass, this thread *must* check for the .stop_requested
-    flag.
+def remove_stale_socket(path):
+    """Removes a unix socket left behind by a process that's gone.  A
+    socket something is still listening on is left alone, so we can't steal
+    another process's socket.
+
+    Args:
+        path (str): The socket path.
+
+    Returns:
+        None
+
+    Raises:
+        socket.error: If something is listening on ``path``.
     """
 
-    def __init__(self, host, port, timeout=1):
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as exception:
+        if exception.errno != errno.ECONNREFUSED:
+            raise
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+
+    raise socket.error(errno.EADDRINUSE, 'Socket is in use: ' + path)
+
+class DispatchThread(WakeableThread):
+    """``DispatchThread`` runs the connection listener thread.  It blocks
+    until a connection arrives or it's stopped, so an idle Eww costs no
+    wakeups.  As a StoppableThread subclass, this thread *must* check for the
+    .stop_requested flag.
+    """
+
+    def __init__(self, host, port, timeout=1, unix_socket=None,
+                 max_consoles=10, backlog=5, idle_timeout=None, linger=0,
+                 console_engine='thread', console_workers=2):
         """Init.
 
            Args:
                host (str): The interface to listen for connections on.
                port (int): The port to listen for connections on.
-               timeout (float): Frequency, in seconds, to check for a stop or
-                                remove request.
+               timeout (float): Unused.  We're woken up when stopped.
+               unix_socket (str): If provided, listen on a unix domain socket
+                                  at this path instead of ``host`` and
+                                  ``port``.  ``%(pid)s`` is replaced with our
+                                  PID.
+               max_consoles (int): The maximum number of consoles open at
+                                   once.  Further connections are turned
+                                   away.  None means no limit.
+               backlog (int): The listen backlog.
+               idle_timeout (float): If provided, consoles are disconnected
+                                     after waiting this many seconds for
+                                     input.
+               linger (float): How long, in seconds, a console thread waits
+                               for another connection after its user
+                               disconnects.
+               console_engine (str): 'thread' runs each console on its own
+                                     thread.  'event' waits on every console
+                                     from one thread, and runs commands on
+                                     ``console_workers`` threads.
+               console_workers (int): The number of threads that run
+                                      commands for the 'event' engine.
         """
         super(DispatchThread, self).__init__()
         self.server_address = (host, port)
         self.timeout = timeout
+        self.backlog = backlog
+        self.console_engine = console_engine
+        if console_engine == 'event':
+            self.pool = EventConsoleThread(max_consoles=max_consoles,
+                                           idle_timeout=idle_timeout,
+                                           workers=console_workers)
+            self.pool.daemon = True
+            self.pool.name = 'eww_console_loop'
+        else:
+            self.pool = ConsolePool(max_consoles=max_consoles,
+                                    idle_timeout=idle_timeout,
+                                    linger=linger)
+        self.unix_socket = None
+        if unix_socket is not None:
+            self.unix_socket = unix_socket % {'pid': os.getpid()}
+
+    def create_socket(self):
+        """Creates and binds the listening socket.
+
+           Returns:
+               socket: The bound socket.
+
+           Raises:
+               socket.error: If we couldn't bind.
+        """
+
+        if self.unix_socket is None:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            set_cloexec(server_socket)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(self.server_address)
+            return server_socket
+
+        remove_stale_socket(self.unix_socket)
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        set_cloexec(server_socket)
+        server_socket.bind(self.unix_socket)
+        # The console runs arbitrary code, so only our user may connect.
+        os.chmod(self.unix_socket, 0600)
+        return server_socket
+
+    def reject(self, user_socket):
+        """Turns a connection away because too many consoles are open.
+
+           Args:
+               user_socket (socket): The rejected connection.
+
+           Returns:
+               None
+        """
+
+        LOGGER.warning('Rejected a console connection, ' +
+                       str(self.pool.max_consoles) + ' consoles are open')
+        try:
+            user_socket.sendall('Too many Eww consoles are open (the limit '
+                                'is ' + str(self.pool.max_consoles) + ').  '
+                                'Try again later.\n')
+        except socket.error:  # pragma: no cover
+            pass
+        user_socket.close()
 
     def run(self):
         """Main thread loop.
@@ -45,35 +158,35 @@ class DispatchThread(StoppableThread):
                None
         """
 
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            server_socket.bind(self.server_address)
-        except socket.error as exception:
+            server_socket = self.create_socket()
+        except (socket.error, OSError) as exception:
             LOGGER.error('Dispatch thread could not bind: ' + str(exception))
+            self.close_wakeup()
+            if self.console_engine == 'event':
+                # It never starts, so it won't close its own wakeup pipe
+                self.pool.close_wakeup()
             return
-        server_socket.listen(5)
-        LOGGER.info('Dispatch thread bound and listening')
+        server_socket.listen(self.backlog)
+        LOGGER.info('Dispatch thread bound and listening on ' +
+                    str(server_socket.getsockname()))
 
-        inputs = [server_socket]
+        if self.console_engine == 'event':
+            self.pool.start()
+
+        poller = self.make_poller(server_socket)
 
         while True:
-            # We don't strictly need select here, but it makes timeout
-            # checking easier.  It also makes it easier to add PTY/TTY
-            # down the line.
-            readable, writable, errored = select.select(inputs,
-                                                        [],
-                                                        inputs,
-                                                        self.timeout)
-
-            for sock in readable:
-                if sock is server_socket:
-                    user_socket, addr = sock.accept()  # pragma: no cover
-
-                    user_thread = ConsoleThread(user_socket)
-                    user_thread.daemon = True
-                    user_thread.name = 'eww_console_' + str(addr)
-                    user_thread.start()
+            # No timeout, stop() wakes us up through wakeup_fd.
+            readable = self.wait_readable(poller)
+
+            if (server_socket.fileno() in readable and
+                    not self.stop_requested):
+                user_socket, addr = server_socket.accept()  # pragma: no cover
+                set_cloexec(user_socket)
+
+                if not self.pool.submit(user_socket, addr):
+                    self.reject(user_socket)
 
             if self.stop_requested:
                 try:
@@ -83,4 +196,10 @@ class DispatchThread(StoppableThread):
                     # just pass.
                     pass
                 server_socket.close()
+                self.close_wakeup()
+                if self.unix_socket is not None:
+                    try:
+                        os.unlink(self.unix_socket)
+                    except OSError:  # pragma: no cover
+                        pass
                 return
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.eventconsole
+    ~~~~~~~~~~~~~~~~
+
+    An alternative to one ``ConsoleThread`` per user.  A single thread waits
+    on every console connection, and complete lines are handed to a small
+    pool of worker threads to run.  Idle consoles cost a socket, not a
+    thread.
+
+    Commands still run on a worker thread with the connection registered on
+    our ``IOProxy`` objects, exactly as they would in a ``ConsoleThread``.
+    While a command runs, its worker owns the connection, so interactive
+    commands like ``repl`` keep a worker busy until they finish.  If every
+    worker is busy, the pool starts another, so long running commands can't
+    hold up other consoles.  Workers beyond the pool's size exit once
+    there's nothing to do.
+
+"""
+
+from collections import deque
+import logging
+import __main__ as main
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from .command import Command
+from .stoppable_thread import StoppableThread, WakeableThread
+
+LOGGER = logging.getLogger(__name__)
+
+class ConsoleConnection(object):
+    """The state of one console connection."""
+
+    def __init__(self, user_socket, addr):
+        """Init.
+
+        Args:
+            user_socket (Socket): A socket connected to a client.
+            addr: The client's address.
+        """
+        self.user_socket = user_socket
+        self.user_socket_file = user_socket.makefile('w')
+        # Unbuffered, so a command reading its own input never reads past
+        # it.  Anything after is left on the socket for the event loop.
+        self.input_file = user_socket.makefile('r', 0)
+        self.addr = addr
+        self.command = Command()
+        self.command.prompt = '(eww) '
+        self.buffer = ''
+        self.busy = False
+        self.closing = False
+        self.last_active = time.time()
+
+    def fileno(self):
+        """Lets us be registered with a poller."""
+        return self.user_socket.fileno()
+
+    def close(self):
+        """Closes the connection.
+
+        Returns:
+            None
+        """
+        for socket_file in (self.input_file, self.user_socket_file):
+            try:
+                socket_file.close()
+            except (IOError, socket.error):
+                pass
+        self.user_socket.close()
+
+class ConsoleExecutor(object):
+    """A pool of ``ConsoleWorker`` threads that run jobs in order.  Jobs
+    never wait for a busy worker: if none are idle, another worker is
+    started.  Workers beyond ``workers`` exit when there are no jobs left.
+    """
+
+    def __init__(self, workers=2):
+        """Init.
+
+        Args:
+            workers (int): The number of worker threads kept waiting for
+                           jobs.
+        """
+        self.workers = workers
+        self.jobs = deque()
+        self.condition = threading.Condition()
+        # All protected by condition.  Idle workers aren't running a job.
+        self.threads = []
+        self.idle = 0
+        self.started = 0
+        self.stopped = False
+
+    def start(self):
+        """Starts the worker threads.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            for _ in range(self.workers):
+                self.add_worker()
+
+    def add_worker(self):
+        """Starts a worker.  The caller must hold ``condition``.
+
+        Returns:
+            None
+        """
+        worker = ConsoleWorker(self)
+        worker.daemon = True
+        worker.name = 'eww_console_worker_' + str(self.started)
+        self.started += 1
+        self.threads.append(worker)
+        self.idle += 1
+        worker.start()
+
+    def submit(self, job):
+        """Queues a job, starting a worker for it if they're all busy.
+
+        Args:
+            job (callable): Called with no arguments on a worker thread.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            if self.stopped:
+                return
+            self.jobs.append(job)
+            # Idle workers each take one queued job
+            if len(self.jobs) > self.idle:
+                self.add_worker()
+            else:
+                self.condition.notify()
+
+    def next_job(self, worker):
+        """Waits for a job.
+
+        Args:
+            worker (ConsoleWorker): The calling worker.
+
+        Returns:
+            callable: The job, or None if the worker should exit.
+        """
+        with self.condition:
+            while not worker.stop_requested:
+                if self.jobs:
+                    self.idle -= 1
+                    return self.jobs.popleft()
+                if len(self.threads) > self.workers:
+                    break
+                self.condition.wait()
+            self.idle -= 1
+            self.threads.remove(worker)
+            return None
+
+    def job_done(self):
+        """Called by a worker when it finishes a job.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.idle += 1
+
+    def wake(self):
+        """Wakes every worker, e.g. so they notice a stop request.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def stop(self):
+        """Stops every worker.  Busy workers exit when their job finishes.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.stopped = True
+            for worker in self.threads:
+                worker.stop_requested = True
+            self.condition.notify_all()
+
+class ConsoleWorker(StoppableThread):
+    """Runs jobs from a ``ConsoleExecutor``."""
+
+    def __init__(self, executor):
+        """Init.
+
+        Args:
+            executor (ConsoleExecutor): Where we get jobs from.
+        """
+        super(ConsoleWorker, self).__init__()
+        self.executor = executor
+
+    def stop(self):
+        """Sets the stop_requested flag and wakes the worker up."""
+        super(ConsoleWorker, self).stop()
+        self.executor.wake()
+
+    def run(self):
+        """Main thread loop."""
+        while True:
+            job = self.executor.next_job(self)
+            if job is None:
+                return
+            try:
+                job()
+            finally:
+                self.executor.job_done()
+
+class EventConsoleThread(WakeableThread):
+    """Waits on every console connection from one thread.  Used by
+    ``DispatchThread`` in place of a ``ConsolePool``.
+    """
+
+    def __init__(self, max_consoles=10, idle_timeout=None, workers=2):
+        """Init.
+
+        Args:
+            max_consoles (int): The maximum number of consoles open at once.
+                                None means no limit.
+            idle_timeout (float): If provided, consoles are disconnected
+                                  after waiting this many seconds for input.
+            workers (int): The number of threads kept waiting to run
+                           commands.  More are started while every one is
+                           busy.
+        """
+        super(EventConsoleThread, self).__init__()
+        self.max_consoles = max_consoles
+        self.idle_timeout = idle_timeout
+        self.executor = ConsoleExecutor(workers)
+        # Only touched by this thread
+        self.connections = []
+        self.poller = None
+        self.by_fd = {}
+        # Handed to us by other threads
+        self.incoming = deque()
+        self.finished = deque()
+        self.count_lock = threading.Lock()
+        self.count = 0
+
+    def submit(self, user_socket, addr):
+        """Takes a new connection.  Called by the dispatch thread.
+
+        Args:
+            user_socket (Socket): A socket connected to a client.
+            addr: The client's address.
+
+        Returns:
+            bool: False if we're at ``max_consoles``, in which case the
+                  caller should turn the connection away.
+        """
+
+        with self.count_lock:
+            if self.max_consoles and self.count >= self.max_consoles:
+                return False
+            self.count += 1
+
+        self.incoming.append((user_socket, addr))
+        self.wake()
+        return True
+
+    def run_job(self, connection, line=None):
+        """Runs on a worker thread.  Runs ``line`` in the connection's console,
+        or prints the intro if ``line`` is None, then prints the prompt.
+
+        Args:
+            connection (ConsoleConnection): The connection.
+            line (str): The line the user entered.
+
+        Returns:
+            None
+        """
+
+        command = connection.command
+        stop = False
+
+        sys.stdin.register(connection.input_file)
+        sys.stdout.register(connection.user_socket_file)
+        sys.stderr.register(connection.user_socket_file)
+        try:
+            if line is None:
+                print command.intro
+            else:
+                line = command.precmd(line)
+                stop = command.onecmd(line)
+                stop = command.postcmd(stop, line)
+
+            if stop:
+                print 'Disconnecting...'
+            else:
+                sys.stdout.write(command.prompt)
+            sys.stdout.flush()
+        except Exception as catchall:  # pylint: disable=broad-except
+            LOGGER.debug('Console command died: ' + str(catchall))
+            stop = True
+        finally:
+            sys.stdin.unregister()
+            sys.stdout.unregister()
+            sys.stderr.unregister()
+
+        connection.closing = connection.closing or bool(stop)
+        self.finished.append(connection)
+        self.wake()
+
+    def accept_incoming(self):
+        """Sets up connections handed to us by ``submit``.
+
+        Returns:
+            None
+        """
+
+        while self.incoming:
+            user_socket, addr = self.incoming.popleft()
+            try:
+                connection = ConsoleConnection(user_socket, addr)
+                command = connection.command
+                command.intro = 'Welcome to the Eww console. Type \'help\' at '
+                command.intro += 'any point for a list of available commands.\n'
+                command.intro += 'Running in PID: ' + str(os.getpid()) + ' '
+                command.intro += 'Name: ' + main.__file__
+            except Exception as catchall:  # pylint: disable=broad-except
+                # Same as a ConsoleThread dying before its cmdloop starts
+                LOGGER.debug('Console died: ' + str(catchall))
+                try:
+                    user_socket.sendall('Disconnecting...\n')
+                except socket.error:  # pragma: no cover
+                    pass
+                user_socket.close()
+                with self.count_lock:
+                    self.count -= 1
+                continue
+            self.connections.append(connection)
+            self.by_fd[connection.fileno()] = connection
+            self.poller.register(connection.fileno(), select.POLLIN)
+            self.dispatch(connection, None)
+
+    def dispatch(self, connection, line):
+        """Hands a line to the executor.
+
+        Args:
+            connection (ConsoleConnection): The connection.
+            line (str): The line, or None to print the intro.
+
+        Returns:
+            None
+        """
+
+        # Busy connections belong to a worker until they're finished
+        if not connection.busy:
+            self.poller.unregister(connection.fileno())
+        connection.busy = True
+        self.executor.submit(lambda: self.run_job(connection, line))
+
+    def finish(self, connection):
+        """Takes a connection back from a worker, and runs the next line
+        the user sent while it was busy, if there is one.
+
+        Args:
+            connection (ConsoleConnection): The connection.
+
+        Returns:
+            None
+        """
+
+        if connection.closing:
+            self.close(connection)
+            return
+
+        connection.busy = False
+        connection.last_active = time.time()
+        self.poller.register(connection.fileno(), select.POLLIN)
+        self.process(connection)
+
+    def close(self, connection):
+        """Closes and forgets a connection.
+
+        Returns:
+            None
+        """
+
+        if not connection.busy:
+            self.poller.unregister(connection.fileno())
+        del self.by_fd[connection.fileno()]
+        connection.close()
+        self.connections.remove(connection)
+        with self.count_lock:
+            self.count -= 1
+
+    def read(self, connection):
+        """Reads what's available on a connection.
+
+        Args:
+            connection (ConsoleConnection): A readable connection.
+
+        Returns:
+            None
+        """
+
+        try:
+            data = connection.user_socket.recv(4096)
+        except socket.error:
+            data = ''
+
+        if not data:
+            self.close(connection)
+            return
+
+        connection.buffer += data
+        connection.last_active = time.time()
+
+    def process(self, connection):
+        """Runs the next complete line a connection has sent, if it isn't
+        already running something.
+
+        Returns:
+            None
+        """
+
+        if connection.busy or '\n' not in connection.buffer:
+            return
+
+        line, connection.buffer = connection.buffer.split('\n', 1)
+        self.dispatch(connection, line.rstrip('\r'))
+
+    def reap_idle(self, now):
+        """Disconnects consoles that have been idle for too long.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            float: Seconds until the next console could become idle, or None
+                   if there's no idle timeout.
+        """
+
+        if not self.idle_timeout:
+            return None
+
+        wait = self.idle_timeout
+        for connection in list(self.connections):
+            if connection.busy:
+                continue
+            remaining = connection.last_active + self.idle_timeout - now
+            if remaining <= 0:
+                try:
+                    connection.user_socket.sendall(
+                        'Console was idle for too long.\nDisconnecting...\n')
+                except socket.error:  # pragma: no cover
+                    pass
+                self.close(connection)
+            else:
+                wait = min(wait, remaining)
+        return wait
+
+    def shutdown(self):
+        """Closes every connection and stops the workers.
+
+        Returns:
+            None
+        """
+
+        for connection in list(self.connections):
+            try:
+                connection.user_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            if not connection.busy:
+                self.close(connection)
+        while self.incoming:
+            self.incoming.popleft()[0].close()
+        self.executor.stop()
+        self.close_wakeup()
+
+    def run(self):
+        """Main thread loop.
+
+        Returns:
+            None
+        """
+
+        self.executor.start()
+        self.poller = self.make_poller()
+
+        while True:
+            self.accept_incoming()
+
+            while self.finished:
+                self.finish(self.finished.popleft())
+
+            if self.stop_requested:
+                self.shutdown()
+                return
+
+            timeout = self.reap_idle(time.time())
+            readable = self.wait_readable(self.poller, timeout)
+
+            for fd in readable:
+                if fd == self.wakeup_fd:
+                    os.read(self.wakeup_fd, 4096)
+                    continue
+                connection = self.by_fd.get(fd)
+                if connection is None or connection.busy:
+                    # Closed or handed to a worker since we polled
+                    continue
+                self.read(connection)
+                if connection in self.connections:
+                    self.process(connection)
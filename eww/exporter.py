@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.exporter
+    ~~~~~~~~~~~~
+
+    An optional HTTP listener that serves stats in the Prometheus text
+    exposition format, so monitoring doesn't need to drive the console.
+
+"""
+
+import logging
+import re
+import socket
+
+from .cloexec import set_cloexec
+from .stats import snapshot
+from .stoppable_thread import WakeableThread
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+MAX_REQUEST_SIZE = 8192
+
+# The series each kind of stat is rendered as, as suffixes of its metric name
+SERIES_SUFFIXES = {'counter': ('',),
+                   'graph': ('', '_datapoints'),
+                   'histogram': ('', '_sum', '_count'),
+                   'gauge': ('',)}
+
+def metric_name(name):
+    """Turns a stat name into a valid Prometheus metric name.
+
+    Args:
+        name (str): The stat name.
+
+    Returns:
+        str: The name with an ``eww_`` prefix and any characters Prometheus
+             doesn't allow replaced with underscores.
+    """
+
+    return 'eww_' + re.sub('[^a-zA-Z0-9_:]', '_', name)
+
+def format_value(value):
+    """Formats a sample value.
+
+    Args:
+        value (int or float): The value.
+
+    Returns:
+        str: The value as Prometheus expects it.
+    """
+
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+def render_counter(name, value):
+    """Renders a counter.  Eww counters can be decremented or put, so they
+    aren't monotonic and are exported as untyped rather than as counters.
+
+    Args:
+        name (str): The metric name.
+        value (int): The counter's value.
+
+    Returns:
+        str: The rendered metric.
+    """
+
+    lines = ['# TYPE ' + name + ' untyped',
+             name + ' ' + format_value(value)]
+    return '\n'.join(lines) + '\n'
+
+def render_graph(name, summary):
+    """Renders a graph as a gauge of its most recent Y value, along with the
+    number of datapoints held.
+
+    Args:
+        name (str): The metric name.
+        summary (GraphSummary): The graph's summary from a snapshot.
+
+    Returns:
+        str: The rendered metric, or an empty string for an empty graph.
+    """
+
+    if not summary.length:
+        return ''
+
+    lines = ['# TYPE ' + name + ' gauge',
+             name + ' ' + format_value(summary.last[1]),
+             '# TYPE ' + name + '_datapoints gauge',
+             name + '_datapoints ' + str(summary.length)]
+    return '\n'.join(lines) + '\n'
+
+def render_histogram(name, histogram):
+    """Renders a histogram as a summary.
+
+    Args:
+        name (str): The metric name.
+        histogram (Histogram): The histogram.
+
+    Returns:
+        str: The rendered metric.
+    """
+
+    lines = ['# TYPE ' + name + ' summary']
+    if histogram.count:
+        for quantile in QUANTILES:
+            value = histogram.quantile(quantile)
+            lines.append('%s{quantile="%s"} %s' % (name, quantile,
+                                                   format_value(value)))
+    lines.append(name + '_sum ' + format_value(histogram.total))
+    lines.append(name + '_count ' + str(histogram.count))
+    return '\n'.join(lines) + '\n'
+
+def render_gauge(name, value):
+    """Renders a gauge.
+
+    Args:
+        name (str): The metric name.
+        value: The value read from the gauge.
+
+    Returns:
+        str: The rendered metric, or an empty string if the gauge couldn't be
+             read or isn't a number.
+    """
+
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+        return ''
+
+    lines = ['# TYPE ' + name + ' gauge',
+             name + ' ' + format_value(value)]
+    return '\n'.join(lines) + '\n'
+
+class ExporterThread(WakeableThread):
+    """``ExporterThread`` serves ``GET /metrics`` over HTTP.  Requests are
+    handled one at a time on this thread, so a scrape costs the application
+    one snapshot and nothing else.  As a StoppableThread subclass, this thread
+    *must* check for the .stop_requested flag.
+    """
+
+    def __init__(self, host, port, timeout=1):
+        """Init.
+
+           Args:
+               host (str): The interface to listen for connections on.
+               port (int): The port to listen for connections on.
+               timeout (float): The longest we'll wait on a slow client.
+        """
+        super(ExporterThread, self).__init__()
+        self.server_address = (host, port)
+        self.timeout = timeout
+        # (kind, name) -> (version, rendered text)
+        self.render_cache = {}
+        # (kind, name) of stats we've warned about a metric name collision
+        self.collisions = set()
+
+    def metric_names(self, stats):
+        """Works out every stat's metric name.  Different stat names can
+        sanitize to the same metric name (e.g. ``a.b`` and ``a_b``), or to
+        one of the series of another stat (e.g. a counter ``a_count`` and a
+        histogram ``a``).  The first stat in render order keeps the name, and
+        the others aren't exported, with a warning the first time.
+
+        Args:
+            stats (Snapshot): The snapshot being rendered.
+
+        Returns:
+            list: (kind, stat name, metric name) tuples, in render order.
+        """
+
+        taken = set(['eww_dropped_stats'])
+        names = []
+
+        for kind, store in (('counter', stats.counters),
+                            ('graph', stats.graphs),
+                            ('histogram', stats.histograms),
+                            ('gauge', stats.gauges)):
+            for name in sorted(store):
+                metric = metric_name(name)
+                series = [metric + suffix for suffix in SERIES_SUFFIXES[kind]]
+
+                if taken.intersection(series):
+                    if (kind, name) not in self.collisions:
+                        self.collisions.add((kind, name))
+                        LOGGER.warning('Not exporting ' + kind + ' ' + name +
+                                       ', since its metric name ' + metric +
+                                       ' collides with another stat.')
+                    continue
+
+                taken.update(series)
+                names.append((kind, name, metric))
+
+        return names
+
+    def cached(self, kind, name, obj):
+        """Finds the previous rendering of a graph or histogram.
+
+        Args:
+            kind (str): 'graph' or 'histogram'.
+            name (str): The stat name.
+            obj: The snapshot's summary or copy of the stat.
+
+        Returns:
+            str: The previous rendering, or None if there isn't one or the
+                 stat's version has changed since.
+        """
+
+        version = getattr(obj, 'version', None)
+        cached = self.render_cache.get((kind, name))
+        if (cached is not None and version is not None and
+                cached[0] == version):
+            return cached[1]
+        return None
+
+    def render_cached(self, kind, name, metric, obj, renderer):
+        """Renders a graph or histogram, reusing the previous rendering if the
+        stat's version hasn't changed.
+
+        Args:
+            kind (str): 'graph' or 'histogram'.
+            name (str): The stat name.
+            metric (str): The metric name.
+            obj: The snapshot's summary or copy of the stat.
+            renderer (callable): Renders the stat if the cache is stale.
+
+        Returns:
+            str: The rendered metric.
+        """
+
+        text = self.cached(kind, name, obj)
+        if text is not None:
+            return text
+
+        version = getattr(obj, 'version', None)
+        text = renderer(metric, obj)
+        self.render_cache[(kind, name)] = (version, text)
+        return text
+
+    def render(self):
+        """Renders every stat.
+
+        Returns:
+            str: The full exposition.
+        """
+
+        stats = snapshot(rates=False)
+        names = self.metric_names(stats)
+        output = []
+
+        # Histograms are only summarized, so copy the ones that have changed
+        # since we last rendered them.
+        stale = [name for kind, name, _ in names
+                 if kind == 'histogram' and
+                 self.cached(kind, name, stats.histograms[name]) is None]
+        distributions = {}
+        if stale:
+            distributions = snapshot(False, False, False, False,
+                                     distributions=stale).distributions
+
+        for kind, name, metric in names:
+            if kind == 'counter':
+                output.append(render_counter(metric, stats.counters[name]))
+            elif kind == 'graph':
+                output.append(self.render_cached(kind, name, metric,
+                                                 stats.graphs[name],
+                                                 render_graph))
+            elif kind == 'histogram':
+                if name in distributions:
+                    output.append(self.render_cached(kind, name, metric,
+                                                     distributions[name],
+                                                     render_histogram))
+                elif name not in stale:
+                    output.append(self.cached(kind, name,
+                                              stats.histograms[name]))
+            else:
+                output.append(render_gauge(metric, stats.gauges[name]))
+
+        # Forget anything that's been removed from the stores
+        for kind, name in self.render_cache.keys():
+            store = stats.graphs if kind == 'graph' else stats.histograms
+            if name not in store:
+                del self.render_cache[(kind, name)]
+
+        output.append(render_counter('eww_dropped_stats', stats.dropped))
+
+        return ''.join(output)
+
+    def handle(self, user_socket):
+        """Reads a single request and responds to it.
+
+        Args:
+            user_socket (socket): The client's socket.
+
+        Returns:
+            None
+        """
+
+        user_socket.settimeout(self.timeout)
+
+        request = ''
+        while '\r\n\r\n' not in request and '\n\n' not in request:
+            data = user_socket.recv(1024)
+            if not data:
+                break
+            request += data
+            if len(request) > MAX_REQUEST_SIZE:
+                break
+
+        request_line = request.split('\n', 1)[0].split()
+
+        if len(request_line) < 2:
+            status, body = '400 Bad Request', 'Bad request.\n'
+        elif request_line[0] != 'GET':
+            status, body = '405 Method Not Allowed', 'Use GET.\n'
+        elif request_line[1].split('?', 1)[0] != '/metrics':
+            status, body = '404 Not Found', 'Try /metrics.\n'
+        else:
+            status, body = '200 OK', self.render()
+
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        headers = ['HTTP/1.0 ' + status,
+                   'Content-Type: ' + CONTENT_TYPE,
+                   'Content-Length: ' + str(len(body)),
+                   'Connection: close']
+        user_socket.sendall('\r\n'.join(headers) + '\r\n\r\n' + body)
+
+    def run(self):
+        """Main thread loop.
+
+           Returns:
+               None
+        """
+
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_cloexec(server_socket)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            server_socket.bind(self.server_address)
+        except socket.error as exception:
+            LOGGER.error('Exporter thread could not bind: ' + str(exception))
+            self.close_wakeup()
+            return
+        server_socket.listen(5)
+        LOGGER.info('Exporter thread bound and listening on ' +
+                    str(server_socket.getsockname()))
+
+        poller = self.make_poller(server_socket)
+
+        while True:
+            # No timeout, stop() wakes us up through wakeup_fd.
+            readable = self.wait_readable(poller)
+
+            if (server_socket.fileno() in readable and
+                    not self.stop_requested):
+                user_socket, _ = server_socket.accept()
+                set_cloexec(user_socket)
+                try:
+                    self.handle(user_socket)
+                except socket.error as exception:
+                    LOGGER.debug('Exporter request failed: ' + str(exception))
+                finally:
+                    user_socket.close()
+
+            if self.stop_requested:
+                server_socket.close()
+                self.close_wakeup()
+                return
@@ -7,17 +7,24 @@
 
 """
 
+import os
 import sys
 import logging
 import threading
 import __builtin__
 
 from .dispatch import DispatchThread
+from .exporter import ExporterThread
 from .ioproxy import IOProxy
 from .quitterproxy import QuitterProxy
-from .shared import (DISPATCH_THREAD_NAME, EMBEDDED, IMPLANT_LOCK, REMOVAL,
-                     STATS_THREAD_NAME)
-from .stats import StatsThread
+from .shared import (ACCUMULATORS, COUNTER_STORE, DISPATCH_THREAD_NAME,
+                     EMBED_CONFIG, EMBEDDED, EXPORTER_THREAD_NAME, FORK_STATUS,
+                     GRAPH_STORE, HISTOGRAM_STORE, IMPLANT_LOCK,
+                     MEMORY_STATUS, OBJECTS_STATUS, PROFILER_STATUS,
+                     RATE_STORE, REMOVAL, STATS_CONFIG, STATS_QUEUE,
+                     STATS_STATUS, STATS_THREAD_NAME, STORE_LOCK)
+from .stats import LOCAL_STATS, StatsThread
+from .statsfile import StatsFile
 
 LOGGER = logging.getLogger(__name__)
 
@@ -27,21 +34,98 @@ class WildlyInsecureFlagNotSet(Exception):
        :py:mod:`~eww.implant.embed` call.
        """
 
+class InvalidConsoleEngine(Exception):
+    """Raised when :py:mod:`~eww.implant.embed` is passed an unknown
+       ``console_engine``.
+       """
+
+class InvalidStatsBatchSize(Exception):
+    """Raised when :py:mod:`~eww.implant.embed` is passed a
+       ``stats_batch_size`` less than 1.
+       """
+
 def embed(host='localhost', port=10000, timeout=1, max_datapoints=500,
-          wildly_insecure=False):
+          wildly_insecure=False, accumulate_counters=False,
+          stats_batch_size=500, stats_batch_delay=0, sample_rate=1,
+          metrics_port=None, stats_file=None, unix_socket=None,
+          max_consoles=10, console_backlog=5, console_idle_timeout=None,
+          console_linger=0, console_engine='thread', console_workers=2):
     """The main entry point for eww.  It creates the threads we need.
 
+    If the process forks afterwards, the child's threads, including its
+    console, aren't started until the child records a stat or calls embed.
+    A child that only wants a console has to call embed itself after
+    forking; any arguments are ignored, and the parent's are reused.
+
     Args:
         host (str): The interface to listen for connections on.
         port (int): The port to listen for connections on.
-        timeout (float): Frequency, in seconds, to check for a stop or
-                         remove request.
+        timeout (float): Frequency, in seconds, to harvest per-thread
+                         counters (see ``accumulate_counters``), and how
+                         long the metrics exporter waits on a slow client.
+                         Eww's threads are woken up to stop, so this doesn't
+                         affect how long ``remove`` takes.
         max_datapoints (int): The maximum number of graph datapoints to
                               record.  If this limit is hit, datapoints
                               will be discarded based on age, oldest-first.
         wildly_insecure (bool): This must be set to True in order to set
                                 the ``host`` argument to anything besides
                                 ``localhost`` or ``127.0.0.1``.
+        accumulate_counters (bool): If True, counter calls are recorded in a
+                                    per-thread accumulator that the stats
+                                    thread harvests every ``timeout``
+                                    seconds, rather than being sent through
+                                    the stats queue.  This avoids taking a
+                                    lock on every counter call.
+        stats_batch_size (int): The maximum number of stats the stats
+                                thread processes in one pass.
+        stats_batch_delay (float): How long, in seconds, the stats thread
+                                   waits after a stat arrives before
+                                   draining the stats queue.  Larger values
+                                   mean larger batches, but stats take
+                                   longer to show up.
+        sample_rate (float): The default fraction of stats calls to record,
+                             between 0 and 1.  Counter changes are scaled up
+                             to compensate.  Calls can override this with
+                             their own ``sample_rate`` argument.  ``put`` is
+                             never sampled.
+        metrics_port (int): If provided, stats are also served over HTTP at
+                            ``/metrics`` on this port, in the Prometheus text
+                            format.  It listens on the same ``host``.
+        stats_file (str): If provided, counters and graphs are also written
+                          to a memory-mapped file at this path, which the
+                          ``eww-stat`` script can read from another process.
+                          ``%(pid)s`` is replaced with our PID, e.g.
+                          ``/dev/shm/eww-%(pid)s.stats``.  If several
+                          processes embed Eww with the same ``stats_file``,
+                          ``stats --all`` in any of their consoles shows the
+                          stats of all of them.
+        unix_socket (str): If provided, the console listens on a unix domain
+                           socket at this path instead of ``host`` and
+                           ``port``.  ``%(pid)s`` is replaced with our PID,
+                           e.g. ``/tmp/eww-%(pid)s.sock``, which lets many
+                           processes on a host run Eww without picking
+                           ports.  Connect with ``eww --pid``.
+        max_consoles (int): The maximum number of consoles open at once.
+                            Further connections get an error message and are
+                            closed.  None means no limit.
+        console_backlog (int): The console listener's listen backlog.
+        console_idle_timeout (float): If provided, consoles are disconnected
+                                      after waiting this many seconds for
+                                      input.
+        console_linger (float): How long, in seconds, a console thread waits
+                                for another connection after its user
+                                disconnects, so it can be reused.  By
+                                default console threads exit right away.
+        console_engine (str): How consoles are served.  'thread' (the
+                              default) runs each console on its own thread.
+                              'event' waits on every console from a single
+                              thread and runs their commands on a pool of
+                              ``console_workers`` threads, so attached
+                              consoles that aren't running anything don't
+                              need a thread each.
+        console_workers (int): The number of threads that run commands when
+                               ``console_engine`` is 'event'.
 
     Returns:
         None
@@ -52,8 +136,18 @@ def embed(host='localhost', port=10000, timeout=1, max_datapoints=500,
                                    besides ``localhost`` or ``127.0.0.1``
                                    without setting ``wildly_insecure`` to
                                    True.
+        InvalidConsoleEngine: Will be raised if ``console_engine`` isn't
+                              'thread' or 'event'.
+        InvalidStatsBatchSize: Will be raised if ``stats_batch_size`` is less
+                               than 1.
     """
 
+    if console_engine not in ('thread', 'event'):
+        raise InvalidConsoleEngine('console_engine must be thread or event.')
+
+    if stats_batch_size < 1:
+        raise InvalidStatsBatchSize('stats_batch_size must be at least 1.')
+
     if not wildly_insecure:
         try:  # pragma: no cover -- We hit this branch, but coverage disagrees
             allowed = ['localhost', '127.0.0.1', '::1']
@@ -63,6 +157,12 @@ def embed(host='localhost', port=10000, timeout=1, max_datapoints=500,
             msg += 'wildly_insecure to True.'
             raise WildlyInsecureFlagNotSet(msg)
 
+    restart = FORK_STATUS['restart']
+    if restart is not None:
+        # We're a forked child that hasn't started Eww yet
+        restart()
+        return
+
     with IMPLANT_LOCK:
         if EMBEDDED.isSet():
             LOGGER.debug('attempted to embed eww more than once')
@@ -78,20 +178,245 @@ def embed(host='localhost', port=10000, timeout=1, max_datapoints=500,
     __builtin__.quit = QuitterProxy(__builtin__.quit)
     __builtin__.exit = QuitterProxy(__builtin__.exit)
 
-    dispatch_thread = DispatchThread(str(host), int(port), timeout=timeout)
-    dispatch_thread.name = DISPATCH_THREAD_NAME
-    dispatch_thread.daemon = True
-    dispatch_thread.start()
+    STATS_CONFIG['accumulate'] = bool(accumulate_counters)
+    STATS_CONFIG['sample_rate'] = sample_rate
+
+    EMBED_CONFIG.clear()
+    EMBED_CONFIG.update(host=str(host),
+                        port=int(port),
+                        timeout=timeout,
+                        max_datapoints=max_datapoints,
+                        stats_batch_size=stats_batch_size,
+                        stats_batch_delay=stats_batch_delay,
+                        metrics_port=metrics_port,
+                        stats_file=stats_file,
+                        unix_socket=unix_socket,
+                        max_consoles=max_consoles,
+                        console_backlog=console_backlog,
+                        console_idle_timeout=console_idle_timeout,
+                        console_linger=console_linger,
+                        console_engine=console_engine,
+                        console_workers=console_workers)
+
+    start_threads(EMBED_CONFIG['port'], EMBED_CONFIG['metrics_port'],
+                  EMBED_CONFIG['stats_file'])
+    install_fork_handlers()
+
+    LOGGER.debug('eww completed embed')
+
+    return
+
+def start_threads(port, metrics_port, stats_file, console=True):
+    """Starts our threads using the options in EMBED_CONFIG.
+
+    Args:
+        port (int): The port for the console to listen on.
+        metrics_port (int): The port for the metrics exporter to listen on,
+                            or None to not start it.
+        stats_file (str): The stats file template, or None to not write one.
+        console (bool): Whether to start the console listener.
+
+    Returns:
+        None
+    """
+
+    host = EMBED_CONFIG['host']
+    timeout = EMBED_CONFIG['timeout']
+
+    if console:
+        dispatch_thread = DispatchThread(
+            host, port, timeout=timeout,
+            unix_socket=EMBED_CONFIG['unix_socket'],
+            max_consoles=EMBED_CONFIG['max_consoles'],
+            backlog=EMBED_CONFIG['console_backlog'],
+            idle_timeout=EMBED_CONFIG['console_idle_timeout'],
+            linger=EMBED_CONFIG['console_linger'],
+            console_engine=EMBED_CONFIG['console_engine'],
+            console_workers=EMBED_CONFIG['console_workers'])
+        dispatch_thread.name = DISPATCH_THREAD_NAME
+        dispatch_thread.daemon = True
+        dispatch_thread.start()
+
+    STATS_CONFIG['stats_file'] = None
+    max_datapoints = EMBED_CONFIG['max_datapoints']
+
+    mapped_file = None
+    if stats_file is not None:
+        try:
+            mapped_file = StatsFile(stats_file, max_datapoints=max_datapoints)
+            STATS_CONFIG['stats_file'] = stats_file
+        except (EnvironmentError, ValueError) as exception:
+            LOGGER.error('Could not create stats file: ' + str(exception))
 
     stats_thread = StatsThread(max_datapoints=max_datapoints,
-                               timeout=timeout)
+                               timeout=timeout,
+                               batch_size=EMBED_CONFIG['stats_batch_size'],
+                               batch_delay=EMBED_CONFIG['stats_batch_delay'],
+                               stats_file=mapped_file)
     stats_thread.name = STATS_THREAD_NAME
     stats_thread.daemon = True
     stats_thread.start()
 
-    LOGGER.debug('eww completed embed')
+    if metrics_port is not None:
+        exporter_thread = ExporterThread(host, int(metrics_port),
+                                         timeout=timeout)
+        exporter_thread.name = EXPORTER_THREAD_NAME
+        exporter_thread.daemon = True
+        exporter_thread.start()
 
-    return
+def install_fork_handlers():
+    """Makes sure ``before_fork`` and the after fork handlers run around every
+    fork.  Python 2 has no ``os.register_at_fork``, so there we wrap
+    ``os.fork`` instead.  Either way this only happens once per process, and
+    the handlers do nothing unless Eww is embedded.
+
+    Returns:
+        None
+    """
+
+    with IMPLANT_LOCK:
+        if FORK_STATUS['installed']:
+            return
+        FORK_STATUS['installed'] = True
+
+    if hasattr(os, 'register_at_fork'):  # pragma: no cover
+        # pylint: disable=no-member
+        os.register_at_fork(before=before_fork,
+                            after_in_parent=after_fork_parent,
+                            after_in_child=after_fork_child)
+        return
+
+    original_fork = os.fork
+
+    def fork():
+        """Wraps ``os.fork`` with Eww's fork handlers."""
+        before_fork()
+        try:
+            pid = original_fork()
+        except:
+            after_fork_parent()
+            raise
+        if pid == 0:
+            after_fork_child()
+        else:
+            after_fork_parent()
+        return pid
+
+    fork.original_fork = original_fork
+    os.fork = fork
+
+def before_fork():
+    """Takes our locks so no other thread holds them when the process forks.
+    A lock held by another thread at fork would stay locked forever in the
+    child, since that thread doesn't exist there.
+
+    Returns:
+        None
+    """
+
+    IMPLANT_LOCK.acquire()
+    STORE_LOCK.acquire()
+    STATS_QUEUE.lock.acquire()
+
+def after_fork_parent():
+    """Releases the locks taken in ``before_fork``.
+
+    Returns:
+        None
+    """
+
+    STATS_QUEUE.lock.release()
+    STORE_LOCK.release()
+    IMPLANT_LOCK.release()
+
+def after_fork_child():
+    """Resets Eww in a new child process.  Only the thread that forked
+    exists in the child, so if Eww was embedded we reset our shared state.
+    The proxies installed by embed are still in place.  Many children (e.g.
+    those that exec straight away) never use Eww, so new threads aren't
+    started until the child records a stat or calls embed; see
+    ``restart_after_fork``.
+
+    Returns:
+        None
+    """
+
+    # The queue's conditions may have waiters from threads that are gone, so
+    # start fresh rather than releasing the mutex.
+    STATS_QUEUE.__init__(STATS_QUEUE.maxsize)
+    STORE_LOCK.release()
+
+    try:
+        if not EMBEDDED.isSet() or REMOVAL.isSet():
+            return
+
+        # The child's stats start from scratch.
+        for store in (COUNTER_STORE, GRAPH_STORE, HISTOGRAM_STORE,
+                      RATE_STORE):
+            store.clear()
+        del ACCUMULATORS[:]
+        # Its thread didn't survive the fork
+        OBJECTS_STATUS['counter'] = None
+        LOCAL_STATS.__dict__.clear()
+        STATS_STATUS['dropped'] = 0
+
+        FORK_STATUS['restart'] = restart_after_fork
+    finally:
+        IMPLANT_LOCK.release()
+
+def per_process(template):
+    """Checks if a path template gives each process its own path.
+
+    Args:
+        template (str): A path that may contain ``%(pid)s``.
+
+    Returns:
+        bool: True if the path depends on the PID.
+    """
+
+    return template % {'pid': 1} != template % {'pid': 2}
+
+def restart_after_fork():
+    """Starts Eww's threads in a forked child, the first time they're
+    needed.  The child can't listen on the parent's ports, so the console and
+    metrics exporter listen on ports picked by the OS, which are logged.  A
+    unix socket or stats file whose path doesn't contain ``%(pid)s`` belongs
+    to the parent, so the child goes without.
+
+    Returns:
+        None
+    """
+
+    with IMPLANT_LOCK:
+        if FORK_STATUS['restart'] is None:
+            return
+        FORK_STATUS['restart'] = None
+
+        if not EMBEDDED.isSet() or REMOVAL.isSet():
+            return
+
+        console = True
+        unix_socket = EMBED_CONFIG['unix_socket']
+        if unix_socket is not None and not per_process(unix_socket):
+            LOGGER.warning('Not starting the console in child process ' +
+                           str(os.getpid()) + ', since its unix socket path '
+                           'has no %(pid)s.')
+            console = False
+
+        stats_file = EMBED_CONFIG['stats_file']
+        if stats_file is not None and not per_process(stats_file):
+            LOGGER.warning('Not writing a stats file in child process ' +
+                           str(os.getpid()) + ', since its path has no '
+                           '%(pid)s.')
+            stats_file = None
+
+        metrics_port = EMBED_CONFIG['metrics_port']
+        if metrics_port is not None:
+            metrics_port = 0
+
+        start_threads(0, metrics_port, stats_file, console)
+
+        LOGGER.debug('eww restarted in child process ' + str(os.getpid()))
 
 def remove():
     """Stops and removes all of eww.
@@ -108,6 +433,7 @@ def remove():
             LOGGER.debug('attempted to remove more than once simultaneously')
             return
         REMOVAL.set()
+        FORK_STATUS['restart'] = None
 
     LOGGER.debug('attempting to remove eww')
 
@@ -127,6 +453,21 @@ def remove():
             # Our threads haven't stopped.
             LOGGER.debug('failed to remove eww, some threads may be alive')
 
+    STATS_CONFIG['accumulate'] = False
+    STATS_CONFIG['sample_rate'] = 1
+    STATS_CONFIG['stats_file'] = None
+
+    if PROFILER_STATUS['profiler'] is not None:
+        PROFILER_STATUS['profiler'].stop()
+        PROFILER_STATUS['profiler'] = None
+
+    if MEMORY_STATUS['tracker'] is not None:
+        MEMORY_STATUS['tracker'].stop()
+        MEMORY_STATUS['tracker'] = None
+
+    # Stopped along with our other threads
+    OBJECTS_STATUS['counter'] = None
+
     __builtin__.quit = __builtin__.quit.original_quit
     __builtin__.exit = __builtin__.exit.original_quit
 
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.memory
+    ~~~~~~~~~~
+
+    Tools for finding out where memory is going.
+
+    If :py:mod:`tracemalloc` is available (it's in the standard library from
+    Python 3.4, and available for patched Python 2 builds as pytracemalloc),
+    snapshots record where memory was allocated.  Otherwise, snapshots are a
+    census of the objects the garbage collector knows about, grouped by type.
+    Both kinds can be compared to see what grew.
+
+"""
+
+from collections import deque
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import types
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, without pytracemalloc
+    pass
+
+from .stoppable_thread import StoppableThread
+
+LOGGER = logging.getLogger(__name__)
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    # We're on Windows
+    PAGE_SIZE = None
+
+def process_memory():
+    """Reads our current memory use from ``/proc/self/statm``.
+
+    Returns:
+        tuple: Resident set size and virtual memory size in bytes, or
+               (None, None) if ``/proc`` isn't available.
+    """
+
+    if PAGE_SIZE is None:  # pragma: no cover
+        return None, None
+
+    try:
+        with open('/proc/self/statm') as statm:
+            fields = statm.read().split()
+        return int(fields[1]) * PAGE_SIZE, int(fields[0]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):  # pragma: no cover
+        return None, None
+
+def type_name(obj):
+    """Returns a readable name for an object's type.  Instances of old-style
+    classes are named after their class rather than ``instance``.
+
+    Args:
+        obj: Any object.
+
+    Returns:
+        str: The type's name, with its module unless it's a builtin.
+    """
+
+    obj_type = type(obj)
+    if obj_type is types.InstanceType:
+        obj_type = obj.__class__
+
+    module = getattr(obj_type, '__module__', None)
+    if module in (None, '__builtin__', 'builtins'):
+        return obj_type.__name__
+    return module + '.' + obj_type.__name__
+
+def object_chunks(chunk_size=10000):
+    """Yields the objects tracked by the garbage collector, a chunk at a time.
+    Between chunks we sleep for 0 seconds, which releases the GIL, so the
+    application's threads keep running while we walk a big heap.
+
+    ``gc.get_objects()`` still lists every object in one call, holding the
+    GIL throughout, before the first chunk.  Chunks are taken off the end of
+    that list, so objects we've yielded aren't kept alive by it.
+
+    Args:
+        chunk_size (int): Objects per chunk.
+
+    Yields:
+        list: The next chunk of objects.
+    """
+
+    objects = gc.get_objects()
+    while objects:
+        chunk = objects[-chunk_size:]
+        del objects[-chunk_size:]
+        yield chunk
+        time.sleep(0)
+
+def census(chunk_size=10000):
+    """Counts the objects tracked by the garbage collector, by type.  Sizes
+    are shallow, from ``sys.getsizeof``.
+
+    Args:
+        chunk_size (int): Objects counted between GIL releases.
+
+    Returns:
+        dict: [count, size in bytes] lists, keyed by type name.
+    """
+
+    counts = {}
+
+    for chunk in object_chunks(chunk_size):
+        for obj in chunk:
+            name = type_name(obj)
+            try:
+                size = sys.getsizeof(obj)
+            except TypeError:  # pragma: no cover
+                # Some extension types don't support getsizeof
+                size = 0
+            try:
+                entry = counts[name]
+            except KeyError:
+                entry = counts[name] = [0, 0]
+            entry[0] += 1
+            entry[1] += size
+
+    return counts
+
+def count_objects(chunk_size=10000):
+    """Counts the objects tracked by the garbage collector, by type.  Cheaper
+    than ``census`` since sizes aren't needed.
+
+    Args:
+        chunk_size (int): Objects counted between GIL releases.
+
+    Returns:
+        dict: Counts keyed by type name.
+    """
+
+    counts = {}
+
+    for chunk in object_chunks(chunk_size):
+        for obj in chunk:
+            name = type_name(obj)
+            counts[name] = counts.get(name, 0) + 1
+
+    return counts
+
+class ObjectCountThread(StoppableThread):
+    """Counts objects by type every ``interval`` seconds, and hands the
+    counts to a callback.  A count of a big heap can take seconds, so this
+    gets a thread of its own rather than holding up the stats thread.
+    """
+
+    def __init__(self, interval, callback, chunk_size=10000):
+        """Init.
+
+        Args:
+            interval (float): Seconds between counts.
+            callback (callable): Called with each count's dict of counts
+                                 keyed by type name.
+            chunk_size (int): Objects counted between GIL releases.
+        """
+        super(ObjectCountThread, self).__init__()
+        self.interval = interval
+        self.callback = callback
+        self.chunk_size = chunk_size
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """Sets the stop_requested flag and wakes the thread up."""
+        super(ObjectCountThread, self).stop()
+        self.stopped.set()
+
+    def run(self):
+        """Main thread loop."""
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stop_requested:
+                return
+            try:
+                self.callback(count_objects(self.chunk_size))
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Counting objects failed')
+
+class MemoryTracker(object):
+    """Takes memory snapshots, and keeps the most recent few of them."""
+
+    def __init__(self, max_snapshots=3):
+        """Init.
+
+        Args:
+            max_snapshots (int): How many snapshots to keep.  Older snapshots
+                                 are dropped, so memory use stays bounded.
+        """
+        self.snapshots = deque(maxlen=max_snapshots)
+        self.taken = 0
+        self.started_tracing = False
+
+    def tracing(self):
+        """Returns True if snapshots come from tracemalloc."""
+        if 'tracemalloc' not in sys.modules:
+            return False
+        return tracemalloc.is_tracing()  # pragma: no cover
+
+    def start(self, frames=1):  # pragma: no cover
+        """Starts tracemalloc.
+
+        Args:
+            frames (int): How many frames of each allocation's traceback to
+                          record.
+
+        Returns:
+            bool: False if tracemalloc isn't available.
+        """
+
+        if 'tracemalloc' not in sys.modules:
+            return False
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.started_tracing = True
+        return True
+
+    def stop(self):
+        """Stops tracemalloc, if we started it, and drops our snapshots.
+        tracemalloc's snapshots can't be compared to a census.
+
+        Returns:
+            None
+        """
+
+        if self.started_tracing:  # pragma: no cover
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.snapshots.clear()
+
+    def snapshot(self):
+        """Takes a snapshot without keeping it.
+
+        Returns:
+            tuple: The kind of snapshot ('tracemalloc' or 'census'), and the
+                   snapshot itself.
+        """
+
+        if self.tracing():  # pragma: no cover
+            snapshot = tracemalloc.take_snapshot()
+            snapshot = snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__)])
+            return 'tracemalloc', snapshot
+
+        return 'census', census()
+
+    def keep(self):
+        """Takes a snapshot and keeps it.
+
+        Returns:
+            int: The snapshot's number.
+        """
+
+        kind, snapshot = self.snapshot()
+        self.taken += 1
+        self.snapshots.append((self.taken, kind, snapshot))
+        return self.taken
+
+    def get(self, number):
+        """Finds a kept snapshot.
+
+        Args:
+            number (int): The snapshot's number.
+
+        Returns:
+            tuple: (number, kind, snapshot), or None if we don't have it.
+        """
+
+        for kept in self.snapshots:
+            if kept[0] == number:
+                return kept
+        return None
+
+def top(kind, snapshot, limit=10):
+    """Finds the biggest allocation sites, or types for a census.
+
+    Args:
+        kind (str): 'tracemalloc' or 'census'.
+        snapshot: The snapshot.
+        limit (int): How many to return.
+
+    Returns:
+        list: (site, size in bytes, count) tuples, biggest first.
+    """
+
+    if kind == 'tracemalloc':  # pragma: no cover
+        stats = snapshot.statistics('traceback')[:limit]
+        return [(str(stat.traceback), stat.size, stat.count)
+                for stat in stats]
+
+    ranked = sorted(snapshot.items(), key=lambda item: (-item[1][1], item[0]))
+    return [(name, size, count) for name, (count, size) in ranked[:limit]]
+
+def diff(kind, old, new, limit=10):
+    """Compares two snapshots of the same kind.
+
+    Args:
+        kind (str): 'tracemalloc' or 'census'.
+        old: The older snapshot.
+        new: The newer snapshot.
+        limit (int): How many changes to return.
+
+    Returns:
+        list: (site, size change, count change, size, count) tuples, biggest
+              changes first.
+    """
+
+    if kind == 'tracemalloc':  # pragma: no cover
+        stats = new.compare_to(old, 'traceback')[:limit]
+        return [(str(stat.traceback), stat.size_diff, stat.count_diff,
+                 stat.size, stat.count) for stat in stats]
+
+    changes = []
+    for name in set(old) | set(new):
+        old_count, old_size = old.get(name, (0, 0))
+        count, size = new.get(name, (0, 0))
+        if count == old_count and size == old_size:
+            continue
+        changes.append((name, size - old_size, count - old_count, size,
+                        count))
+
+    changes.sort(key=lambda change: (-abs(change[1]), change[0]))
+    return changes[:limit]
+
+def format_bytes(size):
+    """Formats a number of bytes for people.
+
+    Args:
+        size (int): The number of bytes.  Can be negative.
+
+    Returns:
+        str: e.g. '1.5 MB'.
+    """
+
+    value = float(size)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(value) < 1024:
+            break
+        value /= 1024
+    else:
+        unit = 'TB'
+
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %s' % (value, unit)
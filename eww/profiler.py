@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.profiler
+    ~~~~~~~~~~~~
+
+    A statistical profiler.  Rather than installing a profile or trace hook,
+    which slows down every function call in the application, we periodically
+    look at every thread's stack with ``sys._current_frames()`` and count how
+    often we see each one.  The application only pays for the samples.
+
+    Samples are aggregated as they're taken into collapsed stacks, the format
+    used by flame graph tools: one line per unique stack, with its frames
+    separated by semicolons (outermost first), followed by a space and the
+    number of times it was seen.
+
+    There's also a deterministic profiler built on :py:mod:`cProfile`, for
+    when counts and exact timings are needed.  Python 2 can only install a
+    profile hook on the calling thread, so by default it profiles threads
+    started while it's running.  Optionally, it installs hooks on threads
+    that are already running by writing to their thread states with
+    :py:mod:`ctypes`.
+
+"""
+
+import cProfile
+try:
+    import ctypes
+except ImportError:  # pragma: no cover
+    # Some minimal builds don't have ctypes
+    pass
+from fnmatch import fnmatch
+import gc
+import logging
+import platform
+import pstats
+import re
+import sys
+import threading
+import time
+
+from .stoppable_thread import StoppableThread
+
+LOGGER = logging.getLogger(__name__)
+
+# Suffixes accepted by parse_interval, and their value in seconds
+UNITS = {'us': 0.000001, 'ms': 0.001, 's': 1.0}
+
+# Stands in for stacks seen after we've run out of room
+OTHER_FRAME = '[other]'
+# Stands in for the outermost frames of stacks deeper than max_depth
+TRUNCATED_FRAME = '[truncated]'
+
+# How often the interpreter considers switching threads while we're writing
+# to thread states, i.e. not at all.
+FROZEN_CHECK_INTERVAL = 2 ** 30
+
+# The ThreadHooks, once they've been created
+HOOKS = {}
+HOOKS_LOCK = threading.Lock()
+
+class InvalidInterval(Exception):
+    """Raised when an interval can't be parsed."""
+    pass
+
+def parse_interval(interval):
+    """Parses a time interval like '5ms', '100us' or '30s'.  Plain numbers are
+    taken to be seconds.
+
+    Args:
+        interval (str): The interval.
+
+    Returns:
+        float: The interval in seconds.
+
+    Raises:
+        InvalidInterval: If the interval isn't valid or isn't positive.
+    """
+
+    match = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*(us|ms|s)?\s*$', str(interval))
+    if not match:
+        raise InvalidInterval('Invalid interval: ' + str(interval))
+
+    seconds = float(match.group(1)) * UNITS[match.group(2) or 's']
+    if seconds <= 0:
+        raise InvalidInterval('Interval must be positive: ' + str(interval))
+
+    return seconds
+
+class StackSampler(object):
+    """Samples thread stacks and aggregates them into collapsed stacks.
+
+    Memory use is bounded by ``max_stacks`` and ``max_depth``.  Once
+    ``max_stacks`` unique stacks have been seen, samples of new stacks are
+    counted against an ``[other]`` stack for their thread instead.
+    """
+
+    def __init__(self, max_stacks=10000, max_depth=128, include_eww=False):
+        """Init.
+
+        Args:
+            max_stacks (int): The maximum number of unique stacks kept.
+            max_depth (int): The maximum number of frames kept per stack.
+                             Deeper stacks lose their outermost frames.
+            include_eww (bool): Also sample Eww's own threads (those with
+                                names starting with ``eww_``).  The sampling
+                                thread itself is never sampled.
+        """
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.include_eww = include_eww
+
+        # stack tuple -> count
+        self.stacks = {}
+        # code object -> frame label
+        self.labels = {}
+        self.samples = 0
+        self.threads = set()
+
+    def label(self, code):
+        """Returns the label for a frame running ``code``.
+
+        Args:
+            code (code): The frame's code object.
+
+        Returns:
+            str: The label.
+        """
+
+        try:
+            return self.labels[code]
+        except KeyError:
+            pass
+
+        label = '%s (%s:%d)' % (code.co_name, code.co_filename,
+                                code.co_firstlineno)
+        # Semicolons separate frames, so they can't appear in one
+        label = label.replace(';', ':')
+        self.labels[code] = label
+        return label
+
+    def sample(self):
+        """Takes one sample of every thread's stack.
+
+        Returns:
+            None
+        """
+
+        names = {}
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+
+        own_ident = threading.current_thread().ident
+
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own_ident:
+                continue
+
+            name = names.get(ident, 'thread-' + str(ident))
+            if not self.include_eww and name.startswith('eww_'):
+                continue
+
+            frames = []
+            while frame is not None and len(frames) < self.max_depth:
+                frames.append(self.label(frame.f_code))
+                frame = frame.f_back
+            if frame is not None:
+                frames.append(TRUNCATED_FRAME)
+            frames.append(name.replace(';', ':'))
+            frames.reverse()
+
+            stack = tuple(frames)
+            if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                stack = (frames[0], OTHER_FRAME)
+
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.threads.add(ident)
+
+        self.samples += 1
+
+    def collapsed(self):
+        """Returns the aggregated stacks, most frequently seen first.
+
+        Returns:
+            list: Collapsed stack lines, without trailing newlines.
+        """
+
+        stacks = sorted(self.stacks.items(), key=lambda item: (-item[1],
+                                                               item[0]))
+        return [';'.join(stack) + ' ' + str(count) for stack, count in stacks]
+
+class ProfilerUnavailable(Exception):
+    """Raised when we can't install profile hooks on other threads."""
+    pass
+
+class StatsSnapshot(object):
+    """Hands a stopped ``cProfile.Profile``'s stats to :py:mod:`pstats`.
+    ``pstats`` normally calls ``create_stats``, which also removes the
+    *calling* thread's profile hook.
+    """
+
+    def __init__(self, profile):
+        """Init.
+
+        Args:
+            profile (cProfile.Profile): The profiler.  It mustn't be
+                                        installed on any thread.
+        """
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        """Already done in __init__."""
+        pass
+
+class ThreadHooks(object):
+    """Installs and removes ``cProfile`` hooks on other threads.
+
+    CPython 2 only lets a thread set its own profile hook, which is stored
+    in three fields of its ``PyThreadState``.  We set the same fields of
+    other threads' states through :py:mod:`ctypes`, exactly as
+    ``sys.setprofile`` would have, while no other thread can run.
+    """
+
+    def __init__(self):
+        """Init.
+
+        Raises:
+            ProfilerUnavailable: If this isn't CPython 2 with ctypes.
+        """
+
+        if ('ctypes' not in sys.modules or sys.version_info[0] != 2 or
+                platform.python_implementation() != 'CPython'):
+            raise ProfilerUnavailable('cprofile needs CPython 2 with ctypes.')
+
+        class ThreadState(ctypes.Structure):  # pylint: disable=too-few-public-methods
+            """The start of CPython 2's PyThreadState, up to thread_id."""
+            pass
+
+        state_pointer = ctypes.POINTER(ThreadState)
+        pointer = ctypes.c_void_p
+        ThreadState._fields_ = [  # pylint: disable=protected-access
+            ('next', state_pointer), ('interp', pointer),
+            ('frame', pointer), ('recursion_depth', ctypes.c_int),
+            ('tracing', ctypes.c_int), ('use_tracing', ctypes.c_int),
+            ('c_profilefunc', pointer), ('c_tracefunc', pointer),
+            ('c_profileobj', pointer), ('c_traceobj', pointer),
+            ('curexc_type', pointer), ('curexc_value', pointer),
+            ('curexc_traceback', pointer), ('exc_type', pointer),
+            ('exc_value', pointer), ('exc_traceback', pointer),
+            ('dict', pointer), ('tick_counter', ctypes.c_int),
+            ('gilstate_counter', ctypes.c_int), ('async_exc', pointer),
+            ('thread_id', ctypes.c_long)]
+
+        # Indexing gives us our own function objects, so we don't change
+        # anyone else's argtypes.
+        self.get_state = ctypes.pythonapi['PyThreadState_Get']
+        self.get_state.restype = state_pointer
+        self.thread_head = ctypes.pythonapi['PyInterpreterState_ThreadHead']
+        self.thread_head.argtypes = [pointer]
+        self.thread_head.restype = state_pointer
+        self.incref = ctypes.pythonapi['Py_IncRef']
+        self.incref.argtypes = [ctypes.py_object]
+        self.incref.restype = None
+        self.decref = ctypes.pythonapi['Py_DecRef']
+        self.decref.argtypes = [ctypes.py_object]
+        self.decref.restype = None
+
+        own_ident = threading.current_thread().ident
+        if self.get_state().contents.thread_id != own_ident:  # pragma: no cover
+            raise ProfilerUnavailable('cprofile doesn\'t know this Python\'s '
+                                      'thread states.')
+
+        self.callback = self.find_callback()
+
+    def find_callback(self):
+        """Finds ``cProfile``'s hook function, by installing a profiler on a
+        thread of our own and looking.
+
+        Returns:
+            int: The address of the hook function.
+        """
+
+        found = []
+
+        def probe():
+            """Installs a profiler and reads the hook."""
+            profile = cProfile.Profile()
+            profile.enable()
+            found.append(self.get_state().contents.c_profilefunc)
+            profile.disable()
+
+        thread = threading.Thread(target=probe, name='eww_cprofile_probe')
+        thread.start()
+        thread.join()
+        return found[0]
+
+    def states(self):
+        """Returns the state of every thread.  Only valid until another
+        thread runs.
+
+        Returns:
+            dict: Thread idents mapped to their states.
+        """
+
+        states = {}
+        state = self.thread_head(self.get_state().contents.interp)
+        while state:
+            states[state.contents.thread_id] = state.contents
+            state = state.contents.next
+        return states
+
+    def update(self, install=(), remove=()):
+        """Installs and removes hooks.  Threads with a hook we didn't
+        install are left alone.
+
+        Args:
+            install (list): (ident, cProfile.Profile) tuples to install.
+            remove (list): (ident, cProfile.Profile) tuples to remove.
+
+        Returns:
+            list: The idents we installed hooks on.
+        """
+
+        installed = []
+
+        # Threads can exit and free their states whenever we let another
+        # thread run, so don't, until we're done with them.  Our ctypes
+        # allocations could start a collection, and a __del__ it runs could
+        # release the GIL, so collections are off too.
+        collecting = gc.isenabled()
+        gc.disable()
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(FROZEN_CHECK_INTERVAL)
+        try:
+            states = self.states()
+
+            for ident, profile in remove:
+                state = states.get(ident)
+                if state is None or state.c_profileobj != id(profile):
+                    continue
+                state.use_tracing = int(bool(state.c_tracefunc))
+                state.c_profilefunc = None
+                state.c_profileobj = None
+                self.decref(profile)
+
+            for ident, profile in install:
+                state = states.get(ident)
+                if state is None or state.c_profilefunc:
+                    continue
+                # Set the hook's argument before the hook, in case we do get
+                # interrupted.
+                self.incref(profile)
+                state.c_profileobj = id(profile)
+                state.c_profilefunc = self.callback
+                state.use_tracing = 1
+                installed.append(ident)
+        finally:
+            sys.setcheckinterval(interval)
+            if collecting:
+                gc.enable()
+
+        return installed
+
+def thread_hooks():
+    """Returns the ``ThreadHooks``, creating them the first time.
+
+    Returns:
+        ThreadHooks: The hooks.
+
+    Raises:
+        ProfilerUnavailable: If this Python isn't supported.
+    """
+
+    with HOOKS_LOCK:
+        if 'hooks' not in HOOKS:
+            HOOKS['hooks'] = ThreadHooks()
+        return HOOKS['hooks']
+
+class ProfileTimer(StoppableThread):
+    """Stops a ``ThreadProfiler`` once its duration has passed."""
+
+    def __init__(self, profiler):
+        """Init.
+
+        Args:
+            profiler (ThreadProfiler): The profiler to stop.
+        """
+        super(ProfileTimer, self).__init__()
+        self.profiler = profiler
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """Sets the stop_requested flag and wakes the timer up."""
+        super(ProfileTimer, self).stop()
+        self.stopped.set()
+
+    def run(self):
+        """Waits for the deadline, or to be stopped, then stops profiling."""
+        self.stopped.wait(max(self.profiler.deadline - time.time(), 0))
+        self.profiler.stop()
+
+class ThreadProfiler(object):
+    """Profiles threads with ``cProfile``.  Every thread started while
+    we're running, whose name matches ``include`` and doesn't match
+    ``exclude``, gets its own profiler.  With ``include_running``, so do
+    matching threads that were already running.
+
+    New threads install their own hooks, through ``threading.setprofile``.
+    Hooks are only installed on running threads with ``ThreadHooks`` when
+    asked to.  Every hook is removed with ``ThreadHooks`` when we're stopped
+    or ``duration`` has passed, and stats are only read once they're gone.
+    """
+
+    def __init__(self, include=None, exclude=None, duration=30,
+                 max_threads=64, include_running=False):
+        """Init.
+
+        Args:
+            include (list): Thread name patterns to profile, e.g.
+                            ``['worker-*']``.  Defaults to every thread.
+            exclude (list): Thread name patterns not to profile.  Defaults to
+                            Eww's own threads.
+            duration (float): Seconds to profile for, at most.
+            max_threads (int): The maximum number of threads profiled.
+            include_running (bool): Also install hooks on threads that are
+                                    already running.  Otherwise only threads
+                                    started while we're running are
+                                    profiled, and they install their own
+                                    hooks.
+        """
+        self.include = include or ['*']
+        self.include_running = include_running
+        self.exclude = exclude if exclude is not None else ['eww_*']
+        self.duration = duration
+        self.max_threads = max_threads
+
+        self.lock = threading.Lock()
+        # (thread name, cProfile.Profile) tuples
+        self.profiles = []
+        # (thread ident, cProfile.Profile) tuples
+        self.hooked = []
+        self.hooks = None
+        self.timer = None
+        self.started = None
+        self.deadline = None
+        self.running = False
+
+    def wanted(self, name):
+        """Checks a thread name against our patterns.
+
+        Args:
+            name (str): The thread name.
+
+        Returns:
+            bool: True if the thread should be profiled.
+        """
+
+        for pattern in self.exclude:
+            if fnmatch(name, pattern):
+                return False
+        for pattern in self.include:
+            if fnmatch(name, pattern):
+                return True
+        return False
+
+    def active(self):
+        """Returns True until we're stopped or ``duration`` has passed."""
+        return self.running and time.time() < self.deadline
+
+    def bootstrap(self, frame, event, arg):  # pylint: disable=unused-argument
+        """Installed with ``threading.setprofile``, so it's called once by
+        every new thread.  Swaps itself out for a ``cProfile`` profiler if we
+        want to profile the thread.
+
+        Returns:
+            None
+        """
+
+        sys.setprofile(None)
+
+        if not self.active():
+            return
+
+        thread = threading.current_thread()
+        if not self.wanted(thread.name):
+            return
+
+        profile = cProfile.Profile()
+        with self.lock:
+            # stop() removes hooks once it's checked running, so we can only
+            # add one before then.
+            if not self.running or len(self.profiles) >= self.max_threads:
+                return
+            self.profiles.append((thread.name, profile))
+            self.hooked.append((thread.ident, profile))
+            profile.enable()
+
+    def start(self):
+        """Starts profiling threads started until we're stopped, and running
+        threads too if we were asked to.
+
+        Returns:
+            None
+
+        Raises:
+            ProfilerUnavailable: If this Python isn't supported.
+        """
+
+        self.hooks = thread_hooks()
+
+        self.started = time.time()
+        self.deadline = self.started + self.duration
+
+        candidates = []
+        names = {}
+        if self.include_running:
+            for thread in threading.enumerate():
+                if (len(candidates) < self.max_threads and
+                        self.wanted(thread.name)):
+                    candidates.append((thread.ident, cProfile.Profile()))
+                    names[thread.ident] = thread.name
+
+        with self.lock:
+            self.running = True
+            installed = set(self.hooks.update(install=candidates))
+            for ident, profile in candidates:
+                if ident in installed:
+                    self.profiles.append((names[ident], profile))
+                    self.hooked.append((ident, profile))
+        threading.setprofile(self.bootstrap)
+
+        self.timer = ProfileTimer(self)
+        self.timer.daemon = True
+        self.timer.name = 'eww_cprofile_timer'
+        self.timer.start()
+
+    def stop(self):
+        """Stops profiling, and removes our hook from every thread.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            hooked = self.hooked
+            self.hooked = []
+
+        threading.setprofile(None)
+        self.hooks.update(remove=hooked)
+
+        if self.timer is not threading.current_thread():
+            self.timer.stop()
+
+    def stats(self, stream=None):
+        """Stops profiling if we haven't been, and collects the stats of
+        every profiled thread.
+
+        Args:
+            stream (file): Where ``pstats`` should print to.  Defaults to
+                           ``sys.stdout``.
+
+        Returns:
+            pstats.Stats: The combined stats, or None if no threads were
+                          profiled.
+        """
+
+        self.stop()
+
+        with self.lock:
+            profiles = [profile for _, profile in self.profiles]
+
+        if not profiles:
+            return None
+
+        snapshots = [StatsSnapshot(profile) for profile in profiles]
+        return pstats.Stats(*snapshots, stream=stream or sys.stdout)
@@ -14,17 +14,57 @@
 
 """
 
-from Queue import Queue
 import threading
 
+from .statsqueue import StatsQueue
+
 DISPATCH_THREAD_NAME = 'eww_dispatch_thread'
 STATS_THREAD_NAME = 'eww_stats_thread'
+EXPORTER_THREAD_NAME = 'eww_exporter_thread'
 
 IMPLANT_LOCK = threading.Lock()
 
 EMBEDDED = threading.Event()
 REMOVAL = threading.Event()
 
-STATS_QUEUE = Queue(maxsize=500)
+STATS_QUEUE = StatsQueue(maxsize=500)
 COUNTER_STORE = {}
 GRAPH_STORE = {}
+HISTOGRAM_STORE = {}
+RATE_STORE = {}
+GAUGE_STORE = {}
+
+# Held by StatsThread while it applies a batch of stats to the stores, and by
+# readers while they take a snapshot of them.
+STORE_LOCK = threading.Lock()
+
+# Runtime stats options, set by embed().  ``accumulate`` makes counter calls
+# write into a per-thread accumulator instead of STATS_QUEUE.
+# ``sample_rate`` is the default fraction of stats calls that are recorded.
+# ``stats_file`` is the stats file template, if we're writing one.
+STATS_CONFIG = {'accumulate': False, 'sample_rate': 1, 'stats_file': None}
+
+# The arguments embed() was called with, kept so we can restart our threads in
+# a forked child.
+EMBED_CONFIG = {}
+
+# Whether our fork handlers have been installed.  This is never undone.  In a
+# forked child that hasn't started Eww's threads yet, ``restart`` is the
+# function that starts them.
+FORK_STATUS = {'installed': False, 'restart': None}
+
+# Every per-thread counter accumulator that StatsThread needs to harvest.
+ACCUMULATORS = []
+
+# Health of the stats pipeline itself.  Only written by StatsThread.
+STATS_STATUS = {'dropped': 0}
+
+# The ThreadProfiler started by the cprofile command, if any.
+PROFILER_STATUS = {'profiler': None}
+
+# The MemoryTracker used by the memory command, once it's been used.
+MEMORY_STATUS = {'tracker': None}
+
+# The ObjectCountThread started by objects --every, if any.
+OBJECTS_STATUS = {'counter': None}
+
@@ -9,22 +9,101 @@
 
 """
 
-from collections import deque, namedtuple
+from array import array
+from collections import namedtuple
+from functools import wraps
+from itertools import izip
 import logging
-from Queue import Full, Empty
+try:
+    import ctypes
+except ImportError:  # pragma: no cover
+    # Some minimal builds don't have ctypes
+    pass
+import math
+from random import random
 try:
     import resource
 except ImportError:  # pragma: no cover
     # We're on Windows
     pass
 import sys
+import threading
+import time
 
 LOGGER = logging.getLogger(__name__)
 
-from .shared import COUNTER_STORE, GRAPH_STORE, STATS_QUEUE
+# From <time.h> on Linux
+CLOCK_MONOTONIC = 1
+
+# Sampled gauges are graphed under their name followed by this, so the graph
+# and the gauge don't fight over the name in the console and the exporter.
+SAMPLES_SUFFIX = '.samples'
+
+def load_monotonic_clock():
+    """Builds a monotonic clock from ``clock_gettime``, for Pythons without
+    ``time.monotonic``.  The wall clock can jump when it's adjusted, which
+    would make durations measured with it wrong, or even negative.
+
+    Returns:
+        A function returning the monotonic time in seconds, or None if
+        ``clock_gettime(CLOCK_MONOTONIC)`` isn't available.
+    """
+
+    if not sys.platform.startswith('linux') or 'ctypes' not in sys.modules:
+        return None  # pragma: no cover
+
+    class Timespec(ctypes.Structure):  # pylint: disable=too-few-public-methods
+        """struct timespec"""
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # Older glibcs only have clock_gettime in librt
+    for library in (None, 'librt.so.1'):
+        try:
+            # clock_gettime doesn't block, so there's no need to release the
+            # GIL, which makes PyDLL's calls cheaper.
+            clock_gettime = ctypes.PyDLL(library).clock_gettime
+            break
+        except (AttributeError, OSError):  # pragma: no cover
+            continue
+    else:  # pragma: no cover
+        return None
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    clock_gettime.restype = ctypes.c_int
+
+    def monotonic():
+        """Returns the monotonic time in seconds."""
+        spec = Timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+
+    # Make sure the clock actually works here
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(Timespec())) != 0:
+        return None  # pragma: no cover
+
+    return monotonic
+
+try:
+    from time import monotonic as clock
+except ImportError:  # pragma: no cover
+    # Python 2 doesn't have a monotonic clock, so use the kernel's, or the
+    # wall clock if we have to.
+    clock = load_monotonic_clock() or time.time
+
+from .shared import (ACCUMULATORS, COUNTER_STORE, FORK_STATUS, GAUGE_STORE,
+                     GRAPH_STORE, HISTOGRAM_STORE, RATE_STORE, STATS_CONFIG,
+                     STATS_QUEUE, STATS_STATUS, STORE_LOCK)
+from .statsqueue import Stat
 from .stoppable_thread import StoppableThread
 
-Stat = namedtuple('Stat', 'name type action value')
+Snapshot = namedtuple('Snapshot', 'counters graphs histograms rates gauges '
+                                  'dropped time series distributions')
+
+GraphSummary = namedtuple('GraphSummary', 'length last version')
+
+HistogramSummary = namedtuple('HistogramSummary', 'count version')
+
+LOCAL_STATS = threading.local()
 
 class InvalidGraphDatapoint(Exception):
     """Raised when stats.graph is called with invalid data"""
@@ -34,73 +113,789 @@ class InvalidCounterOption(Exception):
     """Raised when counter methods are called with invalid data"""
     pass
 
+class InvalidHistogramValue(Exception):
+    """Raised when stats.histogram is called with invalid data"""
+    pass
+
+class InvalidGaugeOption(Exception):
+    """Raised when stats.gauge is called with invalid data"""
+    pass
+
+class GraphSeries(object):
+    """A ring buffer of (X, Y) graph datapoints.  Once ``max_datapoints`` is
+    reached the oldest datapoint is overwritten.
+
+    Datapoints are stored in two arrays of C longs rather than as tuples,
+    which costs 16 bytes per datapoint instead of well over 100, and appending
+    doesn't allocate any objects.  Iterating yields (X, Y) tuples, oldest
+    first, so this can be used anywhere a sequence of datapoints is expected.
+    """
+
+    def __init__(self, max_datapoints):
+        """Init.
+
+        Args:
+            max_datapoints (int): The maximum number of datapoints to keep.
+        """
+        self.max_datapoints = max_datapoints
+        self.x_values = array('l')
+        self.y_values = array('l')
+        # Position of the oldest datapoint, once we've wrapped around
+        self.start = 0
+        # Bumped on every change, so snapshots can tell if we've changed
+        self.version = 0
+
+    def append(self, datapoint):
+        """Adds a datapoint, overwriting the oldest one if we're full.
+
+        Args:
+            datapoint (tuple): An (X, Y) tuple of integers.
+
+        Returns:
+            None
+        """
+
+        x_value, y_value = datapoint
+        self.version += 1
+
+        if len(self.x_values) < self.max_datapoints:
+            self.x_values.append(x_value)
+            self.y_values.append(y_value)
+        elif self.max_datapoints > 0:
+            start = self.start
+            self.x_values[start] = x_value
+            self.y_values[start] = y_value
+            self.start = (start + 1) % self.max_datapoints
+
+    def __len__(self):
+        """Returns the number of datapoints stored."""
+        return len(self.x_values)
+
+    def __getitem__(self, index):
+        """Returns the datapoint at ``index``, where 0 is the oldest.
+
+        Args:
+            index (int): The index of the datapoint to return.
+
+        Returns:
+            tuple: An (X, Y) tuple.
+        """
+
+        size = len(self.x_values)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('GraphSeries index out of range')
+
+        index = (self.start + index) % size
+        return (self.x_values[index], self.y_values[index])
+
+    def __iter__(self):
+        """Yields datapoints, oldest first."""
+
+        start = self.start
+        x_values = self.x_values[start:] + self.x_values[:start]
+        y_values = self.y_values[start:] + self.y_values[:start]
+        return izip(x_values, y_values)
+
+    def copy(self):
+        """Returns an independent copy of this series.
+
+        Returns:
+            GraphSeries: The copy.
+        """
+
+        duplicate = GraphSeries(self.max_datapoints)
+        duplicate.x_values = self.x_values[:]
+        duplicate.y_values = self.y_values[:]
+        duplicate.start = self.start
+        duplicate.version = self.version
+        return duplicate
+
+class Histogram(object):
+    """Records a distribution of values in a fixed amount of memory.
+
+    Values are counted in logarithmically sized buckets, so any quantile we
+    report is within ``relative_accuracy`` of a value that was actually
+    recorded, no matter how many values are added.  Buckets are only created
+    for values we've seen, and if there are ever more than ``max_buckets`` the
+    lowest buckets are merged together, which only affects the accuracy of
+    the lowest quantiles.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        """Init.
+
+        Args:
+            relative_accuracy (float): The relative error allowed in reported
+                                       quantiles.
+            max_buckets (int): The maximum number of buckets to keep.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        # Bumped on every change, so snapshots can tell if we've changed
+        self.version = 0
+
+    def add(self, value):
+        """Records a value.
+
+        Args:
+            value (float): A finite, non-negative number.
+
+        Returns:
+            None
+        """
+
+        # Work out the bucket first, so a bad value raises before we've
+        # changed anything.
+        if value > 0:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+
+        self.count += 1
+        self.total += value
+        self.version += 1
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value <= 0:
+            self.zero_count += 1
+            return
+
+        buckets = self.buckets
+        try:
+            buckets[index] += 1
+        except KeyError:
+            buckets[index] = 1
+            if len(buckets) > self.max_buckets:
+                self.collapse()
+
+    def collapse(self):
+        """Merges the two lowest buckets.
+
+        Returns:
+            None
+        """
+
+        lowest, second = sorted(self.buckets)[:2]
+        self.buckets[second] += self.buckets.pop(lowest)
+
+    def quantile(self, quantile):
+        """Returns an estimate of the value at ``quantile``.
+
+        Args:
+            quantile (float): A number between 0 and 1, e.g. 0.99 for p99.
+
+        Returns:
+            float: The estimated value, or None if nothing was recorded.
+        """
+
+        if not self.count:
+            return None
+
+        # We know these exactly
+        if quantile <= 0:
+            return self.min
+        if quantile >= 1:
+            return self.max
+
+        rank = quantile * (self.count - 1)
+
+        if rank < self.zero_count:
+            return self.min
+
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+
+        # The middle of the bucket, which is within relative_accuracy of
+        # anything in it.
+        value = 2 * self.gamma ** index / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+    def copy(self):
+        """Returns an independent copy of this histogram.
+
+        Returns:
+            Histogram: The copy.
+        """
+
+        duplicate = Histogram(self.relative_accuracy, self.max_buckets)
+        duplicate.buckets = self.buckets.copy()
+        duplicate.zero_count = self.zero_count
+        duplicate.count = self.count
+        duplicate.total = self.total
+        duplicate.min = self.min
+        duplicate.max = self.max
+        duplicate.version = self.version
+        return duplicate
+
+class RateTracker(object):
+    """Tracks how quickly a counter is changing over several time windows.
+
+    Changes are summed into one bucket per second, in a ring of buckets long
+    enough for the largest window, so memory use is fixed.  Each bucket
+    remembers which second it holds, which lets us tell stale buckets from
+    current ones without ever having to clear them on a timer.
+    """
+
+    # Windows we report, in seconds
+    windows = (1, 10, 60, 300)
+
+    def __init__(self):
+        """Init."""
+        self.size = max(self.windows)
+        self.seconds = array('l', [-1]) * self.size
+        self.changes = array('d', [0]) * self.size
+        # Bumped on every change, so snapshots can tell if we've changed
+        self.version = 0
+
+    def record(self, change, now):
+        """Records a change to the counter.
+
+        Args:
+            change (float): The amount the counter changed by.
+            now (float): The current time.
+
+        Returns:
+            None
+        """
+
+        second = int(now)
+        index = second % self.size
+        self.version += 1
+
+        if self.seconds[index] != second:
+            self.seconds[index] = second
+            self.changes[index] = change
+        else:
+            self.changes[index] += change
+
+    def rate(self, window, now):
+        """Returns the average change per second over the last ``window``
+        complete seconds.  The current second isn't complete, so it's left
+        out.
+
+        Args:
+            window (int): The number of seconds to average over.
+            now (float): The current time.
+
+        Returns:
+            float: The change per second.
+        """
+
+        current = int(now)
+        oldest = current - window
+        seconds = self.seconds
+        changes = self.changes
+
+        total = 0
+        for index in xrange(self.size):
+            if oldest <= seconds[index] < current:
+                total += changes[index]
+
+        return total / float(window)
+
+    def rates(self, now):
+        """Returns the rate for each of our windows.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            list: (window, rate) tuples, smallest window first.
+        """
+
+        return [(window, self.rate(window, now)) for window in self.windows]
+
+    def copy(self):
+        """Returns an independent copy of this tracker.
+
+        Returns:
+            RateTracker: The copy.
+        """
+
+        duplicate = RateTracker()
+        duplicate.seconds = self.seconds[:]
+        duplicate.changes = self.changes[:]
+        duplicate.version = self.version
+        return duplicate
+
+class Gauge(object):
+    """A value that is read from a callable when someone asks for it, rather
+    than being pushed.  Optionally, StatsThread also reads it every
+    ``sample_interval`` seconds and records it to a graph named after it,
+    plus ``SAMPLES_SUFFIX``.
+    """
+
+    def __init__(self, func, sample_interval=None):
+        """Init.
+
+        Args:
+            func (callable): Called with no arguments to read the value.
+            sample_interval (float): If provided, how often, in seconds, to
+                                     record the value to a graph.
+        """
+        self.func = func
+        self.sample_interval = sample_interval
+        self.next_sample = 0
+
+    def read(self):
+        """Reads the gauge.  We're calling application code here, so any
+        exception is logged and swallowed.
+
+        Returns:
+            The value returned by ``func``, or None if it raised.
+        """
+
+        try:
+            return self.func()
+        except Exception as exception:  # pylint: disable=broad-except
+            LOGGER.debug('Gauge raised an exception: ' + str(exception))
+            return None
+
+class Timer(object):
+    """Times a block of code or a function, recording the duration in
+    milliseconds to a histogram.  Use it as a context manager::
+
+        with eww.timer('db_query'):
+            run_query()
+
+    or as a decorator::
+
+        @eww.timer('handle_request')
+        def handle_request():
+            pass
+
+    The name is validated once, when the timer is created, so timing a call
+    only costs two clock reads and a queue put.  A single Timer shouldn't be
+    used for overlapping ``with`` blocks; create a new one for each block.
+    Decorated functions can be called from any number of threads.
+    """
+
+    def __init__(self, name, sample_rate=None):
+        """Init.
+
+        Args:
+            name (str): The name of the histogram to record durations to.
+            sample_rate (float): The fraction of calls to time, between 0 and
+                                 1.  If not provided, the rate passed to
+                                 embed() is used.
+        """
+
+        if not isinstance(name, str):
+            raise InvalidHistogramValue('Name must be a string.')
+
+        self.name = name
+        self.sample_rate = sample_rate
+        self.start = None
+
+    def __enter__(self):
+        """Starts timing.
+
+        Returns:
+            Timer: This timer.
+        """
+        if sample_scale(self.sample_rate):
+            self.start = clock()
+        else:
+            self.start = None
+        return self
+
+    def __exit__(self, *args):
+        """Stops timing and records the duration.  Exceptions are not
+        suppressed.
+
+        Returns:
+            None
+        """
+        if self.start is not None:
+            record_duration(self.name, (clock() - self.start) * 1000)
+
+    def __call__(self, func):
+        """Wraps ``func`` so every call to it is timed.
+
+        Args:
+            func (callable): The function to time.
+
+        Returns:
+            callable: The wrapped function.
+        """
+
+        name = self.name
+        sample_rate = self.sample_rate
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            """Times a call to the wrapped function."""
+            if not sample_scale(sample_rate):
+                return func(*args, **kwargs)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_duration(name, (clock() - start) * 1000)
+
+        return timed
+
+class CounterAccumulator(object):
+    """Collects counter changes made by a single thread.
+
+    Only the owning thread writes to an accumulator, and StatsThread only
+    reads from it, so neither side needs a lock.  Rather than handing off
+    deltas (which would race), the owner keeps running totals and the stats
+    thread remembers how much of each total it has already merged.
+    """
+
+    def __init__(self, thread):
+        """Init.
+
+        Args:
+            thread (Thread): The thread that owns this accumulator.
+        """
+        self.thread = thread
+
+        # Written by the owning thread only
+        self.totals = {}
+        self.puts = {}
+
+        # Written by StatsThread only
+        self.harvested_totals = {}
+        self.harvested_puts = {}
+
+    def harvest(self):
+        """Collects everything that changed since the last harvest.  This
+        should only be called by StatsThread.
+
+        Returns:
+            list: A list of ``Stat`` objects to be processed.
+        """
+
+        stats = []
+
+        # Order matters here.  We read puts before totals, that way any put
+        # we see has a baseline that is covered by the totals we read.
+        puts = self.puts.items()
+        totals = dict(self.totals.items())
+
+        for name, entry in puts:
+            # Each put stores a new tuple, so identity tells us if it's new
+            if self.harvested_puts.get(name) is entry:
+                continue
+            self.harvested_puts[name] = entry
+            baseline, value = entry
+            total = totals.get(name, 0)
+            self.harvested_totals[name] = total
+            stats.append(Stat(name=name,
+                              type='counter',
+                              action='put',
+                              value=value + total - baseline))
+
+        for name, total in totals.iteritems():
+            delta = total - self.harvested_totals.get(name, 0)
+            if not delta:
+                continue
+            self.harvested_totals[name] = total
+            stats.append(Stat(name=name,
+                              type='counter',
+                              action='incr',
+                              value=delta))
+
+        return stats
+
 class StatsThread(StoppableThread):
-    """StatsThread listens to STATS_QUEUE and processes incoming stats. As a
-    StoppableThread subclass, this thread *must* check for the .stop_requested
-    flag.
+    """StatsThread listens to STATS_QUEUE and processes incoming stats.  When
+    there's nothing to do it sleeps until a stat arrives, and stop() wakes it
+    up.  As a StoppableThread subclass, this thread *must* check for the
+    .stop_requested flag.
     """
 
-    def __init__(self, max_datapoints=500, timeout=1):
+    def __init__(self, max_datapoints=500, timeout=1, batch_size=500,
+                 batch_delay=0, stats_file=None):
         """Init.
 
         Args:
             max_datapoints (int): The maximum number of graph datapoints to
                                   record.  If this limit is hit, datapoints
                                   will be discard based on age, oldest-first.
-            timeout (float): Frequency, in seconds, to check for a stop or
-                             remove request.
+            timeout (float): Frequency, in seconds, to harvest per-thread
+                             counter accumulators.
+            batch_size (int): The maximum number of stats to take off the
+                              queue at once.
+            batch_delay (float): How long, in seconds, to wait after a stat
+                                 arrives before draining the queue.  Raising
+                                 this lets bigger batches build up, at the
+                                 cost of stats showing up later.
+            stats_file (StatsFile): If provided, counters and graphs are
+                                    mirrored into this file after they
+                                    change.  The thread closes it on exit.
         """
         super(StatsThread, self).__init__()
         self.timeout = timeout
         self.max_datapoints = max_datapoints
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.last_harvest = 0
+        self.stats_file = stats_file
+        self.dirty_counters = set()
+        self.dirty_graphs = set()
 
-    def process_stat(self, msg):
+    def process_stat(self, msg, now=None):
         """Accepts and processes stats messages.
 
         Args:
             msg (Stat): A populated ``Stat`` object.
+            now (float): The current time, used for counter rates.  If not
+                         provided we look it up.
 
         Returns:
             None
         """
 
-        if msg.type == 'counter':
-
-            if msg.name in GRAPH_STORE:
-                error = 'Ignoring attempt to write counter stat to a name '
-                error += 'used previously for graphs.  Stat name: ' + msg.name
-                LOGGER.warning(error)
+        try:
+            if self.name_in_use(msg.name, msg.type):
                 return
 
-            if msg.action == 'incr':
-                try:
-                    COUNTER_STORE[msg.name] += msg.value
-                except KeyError:
+            if msg.type == 'counter':
+
+                if self.stats_file is not None:
+                    self.dirty_counters.add(msg.name)
+
+                if msg.action == 'incr':
+                    try:
+                        COUNTER_STORE[msg.name] += msg.value
+                    except KeyError:
+                        COUNTER_STORE[msg.name] = msg.value
+                    self.record_rate(msg.name, msg.value, now)
+
+                elif msg.action == 'put':
                     COUNTER_STORE[msg.name] = msg.value
 
-            elif msg.action == 'put':
-                COUNTER_STORE[msg.name] = msg.value
+                elif msg.action == 'decr':
+                    try:  # pragma: no cover
+                        COUNTER_STORE[msg.name] -= msg.value
+                    except KeyError:
+                        COUNTER_STORE[msg.name] = -msg.value
+                    self.record_rate(msg.name, -msg.value, now)
+
+            elif msg.type == 'graph':
+
+                if self.stats_file is not None:
+                    self.dirty_graphs.add(msg.name)
+
+                if msg.action == 'add':
+                    try:  # pragma: no cover
+                        GRAPH_STORE[msg.name].append(msg.value)
+                    except KeyError:
+                        series = GraphSeries(self.max_datapoints)
+                        GRAPH_STORE[msg.name] = series
+                        series.append(msg.value)
+
+            elif msg.type == 'histogram':
+
+                if msg.action == 'add':
+                    try:
+                        HISTOGRAM_STORE[msg.name].add(msg.value)
+                    except KeyError:
+                        HISTOGRAM_STORE[msg.name] = Histogram()
+                        HISTOGRAM_STORE[msg.name].add(msg.value)
+        except Exception:  # pylint: disable=broad-except
+            # A bad stat mustn't take StatsThread down with it
+            LOGGER.exception('Failed to process stat: %r', msg)
+
+    def record_rate(self, name, change, now=None):
+        """Records a counter change in the counter's ``RateTracker``.  Puts
+        aren't recorded, since they aren't really a rate of change.
+
+        Args:
+            name (str): The counter name.
+            change (float): The amount the counter changed by.
+            now (float): The current time.  If not provided we look it up.
+
+        Returns:
+            None
+        """
+
+        if now is None:
+            now = time.time()
+
+        try:
+            RATE_STORE[name].record(change, now)
+        except KeyError:
+            RATE_STORE[name] = RateTracker()
+            RATE_STORE[name].record(change, now)
 
-            elif msg.action == 'decr':
-                try:  # pragma: no cover
-                    COUNTER_STORE[msg.name] -= msg.value
-                except KeyError:
-                    COUNTER_STORE[msg.name] = -msg.value
+    def name_in_use(self, name, stat_type):
+        """Checks if ``name`` is already used by a different type of stat.
+        Each name can only be used for one type of stat.
+
+        Args:
+            name (str): The stat name.
+            stat_type (str): The type of stat we want to write to ``name``.
+
+        Returns:
+            bool: True if the name is taken by another stat type.
+        """
 
-        elif msg.type == 'graph':
+        stores = (('counter', COUNTER_STORE),
+                  ('graph', GRAPH_STORE),
+                  ('histogram', HISTOGRAM_STORE))
 
-            if msg.name in COUNTER_STORE:  # pragma: no cover
-                error = 'Ignoring attempt to write graph stat to a name used '
-                error += 'previously for counters.  Stat name: ' + msg.name
+        for other_type, store in stores:
+            if other_type != stat_type and name in store:
+                error = 'Ignoring attempt to write ' + stat_type + ' stat to '
+                error += 'a name used previously for ' + other_type + 's.  '
+                error += 'Stat name: ' + name
                 LOGGER.warning(error)
-                return
+                return True
+
+        return False
+
+    def process_batch(self, batch):
+        """Processes a list of stats messages in order.
+
+        Args:
+            batch (list): A list of populated ``Stat`` objects.
+
+        Returns:
+            None
+        """
+
+        process_stat = self.process_stat
+        now = time.time()
+        with STORE_LOCK:
+            for msg in batch:
+                process_stat(msg, now)
+
+    def record_dropped(self, count):
+        """Adds to the dropped stat count.  We only log the first drop, since
+        logging every drop makes a bad situation worse.
+
+        Args:
+            count (int): The number of newly dropped stats.
+
+        Returns:
+            None
+        """
+
+        if not STATS_STATUS['dropped']:
+            LOGGER.warning('Stats queue is full.  Stats are being dropped, '
+                           'see the stats command for a count.')
+        STATS_STATUS['dropped'] += count
+
+    def harvest_accumulators(self):
+        """Merges every per-thread counter accumulator into COUNTER_STORE.
+        Accumulators belonging to threads that have exited are harvested one
+        last time and then dropped.
+
+        Returns:
+            None
+        """
+
+        now = time.time()
+        self.last_harvest = now
+
+        for accumulator in list(ACCUMULATORS):
+            # Check liveness *before* harvesting so we can't miss a final
+            # write made just before the thread exited.
+            alive = accumulator.thread.is_alive()
+
+            with STORE_LOCK:
+                for msg in accumulator.harvest():
+                    self.process_stat(msg, now)
+
+            if not alive:
+                ACCUMULATORS.remove(accumulator)
+
+    def sample_gauges(self):
+        """Records any gauges that are due to be sampled to their graphs.
+
+        Returns:
+            None
+        """
+
+        now = time.time()
+
+        for name, gauge in GAUGE_STORE.items():
+            if not gauge.sample_interval or now < gauge.next_sample:
+                continue
+
+            gauge.next_sample = now + gauge.sample_interval
+
+            # Don't hold the lock while running application code
+            value = gauge.read()
+            if not isinstance(value, (int, long, float)):
+                continue
+
+            if math.isinf(value) or math.isnan(value):
+                LOGGER.debug('Gauge ' + name + ' returned ' + str(value) +
+                             ', which can\'t be graphed.')
+                continue
+
+            msg = Stat(name + SAMPLES_SUFFIX, 'graph', 'add',
+                       (int(now), int(round(value))))
+            with STORE_LOCK:
+                self.process_stat(msg, now)
+
+    def write_stats_file(self):
+        """Writes any counters and graphs that changed since the last call to
+        the stats file.  We're the only writer of the stores, so we don't
+        need STORE_LOCK to read them.
+
+        Returns:
+            None
+        """
+
+        for name in self.dirty_counters:
+            if name in COUNTER_STORE:
+                self.stats_file.write_counter(name, COUNTER_STORE[name])
+
+        for name in self.dirty_graphs:
+            if name in GRAPH_STORE:
+                self.stats_file.write_graph(name, GRAPH_STORE[name])
+
+        self.dirty_counters.clear()
+        self.dirty_graphs.clear()
+
+    def stop(self):
+        """Sets the stop_requested flag and wakes the thread up."""
+        super(StatsThread, self).stop()
+        if self.is_alive():
+            wake_stats_thread()
+
+    def wait_time(self):
+        """Works out how long we can sleep before there's periodic work to
+        do: harvesting accumulators or sampling gauges.
+
+        Returns:
+            float: Seconds to wait, or None to wait until woken.
+        """
+
+        deadlines = []
+
+        if ACCUMULATORS:
+            deadlines.append(self.last_harvest + self.timeout)
 
-            if msg.action == 'add':
-                try:  # pragma: no cover
-                    GRAPH_STORE[msg.name].append(msg.value)
-                except KeyError:
-                    GRAPH_STORE[msg.name] = deque(maxlen=self.max_datapoints)
-                    GRAPH_STORE[msg.name].append(msg.value)
+        for gauge in GAUGE_STORE.values():
+            if gauge.sample_interval:
+                deadlines.append(gauge.next_sample)
+
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.time(), 0)
 
     def run(self):
         """Main thread loop."""
@@ -108,55 +903,350 @@ class StatsThread(StoppableThread):
         LOGGER.info('Stats thread running')
 
         while True:
-            msg = None
-            try:
-                msg = STATS_QUEUE.get(timeout=self.timeout)
-            except Empty:
-                pass
+            batch = drain_queue(STATS_QUEUE, self.batch_size,
+                                self.wait_time(), self.batch_delay)
+
+            if batch:
+                self.process_batch(batch)
+                STATS_QUEUE.task_done(len(batch))
+
+            dropped = STATS_QUEUE.take_dropped()
+            if dropped:
+                self.record_dropped(dropped)
 
             if self.stop_requested:
+                self.harvest_accumulators()
+                if self.dirty_counters or self.dirty_graphs:
+                    self.write_stats_file()
+                if self.stats_file is not None:
+                    self.stats_file.close()
                 return
 
-            if msg:
-                self.process_stat(msg)
-                STATS_QUEUE.task_done()
+            if ACCUMULATORS and time.time() - self.last_harvest >= self.timeout:
+                self.harvest_accumulators()
 
-def counter_manipulation(stat):
-    """Backend to all counter changes.
+            if GAUGE_STORE:
+                self.sample_gauges()
+
+            if self.dirty_counters or self.dirty_graphs:
+                self.write_stats_file()
+
+def copy_stat(source):
+    """Copies a stat object.  Objects without a ``copy`` method (e.g. a plain
+    deque) are copied into a list.  The caller must hold STORE_LOCK.
 
     Args:
-        stat (Stat): A populated ``Stat`` object.
+        source: A graph series, histogram or rate tracker.
+
+    Returns:
+        The copy.
+    """
+
+    if hasattr(source, 'copy'):
+        return source.copy()
+    return list(source)
+
+def copy_store(store):
+    """Copies every object in ``store``.  The caller must hold STORE_LOCK.
+
+    Args:
+        store (dict): A stats store, e.g. HISTOGRAM_STORE.
+
+    Returns:
+        dict: A dict of copies, keyed by name.
+    """
+
+    copies = {}
+    for name, source in store.items():
+        copies[name] = copy_stat(source)
+    return copies
+
+def summarize_graph(series):
+    """Summarizes a graph without copying its datapoints.  The caller must
+    hold STORE_LOCK.
+
+    Args:
+        series (GraphSeries): The graph's datapoints.
+
+    Returns:
+        GraphSummary: The number of datapoints, the most recent one (or None
+                      if there aren't any), and the series' version (None if
+                      it doesn't have one).
+    """
+
+    length = len(series)
+    return GraphSummary(length=length,
+                        last=series[-1] if length else None,
+                        version=getattr(series, 'version', None))
+
+def summarize_histogram(histogram):
+    """Summarizes a histogram without copying its buckets.  The caller must
+    hold STORE_LOCK.
+
+    Args:
+        histogram (Histogram): The histogram.
+
+    Returns:
+        HistogramSummary: The number of values recorded, and the histogram's
+                          version.
+    """
+
+    return HistogramSummary(count=histogram.count, version=histogram.version)
+
+def snapshot(graphs=True, histograms=True, rates=True, gauges=True,
+             series=None, distributions=None):
+    """Returns a consistent copy of the stats stores.  Nothing in the
+    snapshot changes after it's taken, so it's safe to iterate over and to
+    hold on to.
+
+    StatsThread is paused while we copy, so graphs and histograms are only
+    summarized unless their datapoints are asked for with ``series``, or
+    their buckets with ``distributions``.  Gauges are read after StatsThread
+    is released.
+
+    Args:
+        graphs (bool): Include graph summaries.
+        histograms (bool): Include histogram summaries.
+        rates (bool): Include counter rate trackers.
+        gauges (bool): Read gauges.
+        series (list): Names of graphs to copy the datapoints of.
+        distributions (list): Names of histograms to copy.
+
+    Returns:
+        Snapshot: A namedtuple of counters, graphs (as ``GraphSummary``
+                  namedtuples), histograms (as ``HistogramSummary``
+                  namedtuples), rates, gauges (each a dict keyed by name, or
+                  None if not requested), the number of dropped stats, the
+                  time the snapshot was taken, and the requested series and
+                  distributions (dicts keyed by name, missing any that don't
+                  exist).
+    """
+
+    graph_summaries = histogram_summaries = rate_copies = gauge_values = None
+    series_copies = {}
+    distribution_copies = {}
+
+    with STORE_LOCK:
+        counters = COUNTER_STORE.copy()
+        if graphs:
+            graph_summaries = {}
+            for name, graph_series in GRAPH_STORE.items():
+                graph_summaries[name] = summarize_graph(graph_series)
+        for name in series or ():
+            if name in GRAPH_STORE:
+                series_copies[name] = copy_stat(GRAPH_STORE[name])
+        if histograms:
+            histogram_summaries = {}
+            for name, histogram in HISTOGRAM_STORE.items():
+                histogram_summaries[name] = summarize_histogram(histogram)
+        for name in distributions or ():
+            if name in HISTOGRAM_STORE:
+                distribution_copies[name] = copy_stat(HISTOGRAM_STORE[name])
+        if rates:
+            rate_copies = copy_store(RATE_STORE)
+        dropped = STATS_STATUS['dropped']
+
+    if gauges:
+        gauge_values = {}
+        for name, gauge in GAUGE_STORE.items():
+            gauge_values[name] = gauge.read()
+
+    return Snapshot(counters=counters,
+                    graphs=graph_summaries,
+                    histograms=histogram_summaries,
+                    rates=rate_copies,
+                    gauges=gauge_values,
+                    dropped=dropped,
+                    time=time.time(),
+                    series=series_copies,
+                    distributions=distribution_copies)
+
+def drain_queue(stats_queue, max_items, timeout, delay=0):
+    """Takes up to ``max_items`` off ``stats_queue`` at once, oldest first.
+    Call ``stats_queue.task_done()`` with the number taken once they've been
+    processed.
+
+    Args:
+        stats_queue (StatsQueue): The queue to drain.
+        max_items (int): The maximum number of items to take.  Counters that
+                         were coalesced while the queue was full are taken
+                         along with the last of the queued items, so there
+                         can be a few more than this.
+        timeout (float): How long to wait for an item if the queue is empty.
+                         None waits until one arrives.
+        delay (float): How long to wait after an item arrives, so more items
+                       can collect before we drain.
+
+    Returns:
+        list: The items taken, oldest first.  This is empty if the timeout
+              expired or we were woken up (see ``wake_stats_thread``).
+    """
+
+    return stats_queue.get_batch(max_items, timeout, delay)
+
+def wake_stats_thread():
+    """Wakes StatsThread up if it's waiting for stats, so it notices a stop
+    request or new periodic work.  If it isn't waiting yet, its next wait
+    returns straight away.
 
     Returns:
         None
     """
 
-    if not isinstance(stat.name, str):
+    STATS_QUEUE.wake()
+
+def restart_after_fork():
+    """Starts Eww's threads if we're a forked child that hasn't started them
+    yet.  Callers check ``FORK_STATUS['restart']`` first, so this costs
+    nothing in the common case.
+
+    Returns:
+        None
+    """
+
+    restart = FORK_STATUS['restart']
+    if restart is not None:
+        restart()
+
+def local_accumulator():
+    """Returns the calling thread's ``CounterAccumulator``, creating and
+    registering one if needed.
+
+    Returns:
+        CounterAccumulator: The accumulator for the current thread.
+    """
+
+    try:
+        return LOCAL_STATS.accumulator
+    except AttributeError:
+        if FORK_STATUS['restart'] is not None:
+            restart_after_fork()
+        accumulator = CounterAccumulator(threading.current_thread())
+        LOCAL_STATS.accumulator = accumulator
+        ACCUMULATORS.append(accumulator)
+        # StatsThread may be sleeping with nothing to harvest
+        wake_stats_thread()
+        return accumulator
+
+def validate_counter(name, amount):
+    """Validates counter arguments.
+
+    Args:
+        name (str): The name of the counter.
+        amount (int): The amount being applied to the counter.
+
+    Returns:
+        None
+
+    Raises:
+        InvalidCounterOption: Raised if ``name`` or ``amount`` are invalid.
+    """
+
+    if not isinstance(name, str):
         raise InvalidCounterOption('Name must be a string.')
 
-    if not isinstance(stat.value, int):
+    if not isinstance(amount, int):
         raise InvalidCounterOption('Amount must be an integer.')
 
-    try:
-        STATS_QUEUE.put_nowait(stat)
-    except Full:
-        LOGGER.warning('Stats queue is full.  Stat being silently dropped.')
+def accumulate_counter(name, action, amount):
+    """Applies a counter change to the current thread's accumulator rather
+    than sending it through STATS_QUEUE.  StatsThread will pick the change up
+    on its next harvest.
+
+    Args:
+        name (str): The name of the counter.
+        action (str): One of 'incr', 'put' or 'decr'.
+        amount (int): The amount to apply.
+
+    Returns:
+        None
+    """
+
+    accumulator = local_accumulator()
+    totals = accumulator.totals
+
+    if action == 'incr':
+        totals[name] = totals.get(name, 0) + amount
+    elif action == 'decr':
+        totals[name] = totals.get(name, 0) - amount
+    elif action == 'put':
+        accumulator.puts[name] = (totals.get(name, 0), amount)
+
+def sample_scale(sample_rate):
+    """Decides whether a sampled stat should be recorded.  This is called
+    before anything else, so skipped stats cost as little as possible.
+
+    Args:
+        sample_rate (float): The fraction of calls to record, between 0 and
+                             1.  If None, the rate passed to embed() is used.
+
+    Returns:
+        float: 0 if the stat should be skipped, otherwise the factor to scale
+               counter amounts by so they estimate the unsampled total.
+    """
+
+    if sample_rate is None:
+        sample_rate = STATS_CONFIG['sample_rate']
+
+    if sample_rate >= 1:
+        return 1
+
+    if random() >= sample_rate:
+        return 0
+
+    return 1.0 / sample_rate
 
-def incr(name, amount=1):
+def counter_manipulation(stat, scale=1):
+    """Backend to all counter changes.
+
+    Args:
+        stat (Stat): A populated ``Stat`` object.
+        scale (float): A factor to multiply the stat's value by, used when
+                       the stat was sampled.
+
+    Returns:
+        None
+    """
+
+    validate_counter(stat.name, stat.value)
+
+    if scale != 1:
+        stat = stat._replace(value=stat.value * scale)
+
+    if FORK_STATUS['restart'] is not None:
+        restart_after_fork()
+
+    # If the queue is full, this is coalesced with any other pending changes
+    # to the same counter rather than dropped.
+    STATS_QUEUE.put(stat)
+
+def incr(name, amount=1, sample_rate=None):
     """Increments a counter.
 
     Args:
         name (str): The name of the counter to increment.
         amount (int): The amount to increment ``name`` by.
+        sample_rate (float): The fraction of calls to record, between 0 and 1.
+                             Recorded calls are scaled up to compensate.  If
+                             not provided, the rate passed to embed() is used.
 
     Returns:
         None
     """
 
+    scale = sample_scale(sample_rate)
+    if not scale:
+        return
+
+    if STATS_CONFIG['accumulate']:
+        validate_counter(name, amount)
+        accumulate_counter(name, 'incr', amount * scale)
+        return
+
     counter_manipulation(Stat(name=name,
                               type='counter',
                               action='incr',
-                              value=amount))
+                              value=amount), scale)
 
 def put(name, amount=1):
     """Puts a counter to a specific value.
@@ -169,35 +1259,58 @@ def put(name, amount=1):
         None
     """
 
+    if STATS_CONFIG['accumulate']:
+        validate_counter(name, amount)
+        accumulate_counter(name, 'put', amount)
+        return
+
     counter_manipulation(Stat(name=name,
                               type='counter',
                               action='put',
                               value=amount))
 
-def decr(name, amount=1):
+def decr(name, amount=1, sample_rate=None):
     """Reduces a counter.
 
     Args:
         name (str): The name of the counter to decrement.
         amount (int): The value to decrement ``name`` by.
+        sample_rate (float): The fraction of calls to record, between 0 and 1.
+                             Recorded calls are scaled up to compensate.  If
+                             not provided, the rate passed to embed() is used.
     """
 
+    scale = sample_scale(sample_rate)
+    if not scale:
+        return
+
+    if STATS_CONFIG['accumulate']:
+        validate_counter(name, amount)
+        accumulate_counter(name, 'decr', amount * scale)
+        return
+
     counter_manipulation(Stat(name=name,
                               type='counter',
                               action='decr',
-                              value=amount))
+                              value=amount), scale)
 
-def graph(name, datapoint):
+def graph(name, datapoint, sample_rate=None):
     """Adds an X.Y datapoint.
 
     Args:
         name (str): The name of the graph to record a datapoint for.
         datapoint (tuple): A tuple representing an (X, Y) datapoint.
+        sample_rate (float): The fraction of calls to record, between 0 and 1.
+                             If not provided, the rate passed to embed() is
+                             used.
 
     Returns:
         None
     """
 
+    if not sample_scale(sample_rate):
+        return
+
     if not isinstance(name, str):
         raise InvalidGraphDatapoint('Name must be a string.')
 
@@ -213,13 +1326,128 @@ def graph(name, datapoint):
     except AssertionError:
         raise InvalidGraphDatapoint('Datapoint values must be integers')
 
-    try:
-        STATS_QUEUE.put_nowait(Stat(name=name,
-                                    type='graph',
-                                    action='add',
-                                    value=datapoint))
-    except Full:
-        LOGGER.warning('Stats queue is full.  Stat being silently dropped.')
+    if FORK_STATUS['restart'] is not None:
+        restart_after_fork()
+
+    # Datapoints can't be coalesced, so if the queue is full this is dropped
+    # and counted.
+    STATS_QUEUE.put(Stat(name=name,
+                         type='graph',
+                         action='add',
+                         value=datapoint))
+
+def histogram(name, value, sample_rate=None):
+    """Records a value in a histogram, e.g. a request latency.  Histograms
+    use a fixed amount of memory no matter how many values are recorded, and
+    the stats command reports their count, min, max and quantiles.
+
+    Args:
+        name (str): The name of the histogram to record a value for.
+        value (float): A finite, non-negative number.
+        sample_rate (float): The fraction of calls to record, between 0 and 1.
+                             Sampling doesn't affect quantiles, but the count
+                             and total only reflect recorded values.  If not
+                             provided, the rate passed to embed() is used.
+
+    Returns:
+        None
+    """
+
+    if not sample_scale(sample_rate):
+        return
+
+    if not isinstance(name, str):
+        raise InvalidHistogramValue('Name must be a string.')
+
+    if not isinstance(value, (int, long, float)):
+        raise InvalidHistogramValue('Value must be a number.')
+
+    if math.isinf(value) or math.isnan(value):
+        raise InvalidHistogramValue('Value must be finite.')
+
+    if value < 0:
+        raise InvalidHistogramValue('Value must not be negative.')
+
+    if FORK_STATUS['restart'] is not None:
+        restart_after_fork()
+
+    STATS_QUEUE.put(Stat(name=name,
+                         type='histogram',
+                         action='add',
+                         value=value))
+
+def record_duration(name, duration):
+    """Records a duration to a histogram with only the validation a duration
+    needs.  This is the fast path used by ``Timer``.
+
+    Args:
+        name (str): The name of the histogram.
+        duration (float): The duration in milliseconds.
+
+    Returns:
+        None
+    """
+
+    # A broken clock can produce these, and a histogram can't hold them
+    if math.isinf(duration) or math.isnan(duration):
+        return
+
+    if FORK_STATUS['restart'] is not None:
+        restart_after_fork()
+
+    STATS_QUEUE.put(Stat(name, 'histogram', 'add', duration))
+
+def timer(name, sample_rate=None):
+    """Returns a ``Timer`` that records durations, in milliseconds, to the
+    histogram ``name``.  It can be used as a context manager or a decorator.
+
+    Args:
+        name (str): The name of the histogram to record durations to.
+        sample_rate (float): The fraction of calls to time, between 0 and 1.
+                             If not provided, the rate passed to embed() is
+                             used.
+
+    Returns:
+        Timer: A new timer.
+    """
+
+    return Timer(name, sample_rate)
+
+def gauge(name, func, sample_interval=None):
+    """Registers a gauge: a value that's read by calling ``func`` only when
+    it's displayed or exported, so it costs nothing while nobody is looking.
+    Registering a name again replaces the previous gauge.
+
+    Args:
+        name (str): The name of the gauge.
+        func (callable): Called with no arguments to read the value.
+        sample_interval (float): If provided, the stats thread also reads the
+                                 gauge every ``sample_interval`` seconds and
+                                 records it to a graph named ``name``
+                                 followed by ``.samples``.  The
+                                 graph's X values are unix timestamps.
+
+    Returns:
+        None
+    """
+
+    if not isinstance(name, str):
+        raise InvalidGaugeOption('Name must be a string.')
+
+    if not callable(func):
+        raise InvalidGaugeOption('Gauge must be callable.')
+
+    if sample_interval is not None and sample_interval <= 0:
+        raise InvalidGaugeOption('Sample interval must be positive.')
+
+    if FORK_STATUS['restart'] is not None:
+        restart_after_fork()
+
+    GAUGE_STORE[name] = Gauge(func, sample_interval)
+
+    if sample_interval is not None:
+        # StatsThread may be sleeping with nothing to sample
+        wake_stats_thread()
 
 def memory_consumption():
     """Returns memory consumption (specifically, max rss). Currently this
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.statsfile
+    ~~~~~~~~~~~~~
+
+    Mirrors counters and graphs into a memory-mapped file with a fixed
+    layout, so other processes can read them without connecting to Eww.
+
+    The file is laid out as a header followed by fixed-size counter slots and
+    fixed-size graph slots.  Every slot starts with a sequence number that the
+    writer makes odd while it updates the slot and even when it's done.  A
+    reader that sees an odd sequence number, or a different one before and
+    after reading, retries.  There is a single writer (StatsThread).
+
+    Graph slots hold a copy of the graph's ring buffer, in the same order, so
+    only the datapoints added since the last write need to be copied.
+
+"""
+
+from array import array
+import errno
+import glob
+import logging
+import mmap
+import os
+import struct
+
+from .cloexec import set_cloexec_duplicates
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = 'EWWSTATS'
+SCHEMA_VERSION = 2
+
+# magic, schema version, pid, counter slots, graph slots, max datapoints,
+# size of a graph datapoint value in bytes
+HEADER = struct.Struct('=8sIIIIII')
+
+NAME_SIZE = 64
+SEQUENCE = struct.Struct('=Q')
+# sequence, name, whether the value is a float, integer value, float value.
+# Integers are kept separately since a double can't hold them exactly above
+# 2 ** 53.
+COUNTER = struct.Struct('=Q64s?qd')
+INTEGER_RANGE = (-2 ** 63, 2 ** 63 - 1)
+# sequence, name, datapoint count, index of the oldest datapoint
+GRAPH_HEADER = struct.Struct('=Q64sII')
+
+READ_RETRIES = 100
+
+class StatsFileError(Exception):
+    """Raised when a stats file can't be read."""
+    pass
+
+def graph_slot_size(max_datapoints, item_size):
+    """Returns the size of a graph slot in bytes.
+
+    Args:
+        max_datapoints (int): The number of datapoints a slot can hold.
+        item_size (int): The size of one X or Y value.
+
+    Returns:
+        int: The slot size.
+    """
+
+    return GRAPH_HEADER.size + 2 * max_datapoints * item_size
+
+class StatsFile(object):
+    """The writing side of a stats file.  Only StatsThread should use this."""
+
+    def __init__(self, path, max_datapoints=500, counter_slots=1024,
+                 graph_slots=64):
+        """Init.  Creates and maps the file, replacing any file already at
+        ``path``.
+
+        Args:
+            path (str): Where to create the file.  ``%(pid)s`` is replaced
+                        with our PID.
+            max_datapoints (int): The number of datapoints each graph slot
+                                  holds.  Should match StatsThread's.
+            counter_slots (int): The maximum number of counters stored.
+            graph_slots (int): The maximum number of graphs stored.
+        """
+        self.pid = os.getpid()
+        self.path = path % {'pid': self.pid}
+        self.max_datapoints = max_datapoints
+        self.counter_slots = counter_slots
+        self.graph_slots = graph_slots
+        self.item_size = array('l').itemsize
+
+        self.counter_offset = HEADER.size
+        self.graph_offset = self.counter_offset + counter_slots * COUNTER.size
+        self.graph_size = graph_slot_size(max_datapoints, self.item_size)
+        self.size = self.graph_offset + graph_slots * self.graph_size
+
+        # name -> slot index
+        self.counters = {}
+        self.graphs = {}
+        # graph name -> (series, version) as of the last write
+        self.written = {}
+        self.full_warned = False
+
+        temp_path, fd = self.create_temp()
+        try:
+            try:
+                os.ftruncate(fd, self.size)
+                self.map = mmap.mmap(fd, self.size, mmap.MAP_SHARED,
+                                     mmap.PROT_READ | mmap.PROT_WRITE)
+                # mmap keeps its own duplicate of fd open, and Python 2
+                # can't open files close-on-exec.
+                set_cloexec_duplicates(fd)
+            finally:
+                os.close(fd)
+
+            self.map[0:HEADER.size] = HEADER.pack(MAGIC, SCHEMA_VERSION,
+                                                  self.pid, counter_slots,
+                                                  graph_slots, max_datapoints,
+                                                  self.item_size)
+
+            # Readers only ever see a complete file, and anything already at
+            # our path (even a symlink) is replaced rather than written
+            # through.
+            os.rename(temp_path, self.path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def create_temp(self):
+        """Creates a new file next to ``self.path`` to set up before moving
+        it into place.  It's created exclusively, and symlinks aren't
+        followed, so nobody can point us at another file.
+
+        Returns:
+            tuple: The file's path and an open file descriptor.
+
+        Raises:
+            OSError: If the file can't be created.
+        """
+
+        directory, filename = os.path.split(self.path)
+        flags = (os.O_RDWR | os.O_CREAT | os.O_EXCL |
+                 getattr(os, 'O_NOFOLLOW', 0))
+
+        while True:
+            # Hidden, so read_stats_files doesn't pick it up
+            temp_path = os.path.join(directory, '.' + filename + '.' +
+                                     os.urandom(6).encode('hex'))
+            try:
+                return temp_path, os.open(temp_path, flags, 0600)
+            except OSError as exception:  # pragma: no cover
+                if exception.errno != errno.EEXIST:
+                    raise
+
+    def begin(self, offset):
+        """Marks the slot at ``offset`` as being written.
+
+        Returns:
+            int: The (odd) sequence number now in the slot.
+        """
+
+        sequence = SEQUENCE.unpack_from(self.map, offset)[0] + 1
+        SEQUENCE.pack_into(self.map, offset, sequence)
+        return sequence
+
+    def end(self, offset, sequence):
+        """Marks the slot at ``offset`` as consistent again."""
+        SEQUENCE.pack_into(self.map, offset, sequence + 1)
+
+    def slot(self, slots, name, limit):
+        """Finds or allocates the slot for ``name``.
+
+        Args:
+            slots (dict): ``self.counters`` or ``self.graphs``.
+            name (str): The stat name.
+            limit (int): How many slots there are.
+
+        Returns:
+            int: The slot index, or None if there's no room.
+        """
+
+        try:
+            return slots[name]
+        except KeyError:
+            pass
+
+        if len(slots) >= limit:
+            if not self.full_warned:
+                LOGGER.warning('Stats file is full, some stats will not be '
+                               'written to it.')
+                self.full_warned = True
+            return None
+
+        slots[name] = len(slots)
+        return slots[name]
+
+    def write_counter(self, name, value):
+        """Writes a counter.
+
+        Args:
+            name (str): The counter name.
+            value (int or float): The counter's value.  Integers too big for
+                                  64 bits are written as floats.
+
+        Returns:
+            None
+        """
+
+        index = self.slot(self.counters, name, self.counter_slots)
+        if index is None:
+            return
+
+        if (isinstance(value, (int, long)) and
+                INTEGER_RANGE[0] <= value <= INTEGER_RANGE[1]):
+            is_float, integer, real = False, value, 0.0
+        else:
+            is_float, integer, real = True, 0, float(value)
+
+        offset = self.counter_offset + index * COUNTER.size
+        sequence = self.begin(offset)
+        COUNTER.pack_into(self.map, offset, sequence, name[:NAME_SIZE],
+                          is_float, integer, real)
+        self.end(offset, sequence)
+
+    def write_graph(self, name, series):
+        """Writes a graph.  Only ``GraphSeries`` can be written, since we copy
+        its arrays straight into the file.  Only the datapoints added since
+        the last write are copied, unless it's a different series or more
+        have been added than it holds.
+
+        Args:
+            name (str): The graph name.
+            series (GraphSeries): The graph.
+
+        Returns:
+            None
+        """
+
+        if not hasattr(series, 'x_values'):
+            return
+
+        index = self.slot(self.graphs, name, self.graph_slots)
+        if index is None:
+            return
+
+        count = min(len(series.x_values), self.max_datapoints)
+        start = series.start % max(count, 1)
+
+        written_series, written_version = self.written.get(name, (None, 0))
+        added = series.version - written_version
+        if written_series is not series or not 0 <= added < count:
+            added = count
+        self.written[name] = (series, series.version)
+
+        offset = self.graph_offset + index * self.graph_size
+        sequence = self.begin(offset)
+        GRAPH_HEADER.pack_into(self.map, offset, sequence, name[:NAME_SIZE],
+                               count, start)
+
+        # The newest datapoint is just before the oldest, so the ones we need
+        # to copy end there, and may wrap around to the end of the buffer.
+        last = (start - 1) % max(count, 1)
+        first = last - added + 1
+        if first >= 0:
+            self.copy_datapoints(offset, series, first, last + 1)
+        else:
+            self.copy_datapoints(offset, series, count + first, count)
+            self.copy_datapoints(offset, series, 0, last + 1)
+
+        self.end(offset, sequence)
+
+    def copy_datapoints(self, offset, series, begin, end):
+        """Copies a range of a series' buffer into its graph slot.
+
+        Args:
+            offset (int): The offset of the graph slot.
+            series (GraphSeries): The graph.
+            begin (int): The first index to copy.
+            end (int): One past the last index to copy.
+
+        Returns:
+            None
+        """
+
+        if begin >= end:
+            return
+
+        item_size = self.item_size
+        x_offset = offset + GRAPH_HEADER.size + begin * item_size
+        y_offset = x_offset + self.max_datapoints * item_size
+        length = (end - begin) * item_size
+
+        self.map[x_offset:x_offset + length] = \
+            series.x_values[begin:end].tostring()
+        self.map[y_offset:y_offset + length] = \
+            series.y_values[begin:end].tostring()
+
+    def close(self):
+        """Unmaps and removes the file.
+
+        Returns:
+            None
+        """
+
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:  # pragma: no cover
+            pass
+
+def read_slot(data, offset, read):
+    """Reads a slot, retrying until we get a consistent copy.
+
+    Args:
+        data (mmap): The mapped file.
+        offset (int): The offset of the slot.
+        read (callable): Called with no arguments to read the slot's
+                         contents.
+
+    Returns:
+        The return value of ``read``, or None if the slot is empty.
+
+    Raises:
+        StatsFileError: If the slot never becomes consistent.
+    """
+
+    for _ in xrange(READ_RETRIES):
+        before = SEQUENCE.unpack_from(data, offset)[0]
+        if not before:
+            return None
+        if before % 2:
+            continue
+        result = read()
+        if SEQUENCE.unpack_from(data, offset)[0] == before:
+            return result
+
+    raise StatsFileError('Stats file is being written too quickly to read.')
+
+def read_stats_file(path):
+    """Reads a stats file written by another process.
+
+    Args:
+        path (str): The file to read.
+
+    Returns:
+        tuple: The writer's PID, a dict of counters, and a dict of graphs
+               (each a list of (X, Y) tuples, oldest first).
+
+    Raises:
+        StatsFileError: If the file isn't a stats file.
+    """
+
+    with open(path, 'rb') as stats_file:
+        try:
+            data = mmap.mmap(stats_file.fileno(), 0, mmap.MAP_SHARED,
+                             mmap.PROT_READ)
+        except (mmap.error, ValueError) as exception:
+            raise StatsFileError('Could not map stats file: ' +
+                                 str(exception))
+
+    try:
+        if len(data) < HEADER.size:
+            raise StatsFileError('Not a stats file.')
+
+        (magic, version, pid, counter_slots, graph_slots, max_datapoints,
+         item_size) = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != SCHEMA_VERSION:
+            raise StatsFileError('Not a stats file, or an unsupported version.')
+        if item_size != array('l').itemsize:
+            raise StatsFileError('Stats file was written on another platform.')
+
+        counters = {}
+        for index in xrange(counter_slots):
+            offset = HEADER.size + index * COUNTER.size
+            slot = read_slot(data, offset,
+                             lambda: COUNTER.unpack_from(data, offset))
+            if slot is None:
+                break
+            _, name, is_float, integer, real = slot
+            counters[name.rstrip('\0')] = real if is_float else integer
+
+        graphs = {}
+        graph_offset = HEADER.size + counter_slots * COUNTER.size
+        graph_size = graph_slot_size(max_datapoints, item_size)
+
+        def read_graph(offset):
+            """Reads the graph slot at ``offset``."""
+            _, name, count, start = GRAPH_HEADER.unpack_from(data, offset)
+            x_offset = offset + GRAPH_HEADER.size
+            y_offset = x_offset + max_datapoints * item_size
+            x_values = array('l', data[x_offset:x_offset + count * item_size])
+            y_values = array('l', data[y_offset:y_offset + count * item_size])
+            order = range(start, count) + range(0, start)
+            return name, [(x_values[i], y_values[i]) for i in order]
+
+        for index in xrange(graph_slots):
+            offset = graph_offset + index * graph_size
+            slot = read_slot(data, offset, lambda: read_graph(offset))
+            if slot is None:
+                break
+            graphs[slot[0].rstrip('\0')] = slot[1]
+    finally:
+        data.close()
+
+    return pid, counters, graphs
+
+def pid_alive(pid):
+    """Checks if a process exists.
+
+    Args:
+        pid (int): The process ID.
+
+    Returns:
+        bool: False if there is definitely no such process.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError as exception:
+        return exception.errno != errno.ESRCH
+    return True
+
+def read_stats_files(path):
+    """Reads the stats files of every process using a stats file template,
+    e.g. every worker of a pre-forking server.  Files that can't be read are
+    skipped.  Files left behind by processes that exited without removing
+    Eww are skipped and removed.
+
+    Args:
+        path (str): The stats file template passed to embed, containing
+                    ``%(pid)s``.
+
+    Returns:
+        dict: (counters, graphs) tuples, keyed by PID.  See
+              ``read_stats_file``.
+    """
+
+    results = {}
+
+    for filename in glob.glob(path % {'pid': '*'}):
+        try:
+            pid, counters, graphs = read_stats_file(filename)
+        except (EnvironmentError, StatsFileError) as exception:
+            LOGGER.debug('Skipping stats file ' + filename + ': ' +
+                         str(exception))
+            continue
+
+        if not pid_alive(pid):
+            try:
+                os.unlink(filename)
+            except OSError as exception:
+                LOGGER.debug('Could not remove stale stats file ' +
+                             filename + ': ' + str(exception))
+            continue
+
+        results[pid] = (counters, graphs)
+
+    return results
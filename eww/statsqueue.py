@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.statsqueue
+    ~~~~~~~~~~~~~~
+
+    The queue that carries stats from the application's threads to
+    StatsThread.
+
+    It's a bounded deque behind a single lock.  StatsThread takes everything
+    waiting in one go, so it only takes the lock once per batch.  When the
+    queue is full, counter changes are coalesced per counter rather than
+    dropped, and are handed to StatsThread after everything that was queued
+    before them, so a ``put`` can't be applied ahead of an older ``incr``.
+    Other stats can't be coalesced, so they're dropped and counted.
+
+"""
+
+from collections import namedtuple, deque
+import threading
+import time
+
+Stat = namedtuple('Stat', 'name type action value')
+
+class StatsQueue(object):
+    """A bounded queue of ``Stat`` messages.  Any thread can put, but only
+    StatsThread should take.
+    """
+
+    def __init__(self, maxsize=500):
+        """Init.
+
+        Args:
+            maxsize (int): The most stats held before counters are coalesced
+                           and other stats are dropped.
+        """
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+        self.queue = deque()
+        # Counter changes that arrived while we were full, as
+        # name -> [change before any put, put value or None, change after]
+        self.overflow = {}
+        # Stats taken by StatsThread that it hasn't finished with
+        self.unfinished = 0
+        self.dropped = 0
+        self.wakeup = False
+
+    def qsize(self):
+        """Returns the number of stats queued, not counting coalesced
+        counters.
+        """
+        return len(self.queue)
+
+    def empty(self):
+        """Returns True if there's nothing waiting for StatsThread."""
+        return not self.queue and not self.overflow
+
+    def full(self):
+        """Returns True if new stats would be coalesced or dropped."""
+        return len(self.queue) >= self.maxsize
+
+    def put(self, stat):
+        """Queues a stat without blocking.
+
+        Args:
+            stat (Stat): The stat.
+
+        Returns:
+            bool: False if the stat was dropped because we're full.
+        """
+
+        with self.lock:
+            is_counter = stat.type == 'counter'
+
+            # A counter with changes waiting in overflow has to join them,
+            # or it would be applied first.
+            if ((not is_counter or stat.name not in self.overflow) and
+                    len(self.queue) < self.maxsize):
+                self.queue.append(stat)
+                self.not_empty.notify()
+                return True
+
+            if not is_counter:
+                self.dropped += 1
+                return False
+
+            self.coalesce(stat)
+            self.not_empty.notify()
+            return True
+
+    def coalesce(self, stat):
+        """Merges a counter change into ``overflow``.  The caller must hold
+        ``lock``.
+
+        Args:
+            stat (Stat): A counter stat.
+
+        Returns:
+            None
+        """
+
+        try:
+            entry = self.overflow[stat.name]
+        except KeyError:
+            entry = self.overflow[stat.name] = [0, None, 0]
+
+        if stat.action == 'put':
+            entry[1] = stat.value
+            entry[2] = 0
+            return
+
+        change = stat.value if stat.action == 'incr' else -stat.value
+        if entry[1] is None:
+            entry[0] += change
+        else:
+            entry[2] += change
+
+    def take_overflow(self, batch):
+        """Moves the coalesced counters into ``batch``.  The caller must hold
+        ``lock``.
+
+        Args:
+            batch (list): Where to append the stats.
+
+        Returns:
+            None
+        """
+
+        for name, (before, value, after) in self.overflow.iteritems():
+            if before:
+                batch.append(Stat(name, 'counter', 'incr', before))
+            if value is not None:
+                batch.append(Stat(name, 'counter', 'put', value))
+            if after:
+                batch.append(Stat(name, 'counter', 'incr', after))
+        self.overflow.clear()
+
+    def get_batch(self, max_items, timeout, delay=0):
+        """Takes up to ``max_items`` stats, oldest first.  Coalesced counters
+        are only taken once everything queued before them has been, so the
+        batch can be a little bigger than ``max_items``.  Call ``task_done``
+        once the batch has been processed.
+
+        Args:
+            max_items (int): The maximum number of queued stats to take.
+                             Values below 1 are taken to be 1.
+            timeout (float): How long to wait for a stat if there are none.
+                             None waits until one arrives or we're woken.
+            delay (float): How long to wait after a stat arrives, so more can
+                           collect before we take them.
+
+        Returns:
+            list: The stats taken.  Empty if the timeout expired or we were
+                  woken up.
+        """
+
+        batch = []
+        # Taking nothing would leave the queue full, and our caller spinning
+        max_items = max(max_items, 1)
+
+        with self.lock:
+            if self.empty() and not self.wakeup:
+                self.not_empty.wait(timeout)
+            self.wakeup = False
+
+            if self.empty():
+                return batch
+
+            if delay:
+                # Let more stats collect without holding the lock
+                self.lock.release()
+                try:
+                    time.sleep(delay)
+                finally:
+                    self.lock.acquire()
+
+            queue = self.queue
+            while queue and len(batch) < max_items:
+                batch.append(queue.popleft())
+            if not queue and self.overflow:
+                self.take_overflow(batch)
+
+            self.unfinished += len(batch)
+
+        return batch
+
+    def task_done(self, count):
+        """Marks stats taken by ``get_batch`` as processed.
+
+        Args:
+            count (int): How many were processed.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.unfinished = max(self.unfinished - count, 0)
+            if not self.unfinished:
+                self.all_done.notify_all()
+
+    def join(self):
+        """Waits until every queued stat has been processed.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            while self.queue or self.overflow or self.unfinished:
+                self.all_done.wait()
+
+    def take_dropped(self):
+        """Returns the number of stats dropped since the last call.
+
+        Returns:
+            int: The number dropped.
+        """
+
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+    def wake(self):
+        """Makes StatsThread's current or next ``get_batch`` return straight
+        away, so it notices a stop request or new periodic work.
+
+        Returns:
+            None
+        """
+
+        with self.lock:
+            self.wakeup = True
+            self.not_empty.notify()
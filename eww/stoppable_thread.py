@@ -8,8 +8,13 @@
 
 """
 
+import errno
+import os
+import select
 import threading
 
+from .cloexec import set_cloexec
+
 class StoppableThread(threading.Thread):
     """Thread class that adds a stop() method.  Subclasses *must* check for the
     .stop_requested event regularly.
@@ -23,3 +28,77 @@ class StoppableThread(threading.Thread):
     def stop(self):
         """Sets the stop_requested flag."""
         self.stop_requested = True
+
+class WakeableThread(StoppableThread):
+    """A StoppableThread for threads that block in poll().  Subclasses
+    register ``.wakeup_fd`` with their poller, and stop() makes it readable,
+    so they can block indefinitely instead of waking up regularly to check
+    .stop_requested.  Subclasses must call close_wakeup() on exit.
+    """
+
+    def __init__(self):
+        """Init."""
+        super(WakeableThread, self).__init__()
+        self.wakeup_fd, self.wakeup_write_fd = os.pipe()
+        set_cloexec(self.wakeup_fd)
+        set_cloexec(self.wakeup_write_fd)
+        self.wakeup_lock = threading.Lock()
+
+    def make_poller(self, *fds):
+        """Creates a poller watching ``.wakeup_fd`` and ``fds`` for input.
+        We use poll() rather than select() since select() can't handle
+        descriptors at or above ``FD_SETSIZE``, which busy applications
+        reach.
+
+        Args:
+            *fds: File descriptors, or objects with a ``fileno()`` method.
+
+        Returns:
+            select.poll: The poller.
+        """
+
+        poller = select.poll()
+        for fd in (self.wakeup_fd,) + fds:
+            poller.register(fd, select.POLLIN)
+        return poller
+
+    @staticmethod
+    def wait_readable(poller, timeout=None):
+        """Waits for input on a poller, retrying if interrupted.
+
+        Args:
+            poller (select.poll): The poller.
+            timeout (float): Seconds to wait, or None to wait indefinitely.
+
+        Returns:
+            list: The file descriptors that are readable, or have hung up.
+        """
+
+        if timeout is not None:
+            timeout *= 1000
+
+        while True:
+            try:
+                return [fd for fd, _ in poller.poll(timeout)]
+            except select.error as exception:  # pragma: no cover
+                if exception.args[0] != errno.EINTR:
+                    raise
+
+    def stop(self):
+        """Sets the stop_requested flag and wakes the thread up."""
+        super(WakeableThread, self).stop()
+        self.wake()
+
+    def wake(self):
+        """Makes ``.wakeup_fd`` readable.  Subclasses should drain it."""
+        with self.wakeup_lock:
+            if self.wakeup_write_fd is not None:
+                os.write(self.wakeup_write_fd, 'x')
+
+    def close_wakeup(self):
+        """Closes the wakeup pipe.  stop() is safe to call afterwards."""
+        with self.wakeup_lock:
+            if self.wakeup_write_fd is not None:
+                os.close(self.wakeup_fd)
+                os.close(self.wakeup_write_fd)
+                self.wakeup_write_fd = None
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    eww.threadinfo
+    ~~~~~~~~~~~~~~
+
+    Collects what every thread is doing, and how much CPU time it has used.
+
+    CPU times come from ``/proc/self/task/<tid>/stat``, so they're only
+    available on Linux.  Python identifies threads by their ``pthread_t``
+    rather than the kernel's thread ID, so on Pythons without
+    ``Thread.native_id`` we ask ``pthread_getcpuclockid`` for the thread's
+    CPU clock, which has the thread ID encoded in it.
+
+"""
+
+from collections import namedtuple
+import gc
+import glob
+import logging
+import os
+import sys
+import threading
+try:
+    import ctypes
+except ImportError:  # pragma: no cover
+    # Some minimal builds don't have ctypes
+    pass
+
+LOGGER = logging.getLogger(__name__)
+
+ThreadInfo = namedtuple('ThreadInfo', 'name ident native_id daemon cpu frame')
+
+try:
+    CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    # We're on Windows
+    CLOCK_TICKS = None
+
+# Long enough that no other thread gets to run while it's in effect
+FROZEN_CHECK_INTERVAL = 2 ** 30
+
+def load_getcpuclockid():
+    """Finds ``pthread_getcpuclockid``.
+
+    Returns:
+        The ctypes function, or None if it isn't available.
+    """
+
+    if 'ctypes' not in sys.modules:  # pragma: no cover
+        return None
+
+    try:
+        # PyDLL holds the GIL during the call, so the thread can't finish
+        # exiting underneath us.
+        libc = ctypes.PyDLL(None)
+        getcpuclockid = libc.pthread_getcpuclockid
+    except (AttributeError, OSError):  # pragma: no cover
+        return None
+
+    getcpuclockid.argtypes = [ctypes.c_ulong, ctypes.POINTER(ctypes.c_int)]
+    getcpuclockid.restype = ctypes.c_int
+    return getcpuclockid
+
+GETCPUCLOCKID = load_getcpuclockid()
+
+def native_thread_id(thread):
+    """Finds the kernel's ID for a thread.
+
+    Args:
+        thread (Thread): A running thread.
+
+    Returns:
+        int: The thread ID, or None if it can't be found.
+    """
+
+    native_id = getattr(thread, 'native_id', None)
+    if native_id is not None:  # pragma: no cover
+        return native_id
+
+    if GETCPUCLOCKID is None or thread.ident is None:  # pragma: no cover
+        return None
+
+    clock_id = ctypes.c_int()
+    if GETCPUCLOCKID(thread.ident, ctypes.byref(clock_id)) != 0:
+        return None
+
+    # Linux encodes per-thread CPU clocks as (~tid << 3) | 6
+    if clock_id.value & 7 != 6:  # pragma: no cover
+        return None
+    return ~(clock_id.value >> 3)
+
+def task_cpu_times():
+    """Reads the CPU time used by each of our threads.
+
+    Returns:
+        dict: User plus system CPU seconds, keyed by thread ID.  Empty if
+              ``/proc`` isn't available.
+    """
+
+    times = {}
+
+    if CLOCK_TICKS is None:  # pragma: no cover
+        return times
+
+    for path in glob.glob('/proc/self/task/*/stat'):
+        try:
+            with open(path) as stat_file:
+                stat = stat_file.read()
+        except IOError:
+            # The thread exited
+            continue
+
+        # The command name can contain spaces, so split after it.  utime and
+        # stime are the 14th and 15th fields.
+        fields = stat[stat.rindex(')') + 2:].split()
+        try:
+            tid = int(os.path.basename(os.path.dirname(path)))
+            times[tid] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (IndexError, ValueError):  # pragma: no cover
+            continue
+
+    return times
+
+def thread_info():
+    """Collects the name, IDs, CPU time and current frame of every thread.
+    Threads that Python doesn't know about, such as those started by C
+    extensions, are included with a name of ``[native]``.
+
+    Returns:
+        list: ThreadInfo namedtuples.  ``cpu`` is None if it couldn't be
+              read, and ``frame`` is None for native threads.
+    """
+
+    # Reading /proc and enumerating threads can both release the GIL, so
+    # they're done first.
+    times = task_cpu_times()
+    running = threading.enumerate()
+    native_ids = {}
+
+    # A thread that exits frees its pthread_t, so between finding it in
+    # the frames and asking for its clock, don't let another thread run.
+    collecting = gc.isenabled()
+    gc.disable()
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(FROZEN_CHECK_INTERVAL)
+    try:
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        for thread in running:
+            if thread.ident in frames:
+                native_ids[thread.ident] = native_thread_id(thread)
+    finally:
+        sys.setcheckinterval(interval)
+        if collecting:
+            gc.enable()
+
+    threads = []
+    seen = set()
+
+    for thread in running:
+        native_id = native_ids.get(thread.ident)
+        seen.add(native_id)
+        threads.append(ThreadInfo(thread.name, thread.ident, native_id,
+                                  thread.daemon, times.get(native_id),
+                                  frames.get(thread.ident)))
+
+    # Anything we couldn't match up is only worth showing if we matched the
+    # rest.
+    if None not in seen:
+        for tid in sorted(times):
+            if tid not in seen:
+                threads.append(ThreadInfo('[native]', None, tid, None,
+                                          times[tid], None))
+
+    return threads
@@ -0,0 +1 @@
+eww-stat
\ No newline at end of file
@@ -14,7 +14,7 @@ setup(name='eww',
       long_description = open('README.rst').read(),
       packages = ['eww'],
       install_requires=['pygal == 1.5.0'],
-      scripts = ['scripts/eww'],
+      scripts = ['scripts/eww', 'scripts/eww-stat'],
       classifiers = ['Development Status :: 4 - Beta',
                      'Environment :: Console',
                      'Intended Audience :: Developers',
@@ -7,8 +7,16 @@
 
 """
 
+import os
+import socket
+import sys
+import tempfile
+import time
+
 import eww
+import eww.statsfile
 from scripts import eww as client
+from scripts import eww_stat
 from utils import *
 
 def test_eww_client():
@@ -115,6 +123,46 @@ def test_get_input():
 
     eww.remove()
 
+def test_streaming_input():
+    """Tests that typed lines are only forwarded while a command is streaming.
+    """
+
+    eww.embed(timeout=0.01)
+    assert expected_thread_count(3)
+
+    eww_client = connect_via_client()
+    with CaptureOutput(proxy=True):
+        eww_client.display_output()
+
+    read_fd, write_fd = os.pipe()
+    typed = os.fdopen(read_fd)
+    sys.stdin.register(typed)
+
+    try:
+        # A line typed while an ordinary command runs waits for the prompt
+        os.write(write_fd, 'typed ahead\n')
+        eww_client.get_input(line='help')
+        with CaptureOutput(proxy=True):
+            eww_client.display_output()
+        assert not eww_client.streaming
+        assert typed.readline() == 'typed ahead\n'
+
+        # During a watch it's forwarded, which stops the watch
+        os.write(write_fd, '\n')
+        eww_client.get_input(line='stats --watch 0.05')
+        with CaptureOutput(proxy=True) as output:
+            eww_client.display_output()
+        assert client.STOP_HINT in output.stdout.getvalue()
+        assert eww_client.current_prompt == '(eww) '
+        assert not eww_client.streaming
+    finally:
+        sys.stdin.unregister()
+        typed.close()
+        os.close(write_fd)
+
+    eww_client.sock.close()
+    eww.remove()
+
 def test_clientloop():
     """Tests client.EwwClient.clientloop().  We test each part on it's own, so
     This is just a sanity check to make sure we don't raise.
@@ -160,3 +208,58 @@ def test_main():
     output = output.stdout.getvalue()
 
     assert output == 'Connection refused.\n'
+
+def test_unix_socket():
+    """Tests connecting to eww over a unix socket by PID."""
+
+    template = os.path.join(tempfile.mkdtemp(), 'eww-%(pid)s.sock')
+    path = template % {'pid': os.getpid()}
+
+    # A stale socket is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    eww.embed(timeout=0.01, unix_socket=template)
+    assert expected_thread_count(3)
+
+    opt_args = ['--unix-socket', template, '--pid', str(os.getpid())]
+    with CaptureOutput(proxy=True) as output:
+        for _ in range(20):
+            try:
+                client.main(debug=True, line='exit', opt_args=opt_args)
+                break
+            except SystemExit:
+                time.sleep(0.1)
+    output = output.stdout.getvalue()
+
+    assert 'PID' in output
+    assert oct(os.stat(path).st_mode & 0777) == '0600'
+
+    eww.remove()
+    assert not os.path.exists(path)
+
+def test_eww_stat():
+    """Tests reading a stats file with eww-stat."""
+
+    path = os.path.join(tempfile.mkdtemp(), 'eww.stats')
+    stats_file = eww.statsfile.StatsFile(path)
+    stats_file.write_counter('stat_counter', 5)
+
+    with CaptureOutput() as output:
+        assert eww_stat.main([path]) == 0
+    assert output.stdout.getvalue() == ('PID ' + str(os.getpid()) + '\n'
+                                        'Counters:\n  stat_counter:5\n')
+
+    with CaptureOutput() as output:
+        assert eww_stat.main([path, 'stat_counter']) == 0
+    assert output.stdout.getvalue() == '5\n'
+
+    with CaptureOutput() as output:
+        assert eww_stat.main([path, 'missing']) == 1
+
+    stats_file.close()
+
+    with CaptureOutput() as output:
+        assert eww_stat.main([path]) == 1
+    assert 'Could not read stats file' in output.stdout.getvalue()
@@ -10,8 +10,10 @@
 from collections import deque
 from mock import Mock
 import os
+import pstats
 import socket
 import sys
+import tempfile
 import time
 import threading
 import __builtin__
@@ -21,6 +23,14 @@ from nose.tools import assert_raises
 import eww
 from eww.shared import DISPATCH_THREAD_NAME, STATS_THREAD_NAME
 from eww.stats import InvalidCounterOption, InvalidGraphDatapoint
+from eww.stats import InvalidGaugeOption, InvalidHistogramValue
+import eww.dispatch
+import eww.exporter
+import eww.memory
+import eww.profiler
+import eww.statsfile
+import eww.stoppable_thread
+import eww.threadinfo
 from utils import *
 
 def test_embed_cycle():
@@ -393,6 +403,13 @@ def test_double_bind():
     eww.embed(timeout=0.01, port = 10001)
     assert expected_thread_count(2)
 
+    # The event console's wakeup pipe isn't leaked
+    dispatch = eww.dispatch.DispatchThread('localhost', 10001,
+                                           console_engine='event')
+    dispatch.run()
+    assert dispatch.wakeup_write_fd is None
+    assert dispatch.pool.wakeup_write_fd is None
+
     blocker_socket.close()
     eww.remove()
 
@@ -659,6 +676,8 @@ def test_queue():
     eww.shared.COUNTER_STORE.clear()
     eww.shared.GRAPH_STORE.clear()
     eww.shared.STATS_QUEUE.queue.clear()
+    del eww.shared.ACCUMULATORS[:]
+    eww.stats.LOCAL_STATS.__dict__.clear()
 
 def test_graphs():
     """Tests various graph functions."""
@@ -691,3 +710,1407 @@ def test_graphs():
     eww.shared.COUNTER_STORE.clear()
     eww.shared.GRAPH_STORE.clear()
     eww.shared.STATS_QUEUE.queue.clear()
+
+def test_accumulated_counters():
+    """Tests counters recorded through per-thread accumulators."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+    eww.shared.STATS_CONFIG['accumulate'] = True
+
+    stats_thread = eww.stats.StatsThread(max_datapoints=5, timeout=0.01)
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    eww.incr('acc1')
+    eww.incr('acc1', 4)
+    eww.decr('acc2', 2)
+    eww.put('acc3', 10)
+    eww.incr('acc3')
+
+    # Nothing should have gone through the queue
+    assert eww.shared.STATS_QUEUE.qsize() == 0
+
+    assert expected_counter_value('acc1', 5)
+    assert expected_counter_value('acc2', -2)
+    assert expected_counter_value('acc3', 11)
+
+    def worker():
+        for _ in range(100):
+            eww.incr('acc1')
+        eww.put('acc2', 7)
+
+    worker_thread = threading.Thread(target=worker)
+    worker_thread.start()
+    worker_thread.join()
+
+    assert expected_counter_value('acc1', 105)
+    assert expected_counter_value('acc2', 7)
+
+    # The dead thread's accumulator should be dropped after a final harvest
+    assert expected_thread_count(2)
+    total = 0
+    while total < 2 and len(eww.shared.ACCUMULATORS) != 1:
+        time.sleep(0.01)
+        total += 0.01
+    assert len(eww.shared.ACCUMULATORS) == 1
+
+    assert_raises(InvalidCounterOption, eww.incr, 1)
+    assert_raises(InvalidCounterOption, eww.incr, 'acc1', '1')
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+
+    eww.shared.STATS_CONFIG['accumulate'] = False
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+def test_queue_overflow():
+    """Tests that counters are coalesced, and graph drops counted, when the
+    stats queue is full.
+    """
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+    eww.shared.STATS_STATUS['dropped'] = 0
+
+    for _ in range(499):
+        eww.graph('overflow_graph', (0, 0))
+    eww.incr('ordered_counter', 3)
+    assert eww.shared.STATS_QUEUE.full()
+
+    for _ in range(10):
+        eww.incr('overflow_counter')
+    eww.put('ordered_counter', 100)
+    eww.incr('ordered_counter', 10)
+    eww.graph('overflow_graph', (1, 1))
+    eww.graph('overflow_graph', (2, 2))
+
+    # Ten increments should have coalesced into a single pending +10, and the
+    # put should be kept between the increments around it.
+    overflow = eww.shared.STATS_QUEUE.overflow
+    assert overflow['overflow_counter'] == [10, None, 0]
+    assert overflow['ordered_counter'] == [0, 100, 10]
+    assert eww.shared.STATS_QUEUE.dropped == 2
+
+    stats_thread = eww.stats.StatsThread(max_datapoints=5, timeout=0.01)
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    assert expected_counter_value('overflow_counter', 10)
+    assert expected_counter_value('ordered_counter', 110)
+    total = 0
+    while total < 2 and not eww.shared.STATS_QUEUE.empty():
+        time.sleep(0.01)
+        total += 0.01
+
+    command = eww.command.Command()
+    output = run_command(command.stats_command())
+    output = output.stdout
+    assert 'overflow_counter:10' in output
+    assert 'Dropped stats (stats queue full): 2' in output
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+
+    eww.shared.STATS_STATUS['dropped'] = 0
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+    del eww.shared.ACCUMULATORS[:]
+    eww.stats.LOCAL_STATS.__dict__.clear()
+
+def test_batched_ingestion():
+    """Tests that the stats thread drains the queue in batches."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+    for num in range(10):
+        eww.incr('batch_counter')
+        eww.graph('batch_graph', (num, num))
+
+    batch = eww.stats.drain_queue(eww.shared.STATS_QUEUE, 15, 0.01)
+    assert len(batch) == 15
+    assert batch[0].name == 'batch_counter'
+    assert batch[1].name == 'batch_graph'
+    assert eww.shared.STATS_QUEUE.qsize() == 5
+
+    batch += eww.stats.drain_queue(eww.shared.STATS_QUEUE, 15, 0.01, 0.01)
+    assert len(batch) == 20
+    assert eww.stats.drain_queue(eww.shared.STATS_QUEUE, 15, 0.01) == []
+
+    # A batch always takes something, so the stats thread can't spin
+    eww.incr('batch_counter', 0)
+    small = eww.stats.drain_queue(eww.shared.STATS_QUEUE, 0, 0.01)
+    assert len(small) == 1
+    eww.shared.STATS_QUEUE.task_done(1)
+
+    stats_thread = eww.stats.StatsThread(max_datapoints=5, timeout=0.01,
+                                         batch_size=3)
+    stats_thread.process_batch(batch)
+
+    assert eww.shared.COUNTER_STORE['batch_counter'] == 10
+    assert list(eww.shared.GRAPH_STORE['batch_graph'])[-1] == (9, 9)
+
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    for _ in range(10):
+        eww.incr('batch_counter')
+
+    assert expected_counter_value('batch_counter', 20)
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+def test_graph_series():
+    """Tests the ring buffer used to store graph datapoints."""
+
+    series = eww.stats.GraphSeries(3)
+    assert len(series) == 0
+    assert list(series) == []
+
+    series.append((0, 10))
+    series.append((1, 11))
+    assert list(series) == [(0, 10), (1, 11)]
+
+    for num in range(2, 5):
+        series.append((num, num + 10))
+
+    assert len(series) == 3
+    assert list(series) == [(2, 12), (3, 13), (4, 14)]
+    assert series[0] == (2, 12)
+    assert series[-1] == (4, 14)
+    assert_raises(IndexError, series.__getitem__, 3)
+
+    empty_series = eww.stats.GraphSeries(0)
+    empty_series.append((0, 0))
+    assert len(empty_series) == 0
+
+    # The stats command should work on top of it
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.GRAPH_STORE['series'] = series
+
+    command = eww.command.Command()
+    stats = command.stats_command()
+
+    output = run_command(stats, 'series')
+    output = output.stdout
+    assert output == '[(2, 12), (3, 13), (4, 14)]\n'
+
+    eww.shared.GRAPH_STORE.clear()
+
+def test_histogram():
+    """Tests the histogram structure and quantile accuracy."""
+
+    histogram = eww.stats.Histogram()
+    assert histogram.quantile(0.5) == None
+
+    for num in range(1, 10001):
+        histogram.add(num)
+    histogram.add(0)
+
+    assert histogram.count == 10001
+    assert histogram.min == 0
+    assert histogram.max == 10000
+    assert histogram.total == 50005000
+
+    for quantile in (0.5, 0.9, 0.99, 0.999):
+        expected = quantile * 10000
+        assert abs(histogram.quantile(quantile) - expected) <= expected * 0.02
+
+    # Memory stays bounded no matter how many distinct values we see
+    small = eww.stats.Histogram(max_buckets=10)
+    for num in range(1, 100000, 7):
+        small.add(num)
+    assert len(small.buckets) == 10
+    assert small.quantile(1) == small.max
+
+    copied = histogram.copy()
+    copied.add(5)
+    assert copied.count == histogram.count + 1
+    assert copied.buckets is not histogram.buckets
+
+def test_histogram_stats():
+    """Tests recording histograms through the stats thread."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+    assert_raises(InvalidHistogramValue, eww.histogram, 1, 1)
+    assert_raises(InvalidHistogramValue, eww.histogram, 'foo', '1')
+    assert_raises(InvalidHistogramValue, eww.histogram, 'foo', -1)
+    assert_raises(InvalidHistogramValue, eww.histogram, 'foo', float('inf'))
+    assert_raises(InvalidHistogramValue, eww.histogram, 'foo', float('nan'))
+
+    stats_thread = eww.stats.StatsThread(timeout=0.01)
+
+    # A value that slips through is logged and skipped, without touching the
+    # histogram it was meant for.
+    stats_thread.process_stat(eww.stats.Stat('latency', 'histogram', 'add', 1))
+    stats_thread.process_stat(eww.stats.Stat('latency', 'histogram', 'add',
+                                             float('inf')))
+    assert eww.shared.HISTOGRAM_STORE['latency'].count == 1
+    assert eww.shared.HISTOGRAM_STORE['latency'].max == 1
+    eww.shared.HISTOGRAM_STORE.clear()
+
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    eww.stats.record_duration('latency', float('nan'))
+    for num in range(1, 101):
+        eww.histogram('latency', num / 10.0)
+
+    eww.incr('latency')
+    eww.histogram('sentinel', 1)
+
+    assert expected_stat_exists('sentinel', 'histogram')
+    assert eww.shared.HISTOGRAM_STORE['latency'].count == 100
+    assert 'latency' not in eww.shared.COUNTER_STORE
+
+    command = eww.command.Command()
+    stats = command.stats_command()
+
+    output = run_command(stats)
+    output = output.stdout
+    assert 'Histograms:\n' in output
+    assert '  latency:100\n' in output
+
+    output = run_command(stats, 'latency')
+    output = output.stdout.split('\n')
+    assert output[0] == 'count: 100'
+    assert output[1] == 'total: 505'
+    assert output[2] == 'min: 0.1'
+    assert output[3] == 'max: 10'
+    assert output[4].startswith('p50: 5')
+    assert output[7].startswith('p999: ')
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+def test_timer():
+    """Tests timing blocks and functions."""
+
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+    assert_raises(InvalidHistogramValue, eww.timer, 1)
+
+    # Durations shouldn't be thrown off by changes to the wall clock
+    if sys.platform.startswith('linux'):
+        assert eww.stats.clock is not time.time
+        clock = eww.stats.load_monotonic_clock()
+        first = clock()
+        assert 0 <= clock() - first < 1
+
+    stats_thread = eww.stats.StatsThread(timeout=0.01)
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    with eww.timer('timed_block'):
+        time.sleep(0.02)
+
+    @eww.timer('timed_func')
+    def timed_func(value):
+        """Docstring."""
+        if value is None:
+            raise ValueError
+        return value
+
+    assert timed_func.__name__ == 'timed_func'
+    assert timed_func(5) == 5
+    assert_raises(ValueError, timed_func, None)
+
+    assert expected_stat_exists('timed_block', 'histogram')
+    assert expected_stat_exists('timed_func', 'histogram')
+    total = 0
+    while total < 2 and eww.shared.HISTOGRAM_STORE['timed_func'].count != 2:
+        time.sleep(0.01)
+        total += 0.01
+
+    # Durations are recorded in milliseconds
+    assert eww.shared.HISTOGRAM_STORE['timed_block'].min >= 20
+    assert eww.shared.HISTOGRAM_STORE['timed_func'].count == 2
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+def test_sampling():
+    """Tests sampled stats."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+    # Rejected samples exit before validation, let alone the queue
+    eww.incr(1, sample_rate=0)
+    eww.graph('sampled_graph', 'not a datapoint', sample_rate=0)
+    eww.histogram('sampled_histogram', 1, sample_rate=0)
+    with eww.timer('sampled_timer', sample_rate=0):
+        pass
+    assert eww.shared.STATS_QUEUE.qsize() == 0
+
+    eww.shared.STATS_CONFIG['sample_rate'] = 0
+    eww.incr('sampled_counter')
+    eww.put('sampled_put', 5)
+    assert eww.shared.STATS_QUEUE.qsize() == 1
+    eww.shared.STATS_CONFIG['sample_rate'] = 1
+
+    stats_thread = eww.stats.StatsThread(timeout=0.01)
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    for _ in range(400):
+        eww.incr('sampled_counter', sample_rate=0.5)
+
+    eww.incr('sentinel')
+    assert expected_stat_exists('sentinel', 'counter')
+
+    # Recorded increments are scaled, so we should land near 400
+    value = eww.shared.COUNTER_STORE['sampled_counter']
+    assert 250 < value < 550
+    assert value % 2 == 0
+
+    command = eww.command.Command()
+    stats = command.stats_command()
+
+    eww.shared.COUNTER_STORE['sampled_counter'] = 399.6
+    output = run_command(stats, 'sampled_counter')
+    output = output.stdout
+    assert output == '400\n'
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+def test_rates():
+    """Tests counter rate tracking."""
+
+    tracker = eww.stats.RateTracker()
+
+    # 10 per second for the last 20 seconds, and a partial current second
+    for second in range(1000, 1020):
+        tracker.record(10, second + 0.5)
+    tracker.record(1000, 1020.5)
+
+    assert tracker.rate(1, 1020.9) == 10
+    assert tracker.rate(10, 1020.9) == 10
+    assert tracker.rate(60, 1020.9) == 200 / 60.0
+    assert tracker.rates(1020.9)[-1] == (300, 200 / 300.0)
+
+    # Old buckets age out without being cleared
+    assert tracker.rate(300, 2000) == 0
+    tracker.record(-5, 2000)
+    tracker.record(-5, 2000)
+    assert tracker.rate(1, 2001) == -10
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.RATE_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+    stats_thread = eww.stats.StatsThread(timeout=0.01)
+    stats_thread.process_batch([eww.stats.Stat('rate', 'counter', 'incr', 5),
+                                eww.stats.Stat('rate', 'counter', 'put', 50),
+                                eww.stats.Stat('rate', 'counter', 'decr', 2)])
+    assert eww.shared.COUNTER_STORE['rate'] == 48
+
+    now = time.time()
+    assert eww.shared.RATE_STORE['rate'].rate(1, now + 1) == 3
+
+    command = eww.command.Command()
+    stats = command.stats_command()
+
+    output = run_command(stats, '--rate')
+    output = output.stdout
+    assert output.startswith('Rates (per second, over 1s/10s/60s/5m):\n')
+    assert '  rate: ' in output
+
+    output = run_command(stats, '-r rate')
+    output = output.stdout
+    assert '  rate: ' in output
+
+    output = run_command(stats, '-r nope')
+    output = output.stdout
+    assert output == 'No rates recorded for name nope\n'
+
+    eww.shared.RATE_STORE.clear()
+    output = run_command(stats, '-r')
+    output = output.stdout
+    assert output == 'No rates recorded.\n'
+
+    eww.shared.COUNTER_STORE.clear()
+
+def test_stats_watch():
+    """Tests streaming counter changes with stats --watch."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.COUNTER_STORE['unchanged'] = 1
+    eww.shared.COUNTER_STORE['watched'] = 1
+
+    command = eww.command.Command()
+    stats = command.stats_command()
+
+    read_fd, write_fd = os.pipe()
+    input_file = os.fdopen(read_fd)
+
+    def change_counters():
+        time.sleep(0.05)
+        eww.shared.COUNTER_STORE['watched'] = 11
+        eww.shared.COUNTER_STORE['new'] = 2
+        time.sleep(0.05)
+        os.write(write_fd, '\n')
+
+    changer = threading.Thread(target=change_counters)
+    changer.start()
+
+    with CaptureOutput() as output:
+        stats.watch(0.01, input_file=input_file)
+    output = output.stdout.getvalue()
+
+    changer.join()
+    input_file.close()
+    os.close(write_fd)
+
+    output = output.split('\n')
+    assert output[0] == 'Watching counters every 0.01 seconds. Press enter to stop.'
+    assert len(output) == 3
+    assert output[1].endswith('] new:2 (+2) watched:11 (+10)')
+
+    eww.shared.COUNTER_STORE.clear()
+
+def test_snapshot():
+    """Tests taking snapshots of the stats stores."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.RATE_STORE.clear()
+
+    stats_thread = eww.stats.StatsThread(max_datapoints=5)
+    stats_thread.process_batch([
+        eww.stats.Stat('snap_counter', 'counter', 'incr', 1),
+        eww.stats.Stat('snap_graph1', 'graph', 'add', (0, 0)),
+        eww.stats.Stat('snap_graph2', 'graph', 'add', (0, 0)),
+        eww.stats.Stat('snap_histogram', 'histogram', 'add', 1)])
+
+    first = eww.stats.snapshot(series=['snap_graph1', 'missing'],
+                               distributions=['snap_histogram', 'missing'])
+    assert first.counters == {'snap_counter': 1}
+    assert first.graphs['snap_graph1'].length == 1
+    assert first.graphs['snap_graph1'].last == (0, 0)
+    assert list(first.series['snap_graph1']) == [(0, 0)]
+    assert 'missing' not in first.series
+    assert first.histograms['snap_histogram'] == (1, 1)
+    assert first.distributions['snap_histogram'].quantile(0.5) == 1
+    assert 'missing' not in first.distributions
+    assert 'snap_counter' in first.rates
+
+    stats_thread.process_batch([
+        eww.stats.Stat('snap_counter', 'counter', 'incr', 1),
+        eww.stats.Stat('snap_graph1', 'graph', 'add', (1, 1))])
+
+    # The first snapshot doesn't change
+    assert first.counters == {'snap_counter': 1}
+    assert first.graphs['snap_graph1'].length == 1
+    assert list(first.series['snap_graph1']) == [(0, 0)]
+
+    # Series and distributions are only copied when asked for
+    second = eww.stats.snapshot(rates=False)
+    assert second.distributions == {}
+    assert second.counters == {'snap_counter': 2}
+    assert second.graphs['snap_graph1'] == (2, (1, 1), 2)
+    assert second.graphs['snap_graph2'].version == 1
+    assert second.series == {}
+    assert second.rates is None
+
+    # Objects without versions are summarized too
+    eww.shared.GRAPH_STORE['snap_deque'] = deque([(0, 0)])
+    third = eww.stats.snapshot(graphs=False, series=['snap_deque'])
+    assert third.graphs is None
+    assert third.series['snap_deque'] == [(0, 0)]
+    assert eww.stats.snapshot().graphs['snap_deque'] == (1, (0, 0), None)
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.RATE_STORE.clear()
+
+def test_gauges():
+    """Tests gauges."""
+
+    eww.shared.GAUGE_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+
+    assert_raises(InvalidGaugeOption, eww.gauge, 1, lambda: 1)
+    assert_raises(InvalidGaugeOption, eww.gauge, 'bad_gauge', 1)
+    assert_raises(InvalidGaugeOption, eww.gauge, 'bad_gauge', lambda: 1, 0)
+
+    values = [10]
+    eww.gauge('depth', lambda: values[0])
+    eww.gauge('broken', lambda: 1 / 0)
+
+    # Gauges are read lazily
+    values[0] = 20
+    stats = eww.stats.snapshot()
+    assert stats.gauges == {'depth': 20, 'broken': None}
+    assert eww.stats.snapshot(gauges=False).gauges is None
+
+    stats = eww.command.Command().stats_command()
+    output = run_command(stats).stdout
+    assert 'Gauges:' in output
+    assert 'depth:20' in output
+    assert 'broken:unavailable' in output
+    assert run_command(stats, 'depth').stdout.strip() == '20'
+
+    # Sampled gauges are recorded to a graph of their own
+    stats_thread = eww.stats.StatsThread()
+    eww.gauge('sampled', lambda: 4.6, sample_interval=60)
+    stats_thread.sample_gauges()
+    stats_thread.sample_gauges()
+    assert len(eww.shared.GRAPH_STORE['sampled.samples']) == 1
+    assert eww.shared.GRAPH_STORE['sampled.samples'][0][1] == 5
+    assert 'sampled' not in eww.shared.GRAPH_STORE
+    assert 'depth.samples' not in eww.shared.GRAPH_STORE
+    assert run_command(stats, 'sampled').stdout.strip() == '4.6'
+
+    # ...so both are exported
+    exporter = eww.exporter.ExporterThread('localhost', 0)
+    output = exporter.render()
+    assert 'eww_sampled 4.6\n' in output
+    assert 'eww_sampled_samples 5\n' in output
+    assert not exporter.collisions
+
+    # Values that can't be graphed are skipped
+    values = [float('nan')]
+    eww.gauge('unstable', lambda: values[0], sample_interval=60)
+    stats_thread.sample_gauges()
+    values[0] = float('inf')
+    eww.shared.GAUGE_STORE['unstable'].next_sample = 0
+    stats_thread.sample_gauges()
+    assert 'unstable.samples' not in eww.shared.GRAPH_STORE
+    values[0] = 7
+    eww.shared.GAUGE_STORE['unstable'].next_sample = 0
+    stats_thread.sample_gauges()
+    assert list(eww.shared.GRAPH_STORE['unstable.samples'])[0][1] == 7
+
+    eww.shared.GAUGE_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+
+def test_metrics_exporter():
+    """Tests the Prometheus metrics endpoint."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+
+    def scrape(path):
+        sock = connect_to_eww(port=10002)
+        sock.sendall('GET ' + path + ' HTTP/1.0\r\n\r\n')
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+        sock.close()
+        return response
+
+    assert expected_thread_count(1)
+    eww.embed(timeout=0.01, metrics_port=10002)
+    assert expected_thread_count(4)
+
+    stats_thread = eww.stats.StatsThread()
+    stats_thread.process_batch([
+        eww.stats.Stat('requests.ok', 'counter', 'incr', 3),
+        eww.stats.Stat('queue', 'graph', 'add', (0, 7)),
+        eww.stats.Stat('latency', 'histogram', 'add', 2)])
+
+    response = scrape('/metrics')
+    assert response.startswith('HTTP/1.0 200 OK\r\n')
+    assert '# TYPE eww_requests_ok untyped\neww_requests_ok 3\n' in response
+    assert 'eww_queue 7\n' in response
+    assert '# TYPE eww_latency summary\n' in response
+    assert 'eww_latency_count 1\n' in response
+    assert 'eww_dropped_stats 0\n' in response
+
+    # Unchanged objects reuse their previous rendering
+    exporter = [thread for thread in threading.enumerate()
+                if thread.name == eww.shared.EXPORTER_THREAD_NAME][0]
+    cached = exporter.render_cache[('histogram', 'latency')][1]
+    exporter.render()
+    assert exporter.render_cache[('histogram', 'latency')][1] is cached
+
+    # Changed histograms are copied and rendered again
+    stats_thread.process_batch([
+        eww.stats.Stat('latency', 'histogram', 'add', 4)])
+    assert 'eww_latency_count 2\n' in exporter.render()
+
+    assert scrape('/nope').startswith('HTTP/1.0 404')
+
+    eww.remove()
+    assert expected_thread_count(1)
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+
+def test_metric_name_collisions():
+    """Tests that stats whose metric names collide are only exported once."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.GAUGE_STORE.clear()
+
+    stats_thread = eww.stats.StatsThread()
+    stats_thread.process_batch([
+        eww.stats.Stat('a.b', 'counter', 'incr', 1),
+        eww.stats.Stat('a_b', 'counter', 'incr', 2),
+        eww.stats.Stat('lat_count', 'counter', 'incr', 3),
+        eww.stats.Stat('lat', 'histogram', 'add', 1),
+        eww.stats.Stat('dropped_stats', 'counter', 'incr', 4)])
+    eww.gauge('a-b', lambda: 5)
+
+    exporter = eww.exporter.ExporterThread('localhost', 0)
+    output = exporter.render()
+
+    assert output.count('# TYPE eww_a_b ') == 1
+    assert 'eww_a_b 1\n' in output
+    assert 'eww_lat_count 3\n' in output
+    assert 'eww_lat_sum' not in output
+    assert output.count('# TYPE eww_dropped_stats ') == 1
+    assert exporter.collisions == set([('counter', 'a_b'),
+                                       ('counter', 'dropped_stats'),
+                                       ('histogram', 'lat'),
+                                       ('gauge', 'a-b')])
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.HISTOGRAM_STORE.clear()
+    eww.shared.GAUGE_STORE.clear()
+
+def test_stats_file():
+    """Tests mirroring stats into a memory-mapped file."""
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'eww-%(pid)s.stats')
+
+    # Anything already at the path is replaced, not written through
+    target = os.path.join(directory, 'target')
+    with open(target, 'w') as target_file:
+        target_file.write('untouched')
+    os.symlink(target, path % {'pid': os.getpid()})
+
+    stats_file = eww.statsfile.StatsFile(path, max_datapoints=3)
+    path = path % {'pid': os.getpid()}
+    assert not os.path.islink(path)
+    assert open(target).read() == 'untouched'
+    assert sorted(os.listdir(directory)) == [os.path.basename(path), 'target']
+
+    stats_thread = eww.stats.StatsThread(max_datapoints=3,
+                                         stats_file=stats_file)
+
+    stats_thread.process_batch([
+        eww.stats.Stat('file_counter', 'counter', 'incr', 2),
+        eww.stats.Stat('file_graph', 'graph', 'add', (0, 0))])
+    stats_thread.write_stats_file()
+
+    pid, counters, graphs = eww.statsfile.read_stats_file(path)
+    assert pid == os.getpid()
+    assert counters == {'file_counter': 2}
+    assert graphs == {'file_graph': [(0, 0)]}
+
+    # Wrap the ring buffer
+    stats_thread.process_batch([
+        eww.stats.Stat('file_counter', 'counter', 'decr', 1)] + [
+            eww.stats.Stat('file_graph', 'graph', 'add', (x, x * 2))
+            for x in range(1, 5)])
+    stats_thread.write_stats_file()
+
+    pid, counters, graphs = eww.statsfile.read_stats_file(path)
+    assert counters == {'file_counter': 1}
+    assert graphs == {'file_graph': [(2, 4), (3, 6), (4, 8)]}
+
+    # Only new datapoints are copied
+    copied = []
+    original_copy = stats_file.copy_datapoints
+    def copy_datapoints(offset, series, begin, end):
+        copied.append((begin, end))
+        original_copy(offset, series, begin, end)
+    stats_file.copy_datapoints = copy_datapoints
+    stats_thread.process_batch([
+        eww.stats.Stat('file_graph', 'graph', 'add', (5, 10))])
+    stats_thread.write_stats_file()
+    assert copied == [(2, 3)]
+    pid, counters, graphs = eww.statsfile.read_stats_file(path)
+    assert graphs == {'file_graph': [(3, 6), (4, 8), (5, 10)]}
+
+    # New datapoints that wrap around the end are copied in two parts
+    for x in range(6, 10):
+        stats_thread.process_batch([
+            eww.stats.Stat('file_graph', 'graph', 'add', (x, x * 2))])
+        if x % 2:
+            stats_thread.write_stats_file()
+    assert copied[-2:] == [(2, 3), (0, 1)]
+    pid, counters, graphs = eww.statsfile.read_stats_file(path)
+    assert graphs == {'file_graph': [(7, 14), (8, 16), (9, 18)]}
+
+    # Counters keep their precision
+    stats_file.write_counter('big_counter', 2 ** 53 + 1)
+    stats_file.write_counter('float_counter', 1.5)
+    stats_file.write_counter('huge_counter', 2 ** 64)
+    pid, counters, graphs = eww.statsfile.read_stats_file(path)
+    assert counters['big_counter'] == 2 ** 53 + 1
+    assert counters['float_counter'] == 1.5
+    assert counters['huge_counter'] == float(2 ** 64)
+
+    stats_file.close()
+    assert not os.path.exists(path)
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.GRAPH_STORE.clear()
+
+def test_stats_all_processes():
+    """Tests showing stats from every process sharing a stats file."""
+
+    directory = tempfile.mkdtemp()
+    template = os.path.join(directory, 'eww-%(pid)s.stats')
+
+    ours = eww.statsfile.StatsFile(template)
+    ours.write_counter('shared_counter', 2)
+    series = eww.stats.GraphSeries(5)
+    series.append((0, 0))
+    ours.write_graph('shared_graph', series)
+
+    # A file left behind by a process that's gone away
+    dead = eww.statsfile.StatsFile(os.path.join(directory, 'eww-1.stats'))
+    dead.write_counter('shared_counter', 100)
+    dead_pid = 2 ** 31 - 1
+    eww.statsfile.HEADER.pack_into(dead.map, 0, eww.statsfile.MAGIC,
+                                   eww.statsfile.SCHEMA_VERSION, dead_pid,
+                                   dead.counter_slots, dead.graph_slots,
+                                   dead.max_datapoints, dead.item_size)
+
+    processes = eww.statsfile.read_stats_files(template)
+    assert processes.keys() == [os.getpid()]
+
+    stats = eww.command.Command().stats_command()
+
+    output = run_command(stats, '--all').stdout
+    assert output == 'Eww was not embedded with a stats_file.\n'
+
+    eww.shared.STATS_CONFIG['stats_file'] = template
+    output = run_command(stats, '--all').stdout
+    pid = str(os.getpid())
+    assert output == ('Processes: ' + pid + '\n'
+                      'Counters:\n'
+                      '  shared_counter:2 (' + pid + ':2)\n'
+                      'Graphs:\n'
+                      '  shared_graph:1 (' + pid + ':1)\n')
+
+    output = run_command(stats, '--all missing').stdout
+    assert output.endswith('No stat recorded with that name.\n')
+
+    eww.shared.STATS_CONFIG['stats_file'] = None
+    ours.close()
+    dead.close()
+
+def test_fork():
+    """Tests that a forked child gets its own working eww, once it uses it."""
+
+    assert expected_thread_count(1)
+    eww.embed(timeout=0.01)
+    assert expected_thread_count(3)
+    eww.put('fork_counter', 5)
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover -- coverage doesn't follow the child
+        status = 1
+        try:
+            # Nothing starts until the child records a stat.  Parent stats
+            # don't carry over, and new stats are recorded.
+            if (expected_thread_count(1) and
+                    'fork_counter' not in eww.shared.COUNTER_STORE):
+                eww.incr('fork_counter')
+                if (expected_thread_count(3) and
+                        expected_counter_value('fork_counter', 1)):
+                    status = 0
+            eww.remove()
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+
+    # The parent is unaffected
+    assert expected_thread_count(3)
+    assert expected_counter_value('fork_counter', 5)
+
+    eww.remove()
+    assert expected_thread_count(1)
+    eww.shared.COUNTER_STORE.clear()
+
+def test_fork_shared_paths():
+    """Tests that a forked child leaves a stats file without a PID in its
+    path to its parent, and that our descriptors are close-on-exec.
+    """
+
+    import fcntl
+
+    assert expected_thread_count(1)
+    path = os.path.join(tempfile.mkdtemp(), 'eww.stats')
+    eww.embed(timeout=0.01, stats_file=path)
+    assert expected_thread_count(3)
+
+    inode = os.stat(path).st_ino
+    for name in os.listdir('/proc/self/fd'):
+        try:
+            if os.fstat(int(name)).st_ino != inode:
+                continue
+        except OSError:
+            continue
+        assert fcntl.fcntl(int(name), fcntl.F_GETFD) & fcntl.FD_CLOEXEC
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover -- coverage doesn't follow the child
+        status = 1
+        try:
+            eww.embed()
+            if (expected_thread_count(3) and
+                    eww.shared.STATS_CONFIG['stats_file'] is None and
+                    os.stat(path).st_ino == inode):
+                status = 0
+            eww.remove()
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert eww.statsfile.read_stats_file(path)[0] == os.getpid()
+
+    eww.remove()
+    assert expected_thread_count(1)
+    assert not os.path.exists(path)
+
+def test_dispatch_wakeup():
+    """Tests that the dispatch thread stops without waiting for a timeout."""
+
+    assert expected_thread_count(1)
+
+    dispatch_thread = eww.dispatch.DispatchThread('localhost', 10004,
+                                                  timeout=60)
+    dispatch_thread.start()
+    assert expected_thread_count(2)
+
+    dispatch_thread.stop()
+    dispatch_thread.join(1)
+    assert not dispatch_thread.is_alive()
+    assert dispatch_thread.wakeup_write_fd is None
+
+    # Stopping again is harmless
+    dispatch_thread.stop()
+
+def test_wakeable_thread_high_fds():
+    """Tests that wakeable threads can wait on descriptors above
+    FD_SETSIZE, which select() can't.
+    """
+
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft <= 1100 and (hard == resource.RLIM_INFINITY or hard > 1100):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (1100, hard))
+    elif soft <= 1100:  # pragma: no cover
+        return
+
+    try:
+        thread = eww.stoppable_thread.WakeableThread()
+        read_fd, write_fd = os.pipe()
+        high_fd = os.dup2(read_fd, 1050) or 1050
+        poller = thread.make_poller(high_fd)
+        assert thread.wait_readable(poller, 0) == []
+        # As console commands wait for their input
+        assert not eww.command.wait_for_input(high_fd, 0)
+
+        os.write(write_fd, 'x')
+        assert thread.wait_readable(poller, 1) == [high_fd]
+        assert eww.command.wait_for_input(high_fd, 1)
+
+        thread.stop()
+        assert sorted(thread.wait_readable(poller, 1)) == sorted(
+            [thread.wakeup_fd, high_fd])
+
+        thread.close_wakeup()
+        for fd in (read_fd, write_fd, high_fd):
+            os.close(fd)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+def test_idle_stats_thread():
+    """Tests that an idle stats thread sleeps until woken, and that remove
+    doesn't wait for a timeout.
+    """
+
+    assert expected_thread_count(1)
+    eww.embed(timeout=30)
+    assert expected_thread_count(3)
+
+    stats_thread = [thread for thread in threading.enumerate()
+                    if thread.name == STATS_THREAD_NAME][0]
+    assert stats_thread.wait_time() is None
+
+    eww.incr('idle_counter')
+    assert expected_counter_value('idle_counter', 1)
+
+    start = time.time()
+    eww.remove()
+    assert time.time() - start < 5
+    assert expected_thread_count(1)
+
+    eww.shared.COUNTER_STORE.clear()
+    eww.shared.RATE_STORE.clear()
+
+def test_console_pool():
+    """Tests console limits, idle timeouts and thread reuse."""
+
+    def read_all(sock):
+        output = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                return output
+            output += data
+
+    assert expected_thread_count(1)
+    eww.embed(timeout=0.01, max_consoles=1, console_idle_timeout=0.5,
+              console_linger=10)
+    assert expected_thread_count(3)
+
+    first = connect_to_eww()
+    assert expected_thread_count(4)
+
+    rejected = connect_to_eww()
+    assert 'Too many Eww consoles are open' in read_all(rejected)
+    rejected.close()
+
+    # The console thread waits around for the next connection
+    first.shutdown(socket.SHUT_RDWR)
+    first.close()
+    total = 0
+    while total < 2 and not [thread for thread in threading.enumerate()
+                             if thread.name == 'eww_console_idle']:
+        time.sleep(0.01)
+        total += 0.01
+    assert expected_thread_count(4)
+
+    # ...and serves it, until it's idle for too long
+    second = connect_to_eww()
+    assert 'Console was idle for too long.' in read_all(second)
+    second.close()
+    assert expected_thread_count(4)
+
+    eww.remove()
+    assert expected_thread_count(1)
+
+def test_event_console():
+    """Tests serving consoles from a single event loop thread."""
+
+    def read_until_prompt(sock):
+        output = ''
+        while not output.endswith('(eww) '):
+            data = sock.recv(4096)
+            if not data:
+                break
+            output += data
+        return output
+
+    assert_raises(eww.implant.InvalidStatsBatchSize, eww.embed,
+                  stats_batch_size=0)
+    assert_raises(eww.implant.InvalidConsoleEngine, eww.embed,
+                  console_engine='fibers')
+
+    assert expected_thread_count(1)
+    eww.embed(timeout=0.01, console_engine='event', console_workers=1)
+    # Dispatch, stats, the event loop and one worker
+    assert expected_thread_count(5)
+
+    eww.put('event_counter', 3)
+    assert expected_counter_value('event_counter', 3)
+
+    first = connect_to_eww()
+    second = connect_to_eww()
+    assert 'Welcome to the Eww console' in read_until_prompt(first)
+    assert 'Welcome to the Eww console' in read_until_prompt(second)
+
+    # Consoles don't get their own threads
+    assert expected_thread_count(5)
+
+    second.sendall('stats event_counter\n')
+    assert read_until_prompt(second) == '3\n(eww) '
+
+    # Several lines at once are run in order
+    first.sendall('stats event_counter\nstats nope\n')
+    output = read_until_prompt(first)
+    if output == '3\n(eww) ':
+        output += read_until_prompt(first)
+    assert output == '3\n(eww) No stat recorded with that name.\n(eww) '
+
+    # A streaming command doesn't hold up other consoles, even though it's
+    # using our only worker
+    first.sendall('stats --watch 0.05 event_counter\n')
+    assert first.recv(4096).startswith('Watching')
+    second.sendall('stats event_counter\n')
+    assert read_until_prompt(second) == '3\n(eww) '
+
+    # The watch only reads the line that stops it, the next line runs once
+    # it's done
+    first.sendall('\nstats event_counter\n')
+    output = read_until_prompt(first)
+    if not output.endswith('3\n(eww) '):
+        output += read_until_prompt(first)
+    assert output.endswith('(eww) 3\n(eww) ')
+
+    # The extra worker exits once it's done
+    assert expected_thread_count(5)
+
+    first.sendall('exit\n')
+    assert read_until_prompt(first) == 'Disconnecting...\n'
+
+    eww.remove()
+    assert expected_thread_count(1)
+    second.close()
+    first.close()
+    eww.shared.COUNTER_STORE.clear()
+
+def test_profile():
+    """Tests the sampling profiler."""
+
+    assert eww.profiler.parse_interval('5ms') == 0.005
+    assert eww.profiler.parse_interval('2') == 2.0
+    assert_raises(eww.profiler.InvalidInterval, eww.profiler.parse_interval,
+                  '5 minutes')
+    assert_raises(eww.profiler.InvalidInterval, eww.profiler.parse_interval,
+                  '0ms')
+
+    stop = threading.Event()
+
+    def spin_for_profiler():
+        while not stop.is_set():
+            pass
+
+    spinner = threading.Thread(target=spin_for_profiler, name='spinner')
+    spinner.start()
+
+    try:
+        profile = eww.command.Command().profile_command()
+
+        read_fd, write_fd = os.pipe()
+        input_file = os.fdopen(read_fd)
+        sampler = eww.profiler.StackSampler()
+        with CaptureOutput() as output:
+            profile.profile(sampler, 0.2, 0.001, input_file=input_file)
+
+        assert output.stdout.getvalue().startswith('Sampling every 0.001 ')
+        assert sampler.samples > 10
+        lines = sampler.collapsed()
+        spinner_lines = [line for line in lines
+                         if line.startswith('spinner;')]
+        assert spinner_lines
+        assert 'spin_for_profiler (' in spinner_lines[0]
+        assert not [line for line in lines if 'profile (' in line]
+
+        # Bounded, plus an [other] stack per thread
+        sampler = eww.profiler.StackSampler(max_stacks=1, include_eww=True)
+        for _ in range(10):
+            sampler.sample()
+        assert len(sampler.stacks) <= 1 + len(sampler.threads)
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        original_stdin = sys.stdin
+        sys.stdin = input_file
+        try:
+            with CaptureOutput() as output:
+                profile.run('-d 50ms -i 1ms -f ' + filename)
+        finally:
+            sys.stdin = original_stdin
+            input_file.close()
+            os.close(write_fd)
+        assert 'stacks to ' + filename in output.stdout.getvalue()
+        with open(filename) as profile_file:
+            assert 'spin_for_profiler (' in profile_file.read()
+        os.unlink(filename)
+
+        output = run_command(profile, '-i fast')
+        assert output.stdout == 'Invalid interval: fast\n'
+    finally:
+        stop.set()
+        spinner.join()
+
+def test_cprofile():
+    """Tests profiling threads with cProfile."""
+
+    cprofile = eww.command.Command().cprofile_command()
+
+    output = run_command(cprofile, 'dump')
+    assert output.stdout == 'No profile has been started.\n'
+
+    go = threading.Event()
+    stop = threading.Event()
+    profiled = []
+    done = []
+
+    def profiled_function():
+        return sum(range(10))
+
+    def worker():
+        go.wait(5)
+        for _ in range(100):
+            profiled_function()
+        done.append(sys.getprofile() is not None)
+        stop.wait(5)
+        # Once stopped, our hooks are gone
+        profiled.append(sys.getprofile())
+
+    # Already running when the profile starts
+    running = threading.Thread(target=worker, name='cp_worker_running')
+    running.start()
+
+    output = run_command(cprofile, '-r -i cp_worker* -d 10s start')
+    assert output.stdout == ('Profiling 1 running threads, and threads '
+                             'started in the next 10.0 seconds.\n')
+
+    output = run_command(cprofile, 'start')
+    assert output.stdout == 'A profile is already running.  Stop it first.\n'
+
+    ignored = threading.Thread(target=worker, name='other_worker')
+    watched = threading.Thread(target=worker, name='cp_worker')
+    ignored.start()
+    watched.start()
+    go.set()
+
+    while len(done) < 3:
+        time.sleep(0.01)
+    assert sorted(done) == [False, True, True]
+
+    output = run_command(cprofile, 'status')
+    assert output.stdout.startswith('Profiling for another ')
+    assert output.stdout.endswith(
+        ' seconds.\n  cp_worker_running\n  cp_worker\n')
+
+    output = run_command(cprofile, 'stop')
+    assert output.stdout == 'Profiling stopped. 2 threads were profiled.\n'
+    assert expected_thread_count(4)
+
+    stop.set()
+    ignored.join()
+    running.join()
+    watched.join()
+    assert profiled == [None, None, None]
+
+    output = run_command(cprofile, '-s calls -n 5 dump')
+    assert 'profiled_function' in output.stdout
+    assert '200' in output.stdout
+
+    output = run_command(cprofile, '-s nope dump')
+    assert output.stdout == 'Invalid sort key: nope\n'
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    output = run_command(cprofile, '-f ' + filename + ' dump')
+    assert output.stdout == 'Wrote stats for 2 threads to ' + filename + '\n'
+    stats = pstats.Stats(filename)
+    assert [key for key in stats.stats if key[2] == 'profiled_function']
+    os.unlink(filename)
+
+    # Profiles stop by themselves
+    run_command(cprofile, '-i cp_worker* -d 0.05s start')
+    profiler = eww.shared.PROFILER_STATUS['profiler']
+    profiler.timer.join(5)
+    assert not profiler.running
+
+    # By default, running threads are left alone
+    output = run_command(cprofile, '-d 10s start')
+    assert output.stdout == ('Profiling threads started in the next 10.0 '
+                             'seconds.\n')
+    assert sys.getprofile() is None
+    run_command(cprofile, 'stop')
+
+    # Dumping a running profile stops it, even on the dumping thread
+    output = run_command(cprofile, '--running -d 10s start')
+    assert output.stdout.startswith('Profiling 1 running threads')
+    assert sys.getprofile() is not None
+    output = run_command(cprofile, 'dump')
+    assert output.stdout.startswith('Stopped profiling to dump the stats.\n')
+    # Parsing the dump command's arguments was profiled
+    assert 'parse_args' in output.stdout
+    assert sys.getprofile() is None
+    assert expected_thread_count(1)
+
+    eww.shared.PROFILER_STATUS['profiler'] = None
+
+def test_threads_command():
+    """Tests listing threads."""
+
+    started = threading.Event()
+    stop = threading.Event()
+
+    def spin_for_threads():
+        started.set()
+        while not stop.is_set():
+            pass
+
+    spinner = threading.Thread(target=spin_for_threads, name='spinner')
+    spinner.daemon = True
+    spinner.start()
+    started.wait(5)
+
+    try:
+        threads = eww.command.Command().threads_command()
+
+        output = run_command(threads, '').stdout
+        assert output.startswith('MainThread  ident: ')
+        assert 'in test_threads_command\n' not in output
+        assert 'spinner  ident: ' + str(spinner.ident) in output
+        assert 'daemon: True' in output
+        assert 'in spin_for_threads\n' in output
+
+        if eww.threadinfo.task_cpu_times():
+            output = run_command(threads, '-n 1 -i 200ms -b').stdout
+            output = output.split('\n')
+            assert len(output) == 2
+            assert output[0].startswith('spinner  ident: ')
+            assert ' cpu: ' in output[0]
+            assert output[0].endswith('%)')
+
+        output = run_command(threads, '-i later').stdout
+        assert output == 'Invalid interval: later\n'
+    finally:
+        stop.set()
+        spinner.join()
+
+def test_memory_command():
+    """Tests memory snapshots and diffs."""
+
+    class Leaky(object):
+        pass
+
+    memory = eww.command.Command().memory_command()
+
+    output = run_command(memory, '').stdout
+    assert output.startswith('RSS: ')
+    assert 'Snapshots: object census' in output
+
+    output = run_command(memory, 'diff').stdout
+    assert output == 'Take at least two snapshots first.\n'
+
+    leaks = []
+    for number in range(1, 5):
+        output = run_command(memory, 'snapshot').stdout
+        assert output == 'Took snapshot ' + str(number) + '.\n'
+        leaks.extend(Leaky() for _ in range(1000))
+
+    # Only the last three are kept
+    output = run_command(memory, '').stdout
+    assert output.endswith('Kept snapshots: 2 3 4\n')
+
+    output = run_command(memory, 'diff 1 2').stdout
+    assert output == 'No such snapshot.\n'
+
+    output = run_command(memory, 'diff').stdout.split('\n')
+    assert output[0] == 'Changes from snapshot 3 to snapshot 4'
+    assert [line for line in output
+            if line.endswith('+1000  standalone_tests.Leaky')]
+
+    output = run_command(memory, '-n 1 top').stdout.split('\n')
+    assert len(output) == 2
+
+    output = run_command(memory, 'stop').stdout
+    assert output == 'Stopped, and dropped all snapshots.\n'
+    assert not eww.shared.MEMORY_STATUS['tracker'].snapshots
+
+    eww.shared.MEMORY_STATUS['tracker'] = None
+
+def test_objects_command():
+    """Tests counting objects by type and graphing the counts."""
+
+    class Counted(object):
+        pass
+
+    chunks = list(eww.memory.object_chunks(100))
+    assert len(chunks) > 1
+    assert max(len(chunk) for chunk in chunks) == 100
+
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
+
+    stats_thread = eww.stats.StatsThread(timeout=0.01)
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    objects = eww.command.Command().objects_command()
+    counted = [Counted() for _ in range(1234)]
+
+    output = run_command(objects, '-n 1 -c 500 standalone_tests.Counted')
+    output = output.stdout.split('\n')
+    assert output[0].startswith('Counted ')
+    assert len(output) == 4
+    assert output[2] == '      1234  standalone_tests.Counted'
+
+    name = 'objects.standalone_tests.Counted'
+    assert expected_stat_exists(name, 'graph')
+    assert list(eww.shared.GRAPH_STORE[name])[0][1] == 1234
+    assert len(eww.shared.GRAPH_STORE) == 2
+
+    # Counting in the background, on a thread of its own
+    output = run_command(objects,
+                         '-n 0 -e 0.01s standalone_tests.Counted')
+    assert output.stdout.endswith('Counting objects every 0.01 seconds.\n')
+    assert eww.shared.OBJECTS_STATUS['counter'].name == 'eww_objects_thread'
+    counted.extend(Counted() for _ in range(10))
+
+    def counted_graph():
+        return [point[1] for point in eww.shared.GRAPH_STORE.get(name, ())]
+
+    total = 0
+    while 1244 not in counted_graph() and total < 2:
+        time.sleep(0.01)
+        total += 0.01
+    assert 1244 in counted_graph()
+
+    output = run_command(objects, '-e off')
+    assert output.stdout == 'Stopped counting objects in the background.\n'
+    assert eww.shared.OBJECTS_STATUS['counter'] is None
+    output = run_command(objects, '-e off')
+    assert output.stdout == 'Objects aren\'t being counted in the background.\n'
+    output = run_command(objects, '-e soon')
+    assert output.stdout == 'Invalid interval: soon\n'
+
+    stats_thread.stop()
+    assert expected_thread_count(1)
+    del counted
+
+    eww.shared.GRAPH_STORE.clear()
+    eww.shared.STATS_QUEUE.queue.clear()
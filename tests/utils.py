@@ -153,7 +153,7 @@ def expected_dict_size(check_dict, expected=0, timeout=2):
 def expected_counter_value(name, value, timeout=2):
     total = 0
     while total < timeout:
-        if eww.shared.COUNTER_STORE[name] == value:
+        if eww.shared.COUNTER_STORE.get(name) == value:
             return True
         time.sleep(0.01)
         total += 0.01
@@ -164,6 +164,8 @@ def expected_stat_exists(name, stat_type, timeout=2):
         stat_dict = eww.shared.COUNTER_STORE
     elif stat_type == 'graph':
         stat_dict = eww.shared.GRAPH_STORE
+    elif stat_type == 'histogram':
+        stat_dict = eww.shared.HISTOGRAM_STORE
     else:
         raise
 